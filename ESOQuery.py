@@ -1,15 +1,18 @@
 import os
 import sys
-import configparser
 from pathlib import Path
+from config import config_file, create_config, read_config, insts
+from core import read_targets, summary_labels
 from do_query import DoQuery, DataDownloader
+from perf import perflog, summary
 from log_window import LogWindow
 from pref_window import PrefWindow
 from dl_window import DlWindow
+from queue_window import QueueWindow
 # from qt_material import apply_stylesheet
-from PyQt5.QtCore import Qt, pyqtSlot, pyqtSignal, QThread
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QGroupBox, QPushButton, QComboBox, QTableWidget, QAbstractScrollArea, QAbstractItemView, QTableWidgetItem, QScrollArea, QProgressBar, QRadioButton, QButtonGroup
-from PyQt5.QtGui import QFont
+from PyQt5.QtCore import Qt, pyqtSlot, pyqtSignal, QThread, QAbstractTableModel, QModelIndex
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QGroupBox, QPushButton, QComboBox, QTableView, QHeaderView, QAbstractItemView, QScrollArea, QProgressBar, QRadioButton, QButtonGroup, QFileDialog, QCheckBox
+from PyQt5.QtGui import QFont, QFontMetrics
 
 
 """
@@ -45,15 +48,24 @@ class MainQuery(QMainWindow):
         self.show()
 
 class QueryWindow(QWidget):
+    startQuery = pyqtSignal()
+    startBatch = pyqtSignal()
+    startSync = pyqtSignal()
+    startMonitor = pyqtSignal()
+    enqueueGroups = pyqtSignal(list, bool, str, str)
+    fetchDetails = pyqtSignal(object)
+
     def __init__(self,parent=None):
         super(QueryWindow, self).__init__(parent)
-        self.insts = ['AMBER', 'APEX', 'APICAM', 'CES', 'CRIRES', 'EFOSC2', 'EMMI', 'ERIS', 'ESPRESSO',\
-                'FEROS', 'FORS1/2', 'GIRAFFE', 'GRAVITY', 'GROND', 'HARPS', 'HAWKI', 'ISAAC', 'KMOS',\
-                'LGSF', 'NACO', 'MAD', 'MASCOT', 'MATISSE', 'MIDI', 'MUSE', 'OMEGACAM', 'PIONIER',\
-                'SINFONI', 'SOFI', 'SPECULOOS', 'SPHERE', 'SUSI', 'TIMMI2', 'UVES', 'VIMOS', 'VINCI',\
-                'VIRCAM', 'VISIR', 'WFCAM', 'WFI', 'XSHOOTER']
+        self.insts = insts
         self.doquery = DoQuery()
+        self.qthread = QThread(parent = self) # To avoid the UI to freeze during the query
+        self.doquery.moveToThread(self.qthread)
+        self.qthread.start()
         self.datadownloader = DataDownloader()
+        self.dthread = QThread(parent = self) # The files are found (DataLink, calibrations) in this thread
+        self.datadownloader.moveToThread(self.dthread)
+        self.dthread.start()
         self.make_connection()
         self.initUI()
 
@@ -70,14 +82,30 @@ class QueryWindow(QWidget):
     def make_connection(self):
         self.doquery.changedStatus.connect(self.set_status)
         self.doquery.changedLog.connect(self.set_log)
+        self.doquery.newGroups.connect(self._append_table)
+        self.doquery.finished.connect(self._query_finished)
+        self.startQuery.connect(self.doquery.start_query)
+        self.startBatch.connect(self.doquery.start_batch)
+        self.startSync.connect(self.doquery.sync_mirror)
+        self.startMonitor.connect(self.doquery.start_monitor)
         self.datadownloader.changedStatus.connect(self.set_status)
         self.datadownloader.changedLog.connect(self.set_log)
+        self.datadownloader.progress.connect(self._update_pbar)
+        self.datadownloader.queueChanged.connect(self._update_queue)
+        self.datadownloader.finished.connect(self._download_finished)
+        self.enqueueGroups.connect(self.datadownloader.enqueue)
+        self.fetchDetails.connect(self.doquery.fetch_all_details)
+        self.doquery.detailsFetched.connect(self._details_fetched)
 
     def initUI(self):
         """
         The main window
         """
         self.raw = False
+        self.batch = False
+        self.lastquery = None
+        self.refresh = False
+        self.rendertimes = {}
         self.font = QFont()
         self.font.setPointSize(8)
         self.logwindow = LogWindow(self)
@@ -85,6 +113,7 @@ class QueryWindow(QWidget):
         self._read_config()
         self.pref = PrefWindow(self)
         self.dlwindow = DlWindow(self)
+        self.queuewindow = QueueWindow(self)
         self._create_menubar()
         window = QVBoxLayout()
         window.addLayout(self._create_topbar())
@@ -92,8 +121,9 @@ class QueryWindow(QWidget):
         window.addLayout(self._create_progressbar())
         self.setLayout(window)
         self._create_table()
-        self._qmoved = False
-        self._dmoved = False
+        if self.datadownloader.queue.pending() > 0 and not self.datadownloader.paused:
+            self.set_log('Resuming the download queue')
+            self.datadownloader.start_queue()
 
     def _create_progressbar(self):
         """
@@ -118,8 +148,13 @@ class QueryWindow(QWidget):
         # self.starname = QLineEdit('HD61005', self)
         self.starname = QLineEdit(self)
         self.starname.setPlaceholderText("Search")
+        self.starname.setToolTip('Star name, "ra dec", "polygon ra1 dec1 ra2 dec2 ...", or several of them separated by ";"')
         self.starname.setFixedWidth(200)
         self.starname.returnPressed.connect(self.query_star)
+        radlabel = QLabel('Radius (arcsec):', self)
+        self.radius = QLineEdit('{:g}'.format(self.doquery.radius), self)
+        self.radius.setFixedWidth(50)
+        self.radius.returnPressed.connect(self.query_star)
 
         phase = QButtonGroup(self)
         self.p3but = QRadioButton('Phase 3')
@@ -129,6 +164,10 @@ class QueryWindow(QWidget):
         self.rawbut.clicked.connect(self._raw_switch)
         phase.addButton(self.p3but)
         phase.addButton(self.rawbut)
+        self.sumbut = QCheckBox('Summary only')
+        self.sumbut.setToolTip('Let the archive group and count the files, the list of files is only fetched when selecting a row')
+        self.offbut = QCheckBox('Offline')
+        self.offbut.setToolTip('Search the local mirror of the archive (File > Synchronise offline mirror) instead of the archive')
 
         self.inslabel = QLabel('Instruments:', self)
         self.inslabel.setVisible(False)
@@ -147,11 +186,15 @@ class QueryWindow(QWidget):
         top_bar = QHBoxLayout()
         top_bar.addWidget(starlabel)
         top_bar.addWidget(self.starname)
+        top_bar.addWidget(radlabel)
+        top_bar.addWidget(self.radius)
         top_bar.addStretch()
         top_bar.addWidget(self.inslabel)
         top_bar.addWidget(self.inst)
         top_bar.addWidget(self.rawbut)
         top_bar.addWidget(self.p3but)
+        top_bar.addWidget(self.sumbut)
+        top_bar.addWidget(self.offbut)
         top_bar.addWidget(self.searchbut)
         top_bar.addWidget(self.dlbut)
         return top_bar
@@ -171,7 +214,7 @@ class QueryWindow(QWidget):
 
         I need to pass the list of urls to that window
         """
-        if self.obstable.currentRow() != -1:
+        if self.obstable.currentIndex().row() != -1:
             if self.raw:
                 self.dlwindow.dl.b1.setEnabled(True)
                 self.dlwindow.dl.b2.setEnabled(True)
@@ -182,48 +225,68 @@ class QueryWindow(QWidget):
                 self.dlwindow.dl.b3.setEnabled(False)
             self.dlwindow.show()
 
-    def _start_download(self, selector):
+    def _start_download(self, selector, level = 'normal', allrows = False):
         """
-        Will be called from the DlWindow
+        Will be called from the DlWindow: add the selected rows
+        (or all of them) to the download queue. The files are
+        found and downloaded in the background.
+
+        In summary mode the files of the rows are first listed in
+        the query thread, the download starts when they are back
+        (see _details_fetched).
         """
-        self.pbar.setVisible(True)
-        row = self.obstable.currentRow()
-        index = int(self.obstable.item(row,0).text())
-
-        self.datadownloader.user = self.user
-        self.datadownloader.password = self.password
-        self.datadownloader.raw = self.raw
-        self.datadownloader.dpath = self.dpath
-        self.datadownloader.access_url = self.results[index]['access_url'].split('\n')
-        if self.raw:
-            self.datadownloader.datalink_url = self.results[index]['datalink_url'].split('\n')
+        if allrows:
+            rows = list(range(len(self.results)))
         else:
-            self.datadownloader.obs_id = self.results[index]['obs_id'].split('\n')
-        self.datadownloader.selector = selector
-
-        thread = QThread(parent = self) # To avoid the UI to freeze during the query
-        if not self._dmoved:
-            self.datadownloader.moveToThread(thread)
-            self._dmoved = True # To avoid having to move the thread again for the 2nd query
-        thread.started.connect(self.datadownloader._get_data)
-        thread.start()
+            rows = sorted([index.row() for index in self.obstable.selectionModel().selectedRows()])
+        if len(rows) == 0:
+            return
+        request = {'action': 'download', 'rows': rows, 'groups': [self.results[row] for row in rows],
+                   'selector': selector, 'level': level}
+        if any([group.get('summary') for group in request['groups']]):
+            self.set_status('Getting the list of files of {} entries'.format(len(rows)))
+            self.fetchDetails.emit(request)
+        else:
+            self._enqueue(request['groups'], selector, level)
 
-        self.starname.setEnabled(False)
-        self.searchbut.setEnabled(False)
-        self.obstable.setEnabled(False)
-        self.dlbut.setEnabled(False)
-        self.datadownloader.progress.connect(self._update_pbar)
-        self.datadownloader.finished.connect(thread.quit)
-        self.datadownloader.finished.connect(lambda: self.searchbut.setEnabled(True))
-        self.datadownloader.finished.connect(lambda: self.dlbut.setEnabled(True))
-        self.datadownloader.finished.connect(lambda: self.starname.setEnabled(True))
-        self.datadownloader.finished.connect(lambda: self.pbar.setVisible(False))
-        self.datadownloader.finished.connect(lambda: self.pbar.setValue(0))
-        self.datadownloader.finished.connect(lambda: self.obstable.setEnabled(True))
+    def _enqueue(self, groups, selector, level):
+        if not self.batch:
+            groups = [dict(group, target = self.doquery.starname) for group in groups]
+        self.set_status('Adding {} entries to the download queue'.format(len(groups)))
+        self.pbar.setVisible(True)
+        self.enqueueGroups.emit(groups, self.raw, selector, level)
+
+    def _details_fetched(self, request):
+        """
+        The files of summary rows are known (see DoQuery.fetch_all_details):
+        update the rows that are still in the table, and show them or
+        download them. The rows whose files could not be listed stay
+        as they are and are not downloaded.
+        """
+        for row, group, details in zip(request['rows'], request['groups'], request['details']):
+            if details is not None and row < len(self.results) and self.results[row] is group:
+                self.model.update_row(row, details)
+        if request['action'] == 'download':
+            groups = [details for details in request['details'] if details is not None]
+            missing = len(request['details']) - len(groups)
+            if missing > 0:
+                self.set_status('Could not get the list of files of {} entries, they are not downloaded.'.format(missing))
+            if len(groups) > 0:
+                self._enqueue(groups, request['selector'], request['level'])
+        elif self.obstable.currentIndex().row() == request['rows'][0]:
+            self._show_infobox(request['rows'][0])
 
     def _update_pbar(self, value):
         self.pbar.setValue(value)
 
+    def _update_queue(self, status):
+        self.pbar.setVisible(status['active'] > 0 or status['queued'] > 0)
+        self.queuewindow.qu.update_status(status)
+
+    def _download_finished(self):
+        self.pbar.setVisible(False)
+        self.pbar.setValue(0)
+
     def _create_main_panel(self):
         """
         Main panel
@@ -252,51 +315,20 @@ class QueryWindow(QWidget):
         """
         Create the config file directory
         """
-        filename = str(Path.home()) + '/.config/esoquery/esoquery.conf'
-        Path(filename).parent.mkdir(parents=True, exist_ok=True)
-        if not Path(filename).is_file():
-            output = configparser.ConfigParser()
-            output.read(filename)
-            output.optionxform = str
-            output['ESO']={
-                'login': ' ',
-                'password': ' '
-            }
-            output['DATA']={
-                'path': '{}'.format(str(Path.home()))
-            }
-            output['INSTRUMENTS']={}
-            for inst in self.insts:
-                if inst == 'SPHERE': 
-                    output['INSTRUMENTS'][inst] = 'True'
-                else:
-                    output['INSTRUMENTS'][inst] = 'False'
-            with open(filename,'w') as file_object:
-                output.write(file_object)
-        self.set_status('Checking for config file: {}'.format(filename))
+        create_config()
+        self.set_status('Checking for config file: {}'.format(config_file))
 
     def _read_config(self):
         """
         Read the config file
         """
-        self.pref_insts = []
-        filename = str(Path.home()) + '/.config/esoquery/esoquery.conf'
-        output = configparser.ConfigParser()
-        output.optionxform = str
-        output.read(filename)
-        if output.has_section('ESO'):
-            self.user = output['ESO']['login']
-            self.password = output['ESO']['password']
-        else:
-            self.user, self.password = None, None
-        if output.has_section('DATA'):
-            self.dpath = output['DATA']['path']
-        else:
-            self.dpath = None
-        if output.has_section('INSTRUMENTS'):
-            for key in output['INSTRUMENTS'].keys():
-                if output['INSTRUMENTS'][key] == 'True':
-                    self.pref_insts.append(key)
+        conf = read_config()
+        self.user, self.password = conf['user'], conf['password']
+        self.dpath, self.nworkers = conf['dpath'], conf['nworkers']
+        self.pref_insts = conf['pref_insts']
+        self.doquery.configure(conf)
+        self.datadownloader.configure(conf)
+        self.perf_summary = conf['perf_summary']
         """
         Display some info in the log
         """
@@ -312,52 +344,99 @@ class QueryWindow(QWidget):
         Search the ESO archive for the selected star and instrument
         """
         if self.starname.text() != '':
-            self.doquery.raw = self.raw
+            self.batch = False
             self.doquery.starname = self.starname.text()
-            self.doquery.instrument = self.inst.currentText()
-            self.doquery.user = self.user
-            self.doquery.password = self.password
-            self.doquery.pref_insts = self.pref_insts
-
-            thread = QThread(parent = self) # To avoid the UI to freeze during the query
-            if not self._qmoved:
-                self.doquery.moveToThread(thread)
-                self._qmoved = True # To avoid having to move the thread again for the 2nd query
-            thread.started.connect(self.doquery.start_query)
-            thread.start()
-            """
-            Make sure we cannot do much during the query
-            """
-            self.starname.setEnabled(False)
-            self.searchbut.setEnabled(False)
-            self.dlbut.setEnabled(False)
-            self.export_file.setEnabled(False)
-            self.obstable.setEnabled(False)
-            self.doquery.finished.connect(thread.quit)
-            self.doquery.finished.connect(lambda: self._update_table(self.doquery.obinfo))
-            self.doquery.finished.connect(lambda: self.searchbut.setEnabled(True))
-            self.doquery.finished.connect(lambda: self.starname.setEnabled(True))
-            self.doquery.finished.connect(lambda: self.obstable.setEnabled(True))
-            self.doquery.finished.connect(lambda: self.export_file.setEnabled(True))
+            self._start_doquery(self.startQuery)
         else:
             self.set_log('No star name provide, will not do anything')
             self._update_table([])
 
+    def query_batch(self, monitor = False):
+        """
+        Search the ESO archive for all the stars of a target list,
+        with one name per line. In monitoring mode, only the files
+        that were not found by the previous runs are shown.
+        """
+        filename, _ = QFileDialog.getOpenFileName(self, 'Select a target list', self.dpath)
+        if filename == '':
+            return
+        targets = read_targets(filename)
+        if len(targets) == 0:
+            self.set_status('No targets found in {}'.format(filename))
+            return
+        self.batch = True
+        self.batchname = Path(filename).stem
+        self.doquery.targets = targets
+        self._start_doquery(self.startMonitor if monitor else self.startBatch)
+
+    def _start_doquery(self, signal):
+        """
+        Start a query (single star, batch or monitoring) in the query
+        thread. The signal is kept to run the same query for a refresh.
+        """
+        self.lastquery = signal
+        self.doquery.raw = self.raw
+        self.doquery.instrument = self.inst.currentText()
+        self.doquery.pref_insts = self.pref_insts
+        self.doquery.summary = self.sumbut.isChecked()
+        self.doquery.offline = self.offbut.isChecked()
+        self.doquery.refresh = self.refresh
+        try:
+            self.doquery.radius = float(self.radius.text())
+        except ValueError:
+            self.set_log('Could not read the radius, using {} arcsec'.format(self.doquery.radius))
+        self.refresh = False
+        self._update_table([])
+        """
+        Make sure we cannot do much during the query
+        """
+        self.starname.setEnabled(False)
+        self.radius.setEnabled(False)
+        self.searchbut.setEnabled(False)
+        self.dlbut.setEnabled(False)
+        self.export_file.setEnabled(False)
+        self.batch_file.setEnabled(False)
+        self.monitor_file.setEnabled(False)
+        self.sync_file.setEnabled(False)
+        self.obstable.setEnabled(False)
+        signal.emit()
+
+    def _query_finished(self):
+        self.searchbut.setEnabled(True)
+        self.starname.setEnabled(True)
+        self.radius.setEnabled(True)
+        self.obstable.setEnabled(True)
+        self.export_file.setEnabled(True)
+        self.batch_file.setEnabled(True)
+        self.monitor_file.setEnabled(True)
+        self.sync_file.setEnabled(True)
+        self._resize_table()
+        if self.perf_summary and len(self.rendertimes) > 0:
+            self.set_log(summary(self.rendertimes))
+
     def _create_table(self):
         """
         Create the table that will be used.
         """
+        self.model = ObsModel(self)
+        self.obstable.setModel(self.model)
         self.obstable.setFont(self.font)
-        self.obstable.setSizeAdjustPolicy(QAbstractScrollArea.AdjustToContents)
         self.obstable.setHorizontalScrollMode(QAbstractItemView.ScrollPerPixel)
         self.obstable.verticalHeader().setVisible(False)
         self.obstable.horizontalHeader().setVisible(False)
         self.obstable.horizontalHeader().setStretchLastSection(True)
+        self.obstable.horizontalHeader().setResizeContentsPrecision(200)
+        """
+        All the rows have the same height, multi-line entries
+        are shown on one line and in full in the tooltip
+        """
+        self.obstable.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.obstable.verticalHeader().setDefaultSectionSize(QFontMetrics(self.font).height() + 6)
         self.obstable.setSortingEnabled(True)
 
         self.obstable.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.obstable.setSelectionBehavior(QAbstractItemView.SelectRows)
-        self.obstable.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.obstable.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.obstable.setAlternatingRowColors(True)
         self.obstable.move(0,0)
         """
@@ -381,55 +460,56 @@ class QueryWindow(QWidget):
         """
         What happens when selecting a row
         """
-        row = self.obstable.currentRow()
-        index = int(self.obstable.item(row,0).text())
+        index = self.obstable.currentIndex().row()
+        if self.results[index].get('summary'):
+            self.fetchDetails.emit({'action': 'show', 'rows': [index], 'groups': [self.results[index]]})
+        self._show_infobox(index)
+        """
+        Able the download button
+        """
+        self.dlbut.setEnabled(True)
+
+    def _show_infobox(self, index):
+        """
+        Details of a row in the infobox
+        """
         self._delete_infobox()
         for key in self.doquery._keywords:
             if key not in self.doquery._ignorekey:
-                tmp = QLabel('<strong>{}:</strong><br/>{}'.format(key, self.results[index][key].replace('\n','<br/>')), self)
+                tmp = QLabel('<strong>{}:</strong><br/>{}'.format(key, self.results[index].get(key, '--').replace('\n','<br/>')), self)
                 tmp.setTextFormat(Qt.RichText)
                 tmp.setWordWrap(True)
                 self.infobox.addWidget(tmp)
         self.infobox.addStretch()
-        """
-        Able the download button
-        """
-        # if not self._dmoved: # Only I am not downloading data already ...
-        self.dlbut.setEnabled(True)
 
     def _update_table(self, results):
         """
         Update the obstable with the results
         """
-        self.results = results
-        if self.raw:
-            self.labels = ['ID', 'object', 'instrument', 'dp_tech', 'prog_id', 'obsnight', 
-                      'release_date', 'nfiles', 'pi_coi']
-        else:
-            self.labels = ['ID', 'target_name', 'instrument_name', 'obstech', 'proposal_id',
-                      'nfiles', 'obs_creator_name']
-        nr = len(self.results)
-        self.obstable.setRowCount(nr)
-        self.obstable.setColumnCount(len(self.labels))
-        # self.obstable.setHorizontalHeaderLabels(proper_labels)
-        for i in range(nr):
-            self.obstable.setItem(i,0, QTableWidgetItem(str(i)))
-            for j in range(1,len(self.labels)):
-                self.obstable.setItem(i,j, QTableWidgetItem(str(self.results[i][self.labels[j]])))
+        self.labels = summary_labels(self.raw)
+        if self.batch:
+            self.labels.insert(0, 'target')
+        self.obstable.clearSelection()
+        self.rendertimes = {}
+        with perflog.span('render', self.rendertimes, rows = len(results)):
+            self.model.reset(results, self.labels)
+            self._resize_table()
 
+    def _append_table(self, groups):
         """
-        Hide some of the columns
+        Add a chunk of groups at the end of the table
         """
-        self.obstable.setColumnHidden(0, True)
-        self.obstable.resizeColumnsToContents()
-        self.obstable.resizeRowsToContents()
+        first = self.model.rowCount() == 0
+        with perflog.span('render', self.rendertimes, rows = len(groups)):
+            self.model.append(groups)
+            if first:
+                self._resize_table()
+
+    def _resize_table(self):
         """
-        Refresh the infobox if a row was selected
+        Only the first rows are used to get the width of the columns
         """
-        if self.obstable.currentRow() != -1:
-            # self.dlbut.setEnabled(True)
-            # self.singleClicked_table()
-            self.obstable.clearSelection()
+        self.obstable.resizeColumnsToContents()
 
     # -----------------------------------------------------------------------------
     # For the top menu bar
@@ -444,10 +524,29 @@ class QueryWindow(QWidget):
         self.export_file = logBar.addAction('Export')
         self.export_file.setEnabled(False)
         self.export_file.triggered.connect(lambda: self.export_csv())
+        self.batch_file = logBar.addAction('Batch query')
+        self.batch_file.triggered.connect(lambda: self.query_batch())
+        self.monitor_file = logBar.addAction('Monitor a watch list')
+        self.monitor_file.setToolTip('Batch query showing only the files that are new since the last time')
+        self.monitor_file.triggered.connect(lambda: self.query_batch(monitor = True))
+        action = logBar.addAction('Refresh query')
+        action.setToolTip('Run the last query again without using the local cache')
+        action.triggered.connect(lambda: self.refresh_query())
+        action = logBar.addAction('Clear query cache')
+        action.triggered.connect(lambda: self.clear_cache())
+        self.sync_file = logBar.addAction('Synchronise offline mirror')
+        self.sync_file.setToolTip('Copy the metadata of the favorite instruments (raw or phase 3 data) to the local mirror')
+        self.sync_file.triggered.connect(lambda: self.sync_mirror())
         # logBar.addSeparator()
         action = logBar.addAction('Quit')
         action.triggered.connect(lambda: self.parent().close())
 
+        logBar = self.parent().MenuBar.addMenu('Downloads')
+        action = logBar.addAction('Show queue')
+        action.triggered.connect(lambda: self.displayQueue())
+        action = logBar.addAction('Pause or resume')
+        action.triggered.connect(lambda: self.queuewindow.qu.on_click_pause())
+
         logBar = self.parent().MenuBar.addMenu('Log')
         action = logBar.addAction('Show')
         action.triggered.connect(lambda: self.displayLog())
@@ -455,15 +554,49 @@ class QueryWindow(QWidget):
         action = logBar.addAction('Clear')
         action.triggered.connect(lambda: self.clear_log())
 
+    def refresh_query(self):
+        """
+        Run the last query again, in the same mode (single star,
+        batch or monitoring), without using the cache
+        """
+        self.refresh = True
+        if self.lastquery is None or self.lastquery == self.startQuery:
+            self.query_star()
+        else:
+            self._start_doquery(self.lastquery)
+
+    def sync_mirror(self):
+        """
+        Update the local mirror for the favorite instruments,
+        raw or phase 3 data depending on the selected button
+        """
+        self.doquery.raw = self.raw
+        self.doquery.pref_insts = self.pref_insts
+        self.rendertimes = {}
+        self.starname.setEnabled(False)
+        self.searchbut.setEnabled(False)
+        self.sync_file.setEnabled(False)
+        self.batch_file.setEnabled(False)
+        self.startSync.emit()
+
+    def clear_cache(self):
+        self.doquery.resultcache.clear()
+        self.set_status('Query cache cleared')
+
     def export_csv(self):
+        name = self.batchname if self.batch else self.starname.text().replace(' ', '_')
         if self.raw:
-            filename = '{}/esoquery_{}_raw.csv'.format(self.dpath, self.starname.text().replace(' ', '_'))
+            filename = '{}/esoquery_{}_raw.csv'.format(self.dpath, name)
         else:
-            filename = '{}/esoquery_{}_phase3.csv'.format(self.dpath, self.starname.text().replace(' ', '_'))
+            filename = '{}/esoquery_{}_phase3.csv'.format(self.dpath, name)
+        if self.batch:
+            with open(filename.replace('.csv', '_status.csv'), 'w') as f:
+                for status in self.doquery.batch_status:
+                    f.write('{target};{status};{ngroups};{nfiles}\n'.format(**status))
         f = open(filename, 'w')
         for i in range(len(self.results)):
             txt = ''
-            for j in range(1,len(self.labels)):
+            for j in range(len(self.labels)):
                 txt += str(self.results[i][self.labels[j]]).replace('\n', ' ')
                 if j != len(self.labels)-1:
                     txt += ';'
@@ -473,16 +606,98 @@ class QueryWindow(QWidget):
         f.close()
         self.set_status('File saved to {}'.format(filename))
 
+    @property
+    def results(self):
+        return self.model.results
+
+    def stop_threads(self):
+        self.qthread.quit()
+        self.qthread.wait()
+        self.dthread.quit()
+        self.dthread.wait()
+
     def displayPref(self):
         self.pref.show()
 
     def displayLog(self):
         self.logwindow.show()
 
+    def displayQueue(self):
+        self.queuewindow.qu.refresh()
+        self.queuewindow.show()
+
     def clear_log(self):
         self.logwindow.lt.logframe.clear()
 
-class ObsTable(QTableWidget):
+class ObsModel(QAbstractTableModel):
+    """
+    Table model using directly the list of groups from DoQuery,
+    the cells are only formatted when they are displayed
+    """
+
+    def __init__(self, parent = None):
+        super(ObsModel, self).__init__(parent)
+        self.results = []
+        self.labels = []
+
+    def rowCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.results)
+
+    def columnCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.labels)
+
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        value = str(self.results[index.row()].get(self.labels[index.column()], '--'))
+        if role == Qt.DisplayRole:
+            return value.replace('\n', ', ')
+        if role == Qt.ToolTipRole and '\n' in value:
+            return value
+        return None
+
+    def headerData(self, section, orientation, role = Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.labels[section]
+        return None
+
+    def reset(self, results, labels):
+        self.beginResetModel()
+        self.results = list(results)
+        self.labels = labels
+        self.endResetModel()
+
+    def append(self, groups):
+        if len(groups) == 0:
+            return
+        n = len(self.results)
+        self.beginInsertRows(QModelIndex(), n, n + len(groups) - 1)
+        self.results += groups
+        self.endInsertRows()
+
+    def update_row(self, row, group):
+        self.results[row] = group
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.labels) - 1))
+
+    def sort(self, column, order = Qt.AscendingOrder):
+        if column < 0 or column >= len(self.labels):
+            return
+        key = self.labels[column]
+        self.layoutAboutToBeChanged.emit()
+        before = self.persistentIndexList()
+        groups = [self.results[index.row()] for index in before]
+        if key == 'nfiles':
+            sortkey = lambda group: group.get(key, 0)
+        else:
+            sortkey = lambda group: str(group.get(key, ''))
+        self.results.sort(key = sortkey, reverse = (order == Qt.DescendingOrder))
+        rows = {id(group): row for row, group in enumerate(self.results)}
+        after = [self.index(rows[id(group)], index.column()) for group, index in zip(groups, before)]
+        self.changePersistentIndexList(before, after)
+        self.layoutChanged.emit()
+
+
+class ObsTable(QTableView):
     """docstring for createTable"""
     enter_key = pyqtSignal()
     del_key = pyqtSignal()
@@ -510,6 +725,7 @@ class ObsTable(QTableWidget):
 if __name__ == '__main__':
         app = QApplication(sys.argv)
         win = MainQuery()
+        app.aboutToQuit.connect(win.query_window.stop_threads)
         # apply_stylesheet(app, theme='light_blue.xml')
         win.show()
         sys.exit(app.exec_())
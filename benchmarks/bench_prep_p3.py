@@ -0,0 +1,38 @@
+"""
+Benchmark for the grouping of the phase 3 products (Query._prep_p3,
+which also covers parse and _format).
+
+Compares the vectorized implementation with the previous row by
+row one (see legacy.py) on synthetic tables, and checks that both
+give the same groups.
+
+    python benchmarks/bench_prep_p3.py 1000 10000 100000
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import Query
+from fixtures import synthetic_p3
+from legacy import legacy_prep_p3
+# ------------------------------------------------------------
+def timed(func, *args):
+    t0 = time.perf_counter()
+    out = func(*args)
+    return out, time.perf_counter() - t0
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    query = Query()
+    query.raw = False
+    query._set_keywords()
+    print('{:>10s} {:>10s} {:>12s} {:>12s} {:>9s}'.format('rows', 'groups', 'legacy [s]', 'vector [s]', 'speed-up'))
+    for nrows in sizes:
+        table = synthetic_p3(nrows)
+        new, tnew = timed(query._prep_p3, table.copy())
+        if nrows <= 20000:
+            old, told = timed(legacy_prep_p3, query, table.copy())
+            assert old == new, 'Different groups for {} rows'.format(nrows)
+            print('{:10d} {:10d} {:12.3f} {:12.3f} {:9.1f}'.format(nrows, len(new), told, tnew, told / tnew))
+        else:
+            print('{:10d} {:10d} {:>12s} {:12.3f} {:>9s}'.format(nrows, len(new), '(skipped)', tnew, '--'))
@@ -0,0 +1,93 @@
+"""
+Synthetic archive responses for the benchmarks: query outputs of
+any size, as astropy tables or VOTables, DataLink responses and
+file contents. Everything is generated from fixed seeds, so that
+the benchmarks always run on the same data.
+
+They are not recorded from real queries: the columns and values
+follow dbo.raw, ivoa.obscore and DataLink, but the tables are made
+up, so that they can have any number of rows.
+"""
+import io
+import hashlib
+import numpy as np
+from astropy.table import Table
+from astropy.io.votable import from_table
+from astropy.io.votable.tree import Info
+# ------------------------------------------------------------
+def synthetic_raw(nrows, seed = 0):
+    """
+    Random raw query output: a few instruments, observed in blocks
+    of a few hours on random nights
+    """
+    rng = np.random.default_rng(seed)
+    insts = np.array(['SPHERE', 'NAOS+CONICA', 'HARPS', 'OMEGACAM', 'VIRCAM'])
+    nights = np.datetime64('2005-01-01T23:00:00') + rng.integers(0, 6000, nrows // 50 + 1).astype('timedelta64[D]')
+    start = nights[rng.integers(0, len(nights), nrows)]
+    dobs = start + rng.integers(0, 5 * 3600 * 1000, nrows).astype('timedelta64[ms]')
+    dates = np.datetime_as_string(dobs, unit = 'ms')
+    t = Table()
+    t['object'] = rng.choice(['HD 61005', 'OBJECT', 'HD61005'], nrows)
+    t['ra'] = 114.4 + rng.normal(0, 1e-3, nrows)
+    t['dec'] = -32.8 + rng.normal(0, 1e-3, nrows)
+    t['prog_id'] = rng.choice(['095.C-0298(A)', '097.C-0865(D)', '198.C-0209(N)'], nrows)
+    t['pi_coi'] = 'BEUZIT/LAGRANGE'
+    t['date_obs'] = dates
+    t['instrument'] = rng.choice(insts, nrows)
+    t['dp_tech'] = rng.choice(['IMAGE', 'IMAGE,DUAL'], nrows)
+    t['release_date'] = dates
+    t['dp_id'] = np.char.add('SPHER.', dates)
+    return t
+
+def synthetic_p3(nrows, seed = 0):
+    """
+    Random phase 3 query output, with many proposals as
+    for a wide field survey
+    """
+    rng = np.random.default_rng(seed)
+    dates = np.datetime_as_string(np.datetime64('2012-01-01') + rng.integers(0, 4000, nrows).astype('timedelta64[D]'), unit = 's')
+    t = Table()
+    t['target_name'] = np.char.add('field_', rng.integers(0, 200, nrows).astype(str))
+    t['s_ra'] = 150. + rng.normal(0, 0.5, nrows)
+    t['s_dec'] = 2. + rng.normal(0, 0.5, nrows)
+    t['proposal_id'] = np.char.add('179.A-', rng.integers(2000, 2100, nrows).astype(str))
+    t['obstech'] = rng.choice(['IMAGE', 'SPECTRUM'], nrows)
+    t['instrument_name'] = rng.choice(['VIRCAM', 'OMEGACAM', 'MUSE'], nrows)
+    t['obs_creator_name'] = rng.choice(['Emerson', 'Kuijken', 'Bacon'], nrows)
+    t['filter'] = rng.choice(['Ks', 'J', 'r_SDSS', ''], nrows)
+    t['dp_id'] = np.char.add('ADP.', dates)
+    t['dataproduct_type'] = rng.choice(['image', 'cube'], nrows)
+    t['obs_release_date'] = dates
+    return t
+
+def votable_bytes(table):
+    """
+    VOTable as sent by a TAP or DataLink service
+    """
+    votable = from_table(table)
+    votable.resources[0].infos.append(Info(name = 'QUERY_STATUS', value = 'OK'))
+    output = io.BytesIO()
+    votable.to_xml(output)
+    return output.getvalue()
+
+def datalink_table(dp_id, file_url):
+    """
+    DataLink response of one phase 3 product, with only
+    the product itself (#this)
+    """
+    t = Table()
+    t['ID'] = ['ivo://eso.org/ID?{}'.format(dp_id)]
+    t['access_url'] = [file_url]
+    t['service_def'] = ['']
+    t['error_message'] = ['']
+    t['semantics'] = ['#this']
+    t['description'] = ['Product']
+    t['content_type'] = ['application/fits']
+    return t
+
+def file_content(name, size):
+    """
+    Bytes of a file, the same for a given name and size
+    """
+    seed = int(hashlib.md5(name.encode()).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).integers(0, 256, size, dtype = np.uint8).tobytes()
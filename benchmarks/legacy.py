@@ -0,0 +1,80 @@
+"""
+Row by row implementations of the grouping and parsing, as they
+were before vectorization. Only used by the benchmarks, to check
+that the results are the same and to measure the speed-up.
+"""
+import numpy as np
+from datetime import datetime
+# ------------------------------------------------------------
+def legacy_format(entry, key):
+    text = ''
+    if key == 'object':
+        if '' in entry: entry = np.delete(entry, np.where(entry == ''))
+        if 'OBJECT' in entry: entry = np.delete(entry, np.where(entry == 'OBJECT'))
+        if 'OBJECT NAME NOT SET' in entry: entry = np.delete(entry, np.where(entry == 'OBJECT NAME NOT SET'))
+    if key == 'ra' or key == 'dec' or key == 's_ra' or key == 's_dec':
+        text += '{:.4f}'.format(np.mean(entry))
+    else:
+        if len(entry) ==0:
+            text = '--'
+        for i in range(len(entry)):
+            text += str(entry[i])
+            if i != len(entry) - 1:
+                text += '\n'
+    return text
+
+def legacy_parse(query, q):
+    d = {}
+    d['nfiles'] = len(q)
+    kw = query._keywords.copy()
+    kw.append('obsnight')
+    for key in kw:
+        if key in q.colnames:
+            tmp = np.unique(q[key].data)
+            d[key] = legacy_format(tmp, key)
+    return d
+
+def legacy_prep_p3(query, insquery):
+    obinfo = []
+    for i in range(len(insquery)):
+        insquery[i]['obs_release_date'] = str(insquery[i]['obs_release_date'].split('T')[0].replace('-','/'))
+    for inst in np.unique(insquery['instrument_name']):
+        sel = np.where(insquery['instrument_name'] == inst)[0]
+        for io in np.unique(insquery[sel]['proposal_id']):
+            selid = np.where(insquery[sel]['proposal_id'] == io)[0]
+            obinfo.append(legacy_parse(query, insquery[sel[selid]]))
+    return obinfo
+
+def legacy_prep_raw(query, insquery):
+    """
+    Row by row implementation, before vectorization
+    """
+    def get_time(dobs):
+        if len(dobs.split('.')) == 2:
+            return datetime.strptime(dobs, '%Y-%m-%dT%H:%M:%S.%f')
+        return datetime.strptime(dobs, '%Y-%m-%dT%H:%M:%S')
+    obsnight = np.zeros(len(insquery), dtype = 'U10')
+    insquery.add_column(obsnight, name = 'obsnight')
+    for i in range(len(insquery)):
+        insquery[i]['obsnight'] = str(insquery[i]['date_obs'].split('T')[0].replace('-','/'))
+        insquery[i]['release_date'] = str(insquery[i]['release_date'].split('T')[0].replace('-','/'))
+    insquery.sort('date_obs')
+    groups = np.zeros(len(insquery))
+    insquery.add_column(groups, name = 'groups')
+    gid = 0
+    for inst in np.unique(insquery['instrument']):
+        sel = np.where(insquery['instrument'] == inst)[0]
+        insquery[sel[0]]['groups'] = gid
+        for ig in range(1,len(insquery[sel])):
+            day1 = get_time(insquery[sel[ig]]['date_obs'])
+            prev = get_time(insquery[sel[ig-1]]['date_obs'])
+            deltah = divmod((day1 - prev).total_seconds(), 3600)[0]
+            if deltah > 3.:
+                gid += 1
+            insquery[sel[ig]]['groups'] = gid
+        gid += 1
+    obinfo = []
+    for io in np.unique(insquery['groups']):
+        obinfo.append(legacy_parse(query, insquery[(insquery['groups'] == io)]))
+    return obinfo
+
@@ -0,0 +1,225 @@
+"""
+Benchmark suite: grouping, parsing, table display, queries, name
+resolution and downloads, on synthetic data from 10 to 1M rows and with a local
+stand-in for the archive services (see standin.py).
+
+    python benchmarks/run.py
+    python benchmarks/run.py --quick --save before.json
+    python benchmarks/run.py --quick --compare before.json
+
+Each measurement is the median of --repeat runs, on data generated
+from fixed seeds, so that the numbers of two commits can be compared
+(--save and --compare). Everything is written in a temporary home
+directory, the config and caches of the user are not touched.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib.util
+import statistics
+os.environ['HOME'] = tempfile.mkdtemp(prefix = 'esoquery-bench-')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import core
+from core import Query, Downloader
+from fixtures import synthetic_raw, synthetic_p3
+from standin import StandIn
+# ------------------------------------------------------------
+def median_time(func, repeat, setup = None):
+    """
+    Median duration of func(setup()) over repeat runs
+    """
+    times = []
+    for i in range(repeat):
+        args = () if setup is None else (setup(),)
+        t0 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+def make_query(raw):
+    query = Query()
+    query.raw = raw
+    query.instrument, query.pref_insts = 'All above', ['SPHERE']
+    query._set_keywords()
+    return query
+
+def bench_prep(sizes, repeat):
+    results = {}
+    for raw, synthetic in ((True, synthetic_raw), (False, synthetic_p3)):
+        query = make_query(raw)
+        prep = query._prep_raw if raw else query._prep_p3
+        for nrows in sizes:
+            table = synthetic(nrows)
+            results['prep_{}/{}'.format('raw' if raw else 'p3', nrows)] = (median_time(prep, repeat, table.copy), 's')
+    return results
+
+def bench_parse(sizes, repeat):
+    """
+    parse (and _format) of a single group of nrows files
+    """
+    results = {}
+    query = make_query(True)
+    for nrows in sizes:
+        table = query._prep_columns(synthetic_raw(nrows))
+        results['parse/{}'.format(nrows)] = (median_time(query.parse, repeat, lambda: table), 's')
+    return results
+
+def bench_table(sizes, repeat):
+    """
+    What QueryWindow._update_table does: reset the model
+    and resize the columns of the table
+    """
+    if importlib.util.find_spec('PyQt5') is None:
+        print('Skipping the table benchmark (PyQt5 is not installed)', file = sys.stderr)
+        return {}
+    from PyQt5.QtWidgets import QApplication
+    from ESOQuery import ObsModel, ObsTable
+    app = QApplication.instance() or QApplication(sys.argv)
+    query = make_query(True)
+    labels = core.summary_labels(True)
+    results = {}
+    for nrows in sizes:
+        groups = query._prep_raw(synthetic_raw(nrows))
+        table = ObsTable()
+        model = ObsModel(table)
+        table.setModel(model)
+        table.horizontalHeader().setResizeContentsPrecision(200)
+        def update():
+            model.reset(groups, labels)
+            table.resizeColumnsToContents()
+            app.processEvents()
+        results['update_table/{}'.format(nrows)] = (median_time(update, repeat), 's')
+    return results
+
+def bench_query(standin, sizes, repeat):
+    """
+    A whole query (CDS, TAP, grouping) through the stand-in,
+    with the time spent in each phase
+    """
+    core.cds_url, core.cds_mirrors = standin.url + '/sesame', []
+    core.eso_url = standin.url + '/tap_obs'
+    standin.add_name('HD 61005', 114.4, -32.8)
+    results = {}
+    for nrows in sizes:
+        standin.set_table(synthetic_raw(nrows))
+        query = make_query(True)
+        query.starname, query.refresh, query.page_size = 'HD 61005', True, 0
+        query.sync_maxrec = nrows + 1
+        phases = {}
+        def run():
+            query.namecache.clear()
+            query.start_query()
+            for phase, (count, total, nbytes) in query.timings.items():
+                phases.setdefault(phase, []).append(total)
+        results['query/{}'.format(nrows)] = (median_time(run, repeat), 's')
+        for phase in ['cds', 'tap_sync', 'prep']:
+            if phase in phases:
+                results['query_{}/{}'.format(phase, nrows)] = (statistics.median(phases[phase]), 's')
+    return results
+
+def bench_names(standin, counts, repeat):
+    """
+    Resolution of a list of names through the stand-in
+    Sesame, with sesame_chunk names per request
+    """
+    core.cds_url, core.cds_mirrors = standin.url + '/sesame', []
+    results = {}
+    for count in counts:
+        names = ['STAR {}'.format(i) for i in range(count)]
+        for i, name in enumerate(names):
+            standin.add_name(name, i * 360. / count, -30., 10., -5.)
+        query = make_query(True)
+        def setup():
+            query.namecache.clear()
+            return names
+        results['names/{}'.format(count)] = (median_time(query._resolve_names, repeat, setup), 's')
+    return results
+
+def bench_download(standin, nfiles, size, workers, repeat):
+    """
+    Download of phase 3 products (DataLink and files)
+    through the stand-in, for several numbers of workers
+    """
+    urls = standin.add_products(nfiles, size)
+    group = {'access_url': '\n'.join(urls), 'obs_id': '\n'.join([str(i) for i in range(nfiles)])}
+    results = {}
+    for nworkers in workers:
+        downloader = Downloader()
+        downloader.nworkers = nworkers
+        downloader.set_group(group, False)
+        def setup():
+            downloader.datalinkcache.clear()
+            downloader.dpath = tempfile.mkdtemp()
+        def run(_):
+            downloader.get_data()
+            shutil.rmtree(downloader.dpath)
+        duration = median_time(run, repeat, setup)
+        results['download/{}'.format(nworkers)] = (nfiles * size / 1e6 / duration, 'MB/s')
+    return results
+# ------------------------------------------------------------
+def report(results, previous = None):
+    """
+    One line per measurement, with the ratio to the
+    previous results if any (> 1 means slower now)
+    """
+    for key, (value, unit) in results.items():
+        line = '{:<28s} {:>12.4f} {:<5s}'.format(key, value, unit)
+        if previous is not None and key in previous and previous[key][0] > 0:
+            ratio = value / previous[key][0]
+            if unit == 'MB/s':
+                ratio = 1. / ratio if ratio > 0 else float('inf')
+            line += ' {:>7.2f}x'.format(ratio)
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default = '10,100,1000,10000,100000,1000000', help = 'numbers of rows, comma separated')
+    parser.add_argument('--quick', action = 'store_true', help = 'at most 100000 rows and fewer repeats')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'number of runs of each measurement')
+    parser.add_argument('--only', action = 'append', choices = ['prep', 'parse', 'table', 'query', 'names', 'download'], help = 'only run some of the benchmarks (can be repeated)')
+    parser.add_argument('--files', type = int, default = 32, help = 'number of files for the download benchmark')
+    parser.add_argument('--file-size', type = float, default = 2., help = 'size of the files in MB')
+    parser.add_argument('--workers', default = '1,2,4,8', help = 'numbers of workers for the download benchmark')
+    parser.add_argument('--save', help = 'save the results in this json file')
+    parser.add_argument('--compare', help = 'json file saved by a previous run')
+    args = parser.parse_args()
+
+    sizes = [int(n) for n in args.sizes.split(',')]
+    repeat = args.repeat
+    if args.quick:
+        sizes = [n for n in sizes if n <= 100000]
+        repeat = min(repeat, 3)
+    only = args.only or ['prep', 'parse', 'table', 'query', 'names', 'download']
+    core.perflog.enabled = False
+    results = {}
+    if 'prep' in only:
+        results.update(bench_prep(sizes, repeat))
+    if 'parse' in only:
+        results.update(bench_parse(sizes, repeat))
+    if 'table' in only:
+        results.update(bench_table([n for n in sizes if n <= 100000], repeat))
+    if 'query' in only or 'names' in only or 'download' in only:
+        standin = StandIn().start()
+        if 'query' in only:
+            results.update(bench_query(standin, [n for n in sizes if n <= 100000], repeat))
+        if 'names' in only:
+            results.update(bench_names(standin, [n for n in sizes if n <= 10000], repeat))
+        if 'download' in only:
+            workers = [int(n) for n in args.workers.split(',')]
+            results.update(bench_download(standin, args.files, int(args.file_size * 1e6), workers, repeat))
+        standin.stop()
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    report(results, previous)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent = 1)
+    shutil.rmtree(os.environ['HOME'], ignore_errors = True)
@@ -0,0 +1,123 @@
+"""
+Local stand-in for the archive services, so that the benchmarks
+measure our side only and always get the same responses:
+
+    /sesame/-ox/SNV?NAME1&NAME2...
+                        CDS Sesame (XML output, several names)
+    /tap_obs/sync       TAP synchronous queries (the same table
+                        whatever the query)
+    /datalink?ID=...    DataLink of the phase 3 products
+    /files/NAME         files, with Range requests
+
+The responses are prepared once (see fixtures.py) and replayed
+by a threaded http.server on a free port of 127.0.0.1.
+"""
+import threading
+from urllib.parse import unquote, urlparse, parse_qs
+from xml.sax.saxutils import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from fixtures import votable_bytes, datalink_table, file_content
+# ------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type = 'text/plain', status = 200, headers = {}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        standin = self.server.standin
+        url = urlparse(self.path)
+        if url.path.startswith('/sesame'):
+            body = '<?xml version="1.0" encoding="UTF-8"?>\n<Sesame>\n'
+            for name in url.query.split('&'):
+                name = unquote(name)
+                body += '<Target option="S">\n<name>{}</name>\n'.format(escape(name))
+                coords = standin.names.get(name)
+                if coords is None:
+                    body += '<INFO>*** Nothing found ***</INFO>\n'
+                else:
+                    body += ('<Resolver name="S=Simbad (stand-in)">\n<oname>{}</oname>\n<jradeg>{}</jradeg>\n'
+                             '<jdedeg>{}</jdedeg>\n<pm><pmRA>{}</pmRA><pmDE>{}</pmDE></pm>\n</Resolver>\n').format(escape(name), *coords)
+                body += '</Target>\n'
+            self._send((body + '</Sesame>\n').encode(), 'text/xml')
+        elif url.path == '/datalink':
+            dp_id = parse_qs(url.query)['ID'][0].split('?')[-1]
+            self._send(standin.datalinks[dp_id], 'application/x-votable+xml')
+        elif url.path.startswith('/files/'):
+            self._send_file(url.path[len('/files/'):])
+        else:
+            self._send(b'Not found', status = 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if urlparse(self.path).path == '/tap_obs/sync':
+            self._send(self.server.standin.tap, 'application/x-votable+xml')
+        else:
+            self._send(b'Not found', status = 404)
+
+    def _send_file(self, name):
+        content = self.server.standin.files.get(name)
+        if content is None:
+            self._send(b'Not found', status = 404)
+            return
+        headers = {'Content-Disposition': 'attachment; filename={}'.format(name), 'Accept-Ranges': 'bytes'}
+        start = 0
+        if self.headers.get('Range', '').startswith('bytes='):
+            start = int(self.headers['Range'][6:].split('-')[0])
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content))
+        self._send(content[start:], 'application/octet-stream', 206 if start > 0 else 200, headers)
+
+
+class StandIn(object):
+    """
+    The stand-in server and the responses it replays
+    """
+
+    def __init__(self):
+        self.names, self.datalinks, self.files = {}, {}, {}
+        self.tap = b''
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._server.standin = self
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_name(self, name, ra, dec, pmra = 0., pmdec = 0.):
+        self.names[name] = (ra, dec, pmra, pmdec)
+
+    def set_table(self, table):
+        """
+        Table returned by all the TAP queries
+        """
+        self.tap = votable_bytes(table)
+
+    def add_products(self, nfiles, size):
+        """
+        Phase 3 products of size bytes, returns their DataLink urls
+        """
+        urls = []
+        for i in range(nfiles):
+            dp_id = 'ADP.2020-01-01T00:00:{:06.3f}'.format(i / 1000.)
+            name = 'ADP.{:05d}.fits'.format(i)
+            self.files[name] = file_content(name, size)
+            self.datalinks[dp_id] = votable_bytes(datalink_table(dp_id, '{}/files/{}'.format(self.url, name)))
+            urls.append('{}/datalink?ID=ivo://eso.org/ID?{}'.format(self.url, dp_id))
+        return urls
@@ -0,0 +1,476 @@
+import os
+import re
+import json
+import time
+import hashlib
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+from collections import namedtuple
+from lazy import LazyModule
+np = LazyModule('numpy')
+aptable = LazyModule('astropy.table')
+# ------------------------------------------------------------
+cache_dir = str(Path.home()) + '/.config/esoquery'
+# ------------------------------------------------------------
+class SQLiteCache(object):
+    """
+    Persistent key/value cache, stored in a SQLite file
+    in the config directory.
+
+    Values are stored as json, each entry has its own expiration
+    time, and the least recently used entries are removed when
+    there are more than max_entries.
+    """
+
+    def __init__(self, filename, ttl = 30 * 86400., max_entries = 10000):
+        """
+        Open (or create) the cache file
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect('{}/{}'.format(cache_dir, filename), check_same_thread = False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, '
+                             'expires REAL, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+
+    def get(self, key, default = None):
+        """
+        Return the value for key, or default if it is not
+        there or if it has expired
+        """
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+            if row[1] < now:
+                self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return default
+            self._db.execute('UPDATE cache SET used = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl = None):
+        """
+        Store a value, with a specific time to live if provided
+        """
+        now = time.time()
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(value), now + ttl, now))
+            self._evict()
+
+    def clear(self):
+        """
+        Remove everything
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM cache')
+
+    def _evict(self):
+        """
+        Remove the expired entries and the least recently
+        used ones if there are too many of them
+        """
+        self._db.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        self._db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+
+class NameCache(SQLiteCache):
+    """
+    Cache for the name resolution with Sesame.
+
+    Names are normalised (case and white spaces) so that "hd 61005"
+    and "HD61005" end up in the same entry. Names that could not be
+    resolved are also cached, with a shorter time to live.
+    """
+
+    def __init__(self, filename = 'sesame.sqlite', ttl = 30 * 86400., negative_ttl = 86400., max_entries = 10000):
+        super(NameCache, self).__init__(filename, ttl = ttl, max_entries = max_entries)
+        self.negative_ttl = negative_ttl
+
+    @staticmethod
+    def normalise(name):
+        return re.sub(r'\s+', '', name).upper()
+
+    def get(self, name, default = None):
+        return super(NameCache, self).get(self.normalise(name), default)
+
+    def set(self, name, value, ttl = None):
+        """
+        value is either a dictionary (see resolver.Position),
+        or None if the name was not resolved
+        """
+        if ttl is None and value is None:
+            ttl = self.negative_ttl
+        super(NameCache, self).set(self.normalise(name), value, ttl = ttl)
+
+
+class ResultCache(object):
+    """
+    Cache for the results of the TAP queries.
+
+    The tables are stored as compressed numpy .npz files (one array per
+    column, plus its mask if any), named after a hash of the query, with
+    white spaces normalised, and of the user name. Entries older than
+    ttl are ignored, and the least recently used files are removed
+    when the total size is larger than max_size (in bytes).
+
+    Entries are not checked against the archive, so they can miss the
+    files ingested during the last ttl. A query for the latest
+    release_date or last_mod_date of the region would take about as
+    long as the cached query for most targets. The monitoring mode,
+    which must see every new file, does not use this cache, and a
+    refresh (--refresh, File > Refresh query) skips it.
+    """
+
+    def __init__(self, directory = cache_dir + '/results', ttl = 86400., max_size = 500e6):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+    def _path(self, query, user):
+        key = '{}|{}'.format(' '.join(query.split()), user or '')
+        return '{}/{}.npz'.format(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, query, user):
+        """
+        Return the cached table, or None
+        """
+        path = self._path(query, user)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if time.time() - mtime > self.ttl:
+            return None
+        os.utime(path, (time.time(), mtime)) # access time is used for the LRU eviction
+        table = aptable.Table()
+        with np.load(path, allow_pickle = False) as data:
+            for name in data['__columns__']:
+                if '__mask__' + name in data.files:
+                    table[name] = aptable.MaskedColumn(data[name], mask = data['__mask__' + name])
+                else:
+                    table[name] = data[name]
+        table.meta['query'] = query
+        return table
+
+    def set(self, query, user, table):
+        """
+        Store a table
+        """
+        arrays = {'__columns__': np.array(table.colnames, dtype = str)}
+        for name in table.colnames:
+            col = table[name]
+            data = np.ma.getdata(col.data)
+            if data.dtype.kind == 'O':
+                data = np.array(data, dtype = str)
+            arrays[name] = data
+            mask = np.ma.getmaskarray(col.data)
+            if mask.any():
+                arrays['__mask__' + name] = mask
+        path = self._path(query, user)
+        with self._lock:
+            with open(path + '.tmp', 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(path + '.tmp', path)
+            self._evict()
+
+    def clear(self):
+        """
+        Remove everything
+        """
+        with self._lock:
+            for path in Path(self.directory).glob('*.npz'):
+                path.unlink()
+
+    def _evict(self):
+        """
+        Remove the least recently used files until the total
+        size is below max_size
+        """
+        files = [(p.stat().st_atime, p.stat().st_size, p) for p in Path(self.directory).glob('*.npz')]
+        total = sum([f[1] for f in files])
+        for atime, size, path in sorted(files, key = lambda f: f[0]):
+            if total <= self.max_size:
+                break
+            path.unlink()
+            total -= size
+
+
+class MonitorState(object):
+    """
+    What the monitoring mode already saw for each target: the
+    dp_id of the files, and the latest release and observation
+    (or ingestion, for phase 3) dates, stored in a SQLite file
+    in the config directory.
+    """
+
+    def __init__(self, filename = 'monitor.sqlite'):
+        self._lock = threading.Lock()
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect('{}/{}'.format(cache_dir, filename), check_same_thread = False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS marks (key TEXT PRIMARY KEY, release TEXT, '
+                             'latest TEXT, updated REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS seen (key TEXT, dp_id TEXT, '
+                             'PRIMARY KEY (key, dp_id)) WITHOUT ROWID')
+
+    def marks(self, key):
+        """
+        Latest release and observation dates, (None, None)
+        if the target was never monitored
+        """
+        with self._lock:
+            row = self._db.execute('SELECT release, latest FROM marks WHERE key = ?', (key,)).fetchone()
+        return (None, None) if row is None else row
+
+    def unseen(self, key, dp_ids):
+        """
+        For each dp_id, True if it was not seen yet
+        """
+        seen = set()
+        with self._lock:
+            for i in range(0, len(dp_ids), 500):
+                chunk = [str(d) for d in dp_ids[i:i+500]]
+                rows = self._db.execute('SELECT dp_id FROM seen WHERE key = ? AND dp_id IN ({})'.format(
+                    ', '.join(['?'] * len(chunk))), [key] + chunk).fetchall()
+                seen.update([row[0] for row in rows])
+        return [str(d) not in seen for d in dp_ids]
+
+    def update(self, key, release, latest, dp_ids):
+        """
+        Remember new files and dates for a target
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO marks VALUES (?, ?, ?, ?)', (key, release, latest, time.time()))
+            self._db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)', [(key, str(d)) for d in dp_ids])
+
+    def clear(self):
+        """
+        Forget everything, the next run reports all the files again
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM marks')
+            self._db.execute('DELETE FROM seen')
+
+
+QueueItem = namedtuple('QueueItem', ['id', 'url', 'dirname', 'kind', 'target', 'priority'])
+
+class DownloadQueue(object):
+    """
+    Files waiting to be downloaded, stored in a SQLite file in the
+    config directory so that the queue survives a restart.
+
+    Each file has a state (queued, active, done or failed) and a
+    priority, the files with the lowest priority are downloaded first
+    (see Downloader.enqueue). The pause flag is stored with the queue.
+
+    Several processes can use the queue at the same time. An active
+    file belongs to the process that claimed it (host:pid), which
+    updates its heartbeat while it downloads (see touch). It is queued
+    again once that process is gone, or its heartbeat is older than
+    stale seconds, for instance when the program was killed.
+
+    With own_only, claim, pending and counts only consider the files
+    added through this object, so that a command line download does
+    not take over the rest of the shared queue.
+    """
+    stale, heartbeat_period = 3600., 30.
+
+    def __init__(self, filename = 'queue.sqlite'):
+        self._lock = threading.Lock()
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.own_only = False
+        self._touched = 0.
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect('{}/{}'.format(cache_dir, filename), check_same_thread = False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                             'url TEXT, dirname TEXT, host TEXT, kind TEXT, target TEXT, priority INTEGER, '
+                             'state TEXT, size INTEGER, reason TEXT, added REAL, updated REAL, '
+                             'owner TEXT, heartbeat REAL, UNIQUE (url, dirname))')
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(files)')]
+            for column, kind in (('owner', 'TEXT'), ('heartbeat', 'REAL')):
+                if column not in columns: # queue made by an older version
+                    self._db.execute('ALTER TABLE files ADD COLUMN {} {}'.format(column, kind))
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_state ON files (state, priority, id)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+            self._db.execute('CREATE TEMP TABLE own (id INTEGER PRIMARY KEY)')
+        self._requeue_orphans()
+
+    def _scope(self):
+        """
+        SQL condition restricting a query to the own files, if own_only
+        """
+        return ' AND id IN (SELECT id FROM own)' if self.own_only else ''
+
+    def _owner_gone(self, owner, heartbeat):
+        """
+        Whether the process that claimed a file is no longer
+        downloading it. The processes of other hosts (shared
+        home directory) are only judged by their heartbeat.
+        """
+        if owner is None or heartbeat is None or time.time() - heartbeat > self.stale:
+            return True
+        host, pid = owner.rsplit(':', 1)
+        if host != socket.gethostname() or os.name != 'posix':
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            return False
+        return False
+
+    def _requeue_orphans(self):
+        """
+        Queue again the active files whose process is gone
+        """
+        with self._lock, self._db:
+            rows = self._db.execute("SELECT id, owner, heartbeat FROM files WHERE state = 'active'").fetchall()
+            orphans = [(row[0],) for row in rows if self._owner_gone(row[1], row[2])]
+            self._db.executemany("UPDATE files SET state = 'queued', owner = NULL WHERE id = ? AND state = 'active'", orphans)
+
+    def add(self, items):
+        """
+        Queue files, items being (url, dirname, kind, target, priority).
+        Files already in the queue keep their place, unless they were
+        done or failed, or the new priority is higher. Returns the
+        number of files (re)queued.
+        """
+        now = time.time()
+        count = 0
+        with self._lock, self._db:
+            for url, dirname, kind, target, priority in items:
+                host = urlparse(url).hostname or ''
+                cursor = self._db.execute('INSERT OR IGNORE INTO files (url, dirname, host, kind, target, priority, '
+                                          "state, added, updated) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                                          (url, dirname, host, kind, target, priority, now, now))
+                if cursor.rowcount == 0:
+                    cursor = self._db.execute("UPDATE files SET state = 'queued', priority = MIN(priority, ?), "
+                                              "reason = NULL, updated = ? WHERE url = ? AND dirname = ? AND "
+                                              "(state IN ('done', 'failed') OR (state = 'queued' AND priority > ?))",
+                                              (priority, now, url, dirname, priority))
+                count += cursor.rowcount
+                self._db.execute('INSERT OR IGNORE INTO own SELECT id FROM files WHERE url = ? AND dirname = ?', (url, dirname))
+        return count
+
+    def claim(self, busy_hosts = ()):
+        """
+        Next file to download, skipping the hosts in busy_hosts,
+        marked as active and owned by this process. None if there
+        is nothing to do.
+        """
+        busy_hosts = list(busy_hosts)
+        with self._lock, self._db:
+            row = self._db.execute("SELECT id, url, dirname, kind, target, priority FROM files WHERE state = 'queued' "
+                                   'AND host NOT IN ({}){} ORDER BY priority, id LIMIT 1'.format(
+                                       ', '.join(['?'] * len(busy_hosts)), self._scope()), busy_hosts).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            cursor = self._db.execute("UPDATE files SET state = 'active', owner = ?, heartbeat = ?, updated = ? "
+                                      "WHERE id = ? AND state = 'queued'", (self.owner, now, now, row[0]))
+            if cursor.rowcount == 0: # claimed by another process in the meantime
+                return None
+        return QueueItem(*row)
+
+    def touch(self):
+        """
+        Heartbeat of the files being downloaded by this process, at
+        most once every heartbeat_period seconds. The files left by
+        the processes that are gone are queued again at the same time.
+        """
+        now = time.time()
+        if now - self._touched < self.heartbeat_period:
+            return
+        self._touched = now
+        with self._lock, self._db:
+            self._db.execute("UPDATE files SET heartbeat = ? WHERE state = 'active' AND owner = ?", (now, self.owner))
+        self._requeue_orphans()
+
+    def set_size(self, item_id, size):
+        with self._lock, self._db:
+            self._db.execute('UPDATE files SET size = ? WHERE id = ?', (size, item_id))
+
+    def finish(self, item_id, state, reason = None):
+        """
+        New state of a file: done, failed, or queued again
+        if it was interrupted
+        """
+        with self._lock, self._db:
+            self._db.execute('UPDATE files SET state = ?, reason = ?, owner = NULL, updated = ? WHERE id = ?',
+                             (state, reason, time.time(), item_id))
+
+    def counts(self):
+        """
+        For each state: number of files, number of files whose
+        size is known and their total size
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT state, COUNT(*), COUNT(size), TOTAL(size) FROM files WHERE 1{} '
+                                    'GROUP BY state'.format(self._scope())).fetchall()
+        counts = {state: (0, 0, 0.) for state in ['queued', 'active', 'done', 'failed']}
+        for state, nfiles, nknown, size in rows:
+            counts[state] = (nfiles, nknown, size)
+        return counts
+
+    def pending(self, states = ('queued', 'active'), everything = False):
+        """
+        Number of files queued or being downloaded, in
+        the whole queue if everything is True
+        """
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM files WHERE state IN ({}){}'.format(
+                ', '.join(['?'] * len(states)), '' if everything else self._scope()), list(states)).fetchone()[0]
+
+    def items(self, limit = 1000):
+        """
+        The files, active ones first, then in the order
+        they will be downloaded, and the finished ones
+        """
+        with self._lock:
+            return self._db.execute("SELECT id, url, dirname, kind, target, priority, state, size, reason FROM files "
+                                    "ORDER BY CASE state WHEN 'active' THEN 0 WHEN 'queued' THEN 1 WHEN 'failed' THEN 2 "
+                                    'ELSE 3 END, priority, id LIMIT ?', (limit,)).fetchall()
+
+    def retry(self):
+        """
+        Queue the failed files again
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE files SET state = 'queued', reason = NULL WHERE state = 'failed'")
+
+    def remove(self, ids):
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM files WHERE id = ? AND state != 'active'", [(i,) for i in ids])
+
+    def clear(self, states = ('done',)):
+        """
+        Remove the files in these states (by default the finished ones)
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files WHERE state IN ({})'.format(', '.join(['?'] * len(states))), list(states))
+
+    @property
+    def paused(self):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM settings WHERE key = 'paused'").fetchone()
+        return row is not None and row[0] == 'True'
+
+    @paused.setter
+    def paused(self, value):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO settings VALUES ('paused', ?)", (str(bool(value)),))
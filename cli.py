@@ -0,0 +1,225 @@
+"""
+Command line interface, without the graphical interface
+
+    python cli.py query HD61005 --raw --inst SPHERE
+    python cli.py query "83.82 -5.39; 83.86 -5.42" --radius 60
+    python cli.py batch targets.txt --raw --inst SPHERE --csv results.csv
+    python cli.py download HD61005 --raw --inst SPHERE --group 3 --selector raw2raw
+    python cli.py sync --raw --inst SPHERE
+    python cli.py monitor watchlist.txt --raw --inst SPHERE --download
+    python cli.py query HD61005 --raw --inst SPHERE --offline
+    python cli.py queue --resume
+
+The login, password, data directory and favorite instruments
+are read from the same config file as the graphical interface.
+"""
+import sys
+import time
+import argparse
+from core import Query, Downloader, read_targets, summary_labels, format_queue_status
+from config import create_config, read_config
+# ------------------------------------------------------------
+def _log(text):
+    print(text, file = sys.stderr)
+
+def _queue(status):
+    print('\r{:<100s}'.format(format_queue_status(status)), end = '', file = sys.stderr)
+
+def _newline():
+    print('', file = sys.stderr)
+
+def make_query(args, conf):
+    """
+    Set up a Query from the command line arguments
+    """
+    query = Query()
+    query.on_log = _log if args.verbose else None
+    query.on_status = None if args.verbose else _log
+    query.configure(conf)
+    query.raw = args.raw
+    query.summary = args.summary
+    query.refresh = args.refresh
+    query.offline = args.offline
+    if args.radius is not None:
+        query.radius = args.radius
+    query.pref_insts = args.inst if args.inst else conf['pref_insts']
+    if len(query.pref_insts) == 1:
+        query.instrument = query.pref_insts[0]
+    else:
+        query.instrument = 'All above'
+    return query
+
+def print_results(obinfo, raw, batch = False, filename = None):
+    """
+    Print the summary table, or save it in a csv file
+    """
+    labels = summary_labels(raw)
+    if batch:
+        labels = ['target'] + labels
+    out = open(filename, 'w') if filename is not None else sys.stdout
+    out.write('group;' + ';'.join(labels) + '\n')
+    for i, group in enumerate(obinfo):
+        out.write('{};'.format(i) + ';'.join([str(group[key]).replace('\n', ' ') for key in labels]) + '\n')
+    if filename is not None:
+        out.close()
+        _log('File saved to {}'.format(filename))
+
+def run_query(args, conf):
+    query = make_query(args, conf)
+    query.starname = args.starname
+    query.start_query()
+    print_results(query.obinfo, args.raw, filename = args.csv)
+    return query
+
+def run_batch(args, conf):
+    query = make_query(args, conf)
+    query.targets = read_targets(args.targets)
+    query.start_batch()
+    print_results(query.obinfo, args.raw, batch = True, filename = args.csv)
+    for status in query.batch_status:
+        _log('{target}: {status} ({ngroups} entries, {nfiles} files)'.format(**status))
+
+def make_downloader(args, conf):
+    """
+    Set up a Downloader from the command line arguments
+    """
+    downloader = Downloader()
+    downloader.on_log = _log
+    downloader.on_queue = _queue
+    downloader.on_finished = _newline
+    if getattr(args, 'dpath', None) is not None:
+        conf = dict(conf, dpath = args.dpath)
+    downloader.configure(conf)
+    if getattr(args, 'decompress', False):
+        downloader.decompress = True
+    return downloader
+
+def download_groups(args, conf, groups):
+    """
+    Queue the files of the groups and download them. Only these files
+    are downloaded, the rest of the shared queue (other commands, the
+    graphical interface) is left to "queue --resume".
+    """
+    downloader = make_downloader(args, conf)
+    downloader.queue.own_only = True
+    downloader.enqueue(groups, args.raw, args.selector, args.priority)
+    downloader.wait()
+    left = downloader.queue.pending()
+    if downloader.paused and left > 0:
+        _log('The download queue is paused ({} files left), resume it with: python3 cli.py queue --resume'.format(left))
+    elif left > 0:
+        _log('{} of the files are being downloaded by another instance.'.format(left))
+    others = downloader.queue.pending(everything = True) - left
+    if others > 0:
+        _log('{} other files are waiting in the download queue, see: python3 cli.py queue'.format(others))
+
+def run_download(args, conf):
+    query = run_query(args, conf)
+    groups = []
+    for i in args.group if args.group else range(len(query.obinfo)):
+        if i < 0 or i >= len(query.obinfo):
+            _log('No group {} for {}, skipping.'.format(i, args.starname))
+            continue
+        group = query.fetch_details(query.obinfo[i])
+        if group is None:
+            _log('Could not get the files of group {} for {}, skipping.'.format(i, args.starname))
+            continue
+        groups.append(dict(group, target = args.starname))
+    download_groups(args, conf, groups)
+
+def run_monitor(args, conf):
+    query = make_query(args, conf)
+    if args.reset:
+        query.monitorstate.clear()
+    query.targets = read_targets(args.targets)
+    query.start_monitor()
+    print_results(query.obinfo, args.raw, batch = True, filename = args.csv)
+    for status in query.batch_status:
+        _log('{target}: {status} ({ngroups} entries, {nfiles} files)'.format(**status))
+    if args.download:
+        download_groups(args, conf, query.obinfo)
+
+def run_sync(args, conf):
+    query = make_query(args, conf)
+    query.sync_mirror(query.pref_insts)
+    for kind, inst, nrows, updated in query.mirror.status():
+        _log('{} {}: {} files, last sync on {}'.format(kind, inst, nrows, time.strftime('%Y-%m-%d %H:%M', time.localtime(updated))))
+
+def run_queue(args, conf):
+    """
+    Show and manage the download queue, shared with
+    the graphical interface
+    """
+    downloader = make_downloader(args, conf)
+    if args.pause:
+        downloader.pause()
+    if args.retry:
+        downloader.queue.retry()
+    if args.clear:
+        downloader.queue.clear()
+    if args.resume:
+        downloader.resume()
+        downloader.wait()
+    for item_id, url, dirname, kind, target, priority, state, size, reason in downloader.queue.items():
+        _log('{:>6d} {:<7s} {:<11s} {:>3d} {} -> {}{}'.format(item_id, state, kind, priority, url, dirname,
+                                                        '' if reason is None else ' ({})'.format(reason)))
+    _log(format_queue_status(downloader.queue_status()))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'esoquery', description = 'Browse and download data from the ESO archive.')
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = 'show the full log')
+    sub = parser.add_subparsers(dest = 'command')
+    sub.required = True
+
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument('--raw', action = 'store_true', help = 'query the raw data instead of phase 3')
+    common.add_argument('--inst', action = 'append', help = 'instrument for the raw data (can be repeated), default: favorite instruments')
+    common.add_argument('--summary', action = 'store_true', help = 'let the archive group and count the files (faster for popular targets)')
+    common.add_argument('--offline', action = 'store_true', help = 'search the local mirror instead of the archive (see the sync command)')
+    common.add_argument('--refresh', action = 'store_true', help = 'do not use the local cache of the query results')
+    common.add_argument('--radius', type = float, help = 'search radius in arcsec, default: the one from the config file')
+    common.add_argument('--csv', help = 'save the results in this file instead of printing them')
+
+    p = sub.add_parser('query', parents = [common], help = 'query one star, or a region')
+    p.add_argument('starname', help = 'star name, "ra dec", "polygon ra1 dec1 ra2 dec2 ...", or several of them separated by ";"')
+    p.set_defaults(func = run_query)
+
+    p = sub.add_parser('batch', parents = [common], help = 'query all the stars of a target list')
+    p.add_argument('targets', help = 'file with one star name (or region) per line')
+    p.set_defaults(func = run_batch)
+
+    p = sub.add_parser('download', parents = [common], help = 'query one star and download some of the groups')
+    p.add_argument('starname')
+    p.add_argument('--group', type = int, action = 'append', help = 'group number from the query output (can be repeated), default: all')
+    p.add_argument('--selector', choices = ['sci', 'raw2raw', 'raw2master'], default = 'sci', help = 'calibration files to download for raw data')
+    p.add_argument('--dpath', help = 'download directory, default: the one from the config file')
+    p.add_argument('--priority', choices = Downloader.levels, default = 'normal', help = 'priority in the download queue')
+    p.add_argument('--decompress', action = 'store_true', help = 'decompress the .gz and .Z files while they are downloaded')
+    p.set_defaults(func = run_download)
+
+    p = sub.add_parser('monitor', parents = [common], help = 'query all the stars of a watch list, only showing the new files')
+    p.add_argument('targets', help = 'file with one star name (or region) per line')
+    p.add_argument('--download', action = 'store_true', help = 'download the new files')
+    p.add_argument('--selector', choices = ['sci', 'raw2raw', 'raw2master'], default = 'sci', help = 'calibration files to download for raw data')
+    p.add_argument('--dpath', help = 'download directory, default: the one from the config file')
+    p.add_argument('--reset', action = 'store_true', help = 'forget the previous runs, all the files are new again')
+    p.add_argument('--priority', choices = Downloader.levels, default = 'normal', help = 'priority in the download queue')
+    p.add_argument('--decompress', action = 'store_true', help = 'decompress the .gz and .Z files while they are downloaded')
+    p.set_defaults(func = run_monitor)
+
+    p = sub.add_parser('sync', parents = [common], help = 'update the local mirror of the archive for some instruments')
+    p.set_defaults(func = run_sync)
+
+    p = sub.add_parser('queue', help = 'show the download queue, pause it or download what is left')
+    p.add_argument('--pause', action = 'store_true', help = 'pause the queue, also stops the downloads running in other instances')
+    p.add_argument('--resume', action = 'store_true', help = 'resume the queue and download the files that are left')
+    p.add_argument('--retry', action = 'store_true', help = 'queue the failed files again')
+    p.add_argument('--clear', action = 'store_true', help = 'remove the files that were downloaded from the list')
+    p.set_defaults(func = run_queue)
+
+    args = parser.parse_args(argv)
+    create_config()
+    args.func(args, read_config())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import configparser
+from pathlib import Path
+# ------------------------------------------------------------
+config_file = str(Path.home()) + '/.config/esoquery/esoquery.conf'
+insts = ['AMBER', 'APEX', 'APICAM', 'CES', 'CRIRES', 'EFOSC2', 'EMMI', 'ERIS', 'ESPRESSO',\
+        'FEROS', 'FORS1/2', 'GIRAFFE', 'GRAVITY', 'GROND', 'HARPS', 'HAWKI', 'ISAAC', 'KMOS',\
+        'LGSF', 'NACO', 'MAD', 'MASCOT', 'MATISSE', 'MIDI', 'MUSE', 'OMEGACAM', 'PIONIER',\
+        'SINFONI', 'SOFI', 'SPECULOOS', 'SPHERE', 'SUSI', 'TIMMI2', 'UVES', 'VIMOS', 'VINCI',\
+        'VIRCAM', 'VISIR', 'WFCAM', 'WFI', 'XSHOOTER']
+# ------------------------------------------------------------
+def create_config(filename = config_file):
+    """
+    Create the config file and its directory if needed.
+    Returns True if the file was created.
+    """
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    if Path(filename).is_file():
+        return False
+    output = configparser.ConfigParser()
+    output.read(filename)
+    output.optionxform = str
+    output['ESO']={
+        'login': ' ',
+        'password': ' '
+    }
+    output['DATA']={
+        'path': '{}'.format(str(Path.home())),
+        'workers': '4',
+        'decompress': 'False'
+    }
+    output['CACHE']={
+        'ttl': '24',
+        'size': '500'
+    }
+    output['TAP']={
+        'execution_duration': '300',
+        'timeout': '600',
+        'sync_maxrec': '10000',
+        'sync_timeout': '30',
+        'page_size': '50000'
+    }
+    output['QUERY']={
+        'radius': '20',
+        'max_shapes': '50',
+        'resolvers': 'SNV',
+        'proper_motion': 'True',
+        'first_epoch': '1985'
+    }
+    output['PERF']={
+        'log': 'True',
+        'summary': 'False'
+    }
+    output['STORE']={
+        'enabled': 'True',
+        'path': '',
+        'link': 'hardlink',
+        'per_target': 'True'
+    }
+    output['QUEUE']={
+        'bandwidth': '0',
+        'night_bandwidth': '0',
+        'night': '',
+        'host_limit': '4',
+        'order': 'preview, science, calibration'
+    }
+    output['INSTRUMENTS']={}
+    for inst in insts:
+        if inst == 'SPHERE': 
+            output['INSTRUMENTS'][inst] = 'True'
+        else:
+            output['INSTRUMENTS'][inst] = 'False'
+    with open(filename,'w') as file_object:
+        output.write(file_object)
+    return True
+
+def read_config(filename = config_file):
+    """
+    Read the config file, returns a dictionary with the user,
+    password, dpath, nworkers, decompress, pref_insts, cache_ttl (hours),
+    cache_size (MB) and the settings of the TAP queries
+    (execution_duration, timeout, sync_maxrec, sync_timeout,
+    page_size), the search radius (arcsec), max_shapes, the name
+    resolvers of Sesame to use, in order (resolvers), whether to
+    follow the proper motion of the stars since first_epoch
+    (proper_motion, first_epoch), and whether to write the
+    timings (perf_log) and show them (perf_summary),
+    and the settings of the data store (store, store_path,
+    store_link, per_target) and of the download queue (bandwidth
+    and night_bandwidth in MB/s, night as (start, end) hours or
+    None, host_limit, queue_order)
+    """
+    conf = {'user': None, 'password': None, 'dpath': None, 'nworkers': 4, 'decompress': False, 'pref_insts': [],
+            'cache_ttl': 24., 'cache_size': 500., 'execution_duration': 300., 'timeout': 600.,
+            'sync_maxrec': 10000, 'sync_timeout': 30., 'page_size': 50000,
+            'radius': 20., 'max_shapes': 50, 'resolvers': 'SNV',
+            'proper_motion': True, 'first_epoch': 1985., 'perf_log': True, 'perf_summary': False,
+            'store': True, 'store_path': '', 'store_link': 'hardlink', 'per_target': True,
+            'bandwidth': 0., 'night_bandwidth': 0., 'night': None, 'host_limit': 4,
+            'queue_order': ['preview', 'science', 'calibration']}
+    output = configparser.ConfigParser()
+    output.optionxform = str
+    output.read(filename)
+    if output.has_section('ESO'):
+        conf['user'] = output['ESO']['login']
+        conf['password'] = output['ESO']['password']
+    if output.has_section('DATA'):
+        conf['dpath'] = output['DATA']['path']
+        conf['nworkers'] = int(output['DATA'].get('workers', '4'))
+        conf['decompress'] = output['DATA'].get('decompress', 'False') == 'True'
+    if output.has_section('CACHE'):
+        conf['cache_ttl'] = float(output['CACHE'].get('ttl', '24'))
+        conf['cache_size'] = float(output['CACHE'].get('size', '500'))
+    if output.has_section('TAP'):
+        conf['execution_duration'] = float(output['TAP'].get('execution_duration', '300'))
+        conf['timeout'] = float(output['TAP'].get('timeout', '600'))
+        conf['sync_maxrec'] = int(output['TAP'].get('sync_maxrec', '10000'))
+        conf['sync_timeout'] = float(output['TAP'].get('sync_timeout', '30'))
+        conf['page_size'] = int(output['TAP'].get('page_size', '50000'))
+    if output.has_section('QUERY'):
+        conf['radius'] = float(output['QUERY'].get('radius', '20'))
+        conf['max_shapes'] = int(output['QUERY'].get('max_shapes', '50'))
+        conf['resolvers'] = output['QUERY'].get('resolvers', 'SNV').strip().upper()
+        conf['proper_motion'] = output['QUERY'].get('proper_motion', 'True') == 'True'
+        conf['first_epoch'] = float(output['QUERY'].get('first_epoch', '1985'))
+    if output.has_section('PERF'):
+        conf['perf_log'] = output['PERF'].get('log', 'True') == 'True'
+        conf['perf_summary'] = output['PERF'].get('summary', 'False') == 'True'
+    if output.has_section('STORE'):
+        conf['store'] = output['STORE'].get('enabled', 'True') == 'True'
+        conf['store_path'] = output['STORE'].get('path', '').strip()
+        conf['store_link'] = output['STORE'].get('link', 'hardlink').strip()
+        conf['per_target'] = output['STORE'].get('per_target', 'True') == 'True'
+    if output.has_section('QUEUE'):
+        conf['bandwidth'] = float(output['QUEUE'].get('bandwidth', '0'))
+        conf['night_bandwidth'] = float(output['QUEUE'].get('night_bandwidth', '0'))
+        night = output['QUEUE'].get('night', '').strip()
+        if night != '':
+            conf['night'] = tuple([int(hour) for hour in night.split('-')])
+        conf['host_limit'] = int(output['QUEUE'].get('host_limit', '4'))
+        conf['queue_order'] = [kind.strip() for kind in output['QUEUE'].get('order', 'preview, science, calibration').split(',')]
+    if output.has_section('INSTRUMENTS'):
+        for key in output['INSTRUMENTS'].keys():
+            if output['INSTRUMENTS'][key] == 'True':
+                conf['pref_insts'].append(key)
+    return conf
@@ -0,0 +1,2002 @@
+"""
+Query and download logic, without any dependency on Qt.
+
+Progress is reported through the on_status, on_log, on_groups,
+on_progress, on_queue and on_finished callbacks, which are None by
+default.
+numpy, astropy and pyvo are only imported when first needed.
+"""
+import os
+import re
+import math
+import time
+import threading
+from urllib.parse import unquote, urlparse
+import eso_programmatic as eso
+from lazy import LazyModule
+from cache import SQLiteCache, NameCache, ResultCache, MonitorState, DownloadQueue
+from mirror import Mirror, separations, inside_polygon
+from sessions import manager, TokenBucket
+from perf import perflog, summary
+from store import DataStore, safe_name
+from resolver import Position, resolve_names
+from concurrent.futures import ThreadPoolExecutor, as_completed
+np = LazyModule('numpy')
+pyvo = LazyModule('pyvo')
+aptable = LazyModule('astropy.table')
+# ------------------------------------------------------------
+cds_url = 'http://cdsweb.u-strasbg.fr/cgi-bin/nph-sesame'
+cds_mirrors = ['http://vizier.cfa.harvard.edu/viz-bin/nph-sesame']
+eso_url = "http://archive.eso.org/tap_obs"
+calselector_url = "http://archive.eso.org/calselector/v1/associations"
+# ------------------------------------------------------------
+def dp_id_from_url(url):
+    """
+    Archive file id from a DataLink or download url,
+    (...?ID=ivo://eso.org/ID?ADP.2017-01-01T00:00:00.000)
+    or the url itself if it cannot be found
+    """
+    unquoted = unquote(url)
+    match = re.search(r'ID\?([^&?]+)$', unquoted) or re.search(r'file_id=([^&]+)', unquoted)
+    if match is None:
+        return url
+    return match.group(1)
+
+def file_id_from_url(url):
+    """
+    Archive file id of a DataLink or download url (.../file/SPHER.2016-
+    03-01T01:02:03.123), or None if it cannot be found
+    """
+    dp_id = dp_id_from_url(url)
+    if dp_id != url:
+        return dp_id
+    name = unquote(urlparse(url).path).rstrip('/').split('/')[-1]
+    if re.search(r'\.\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d', name) is None:
+        return None
+    return name
+# ------------------------------------------------------------
+def parse_coordinates(text):
+    """
+    Right ascension and declination in degrees, from "ra dec" in
+    degrees or "hh:mm:ss.s +dd:mm:ss.s" (with or without the colons),
+    or None if text does not look like coordinates
+    """
+    fields = [f for f in re.split(r'[\s,:]+', text.strip()) if f != '']
+    try:
+        values = [float(f) for f in fields]
+    except ValueError:
+        return None
+    if len(values) == 2:
+        ra, dec = values
+    elif len(values) == 6:
+        ra = 15. * (values[0] + values[1] / 60. + values[2] / 3600.)
+        dec = abs(values[3]) + values[4] / 60. + values[5] / 3600.
+        if fields[3].startswith('-'):
+            dec = -dec
+    else:
+        return None
+    if ra < 0. or ra >= 360. or abs(dec) > 90.:
+        return None
+    return ra, dec
+
+def separation(ra1, dec1, ra2, dec2):
+    """
+    Angular distance between two positions, in degrees
+    """
+    ra1, dec1, ra2, dec2 = [math.radians(v) for v in (ra1, dec1, ra2, dec2)]
+    h = math.sin((dec2 - dec1) / 2.)**2 + math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2.)**2
+    return math.degrees(2. * math.asin(min(1., math.sqrt(h))))
+
+def epochs_from_dates(dates):
+    """
+    Julian epochs (years) of dates as YYYY-MM-DDThh:mm:ss...,
+    nan for the missing ones. All nan if some cannot be read.
+    """
+    dates = np.asarray(dates, dtype = 'U19')
+    dates = np.where(np.char.isdigit(np.asarray(dates, dtype = 'U4')), dates, 'NaT')
+    try:
+        dates = np.asarray(dates, dtype = 'datetime64[s]')
+    except ValueError:
+        return np.full(len(dates), np.nan)
+    seconds = (dates - np.datetime64('2000-01-01T12:00:00')) / np.timedelta64(1, 's')
+    return 2000. + seconds / (365.25 * 86400.)
+
+def propagate(ra, dec, pmra, pmdec, epoch):
+    """
+    Position at epoch (years, can be an array) of a star at ra, dec
+    (degrees) in J2000 with a proper motion in mas/yr, pmra including
+    the cos(dec) factor. Linear in the tangent plane, which is enough
+    over a few decades away from the poles.
+    """
+    dt = np.asarray(epoch, dtype = float) - 2000.
+    cosdec = max(math.cos(math.radians(dec)), 1e-6)
+    return (ra + pmra * dt / 3.6e6 / cosdec) % 360., np.clip(dec + pmdec * dt / 3.6e6, -90., 90.)
+
+def track_shapes(ra, dec, pmra, pmdec, radius, epochs, max_cones = 8):
+    """
+    Shapes covering all the positions within radius (arcsec) of a
+    star with a proper motion (see propagate) between two epochs: a
+    single cone if it hardly moves, cones along its path, or a polygon
+    around it if more than max_cones cones would be needed. These
+    shapes end with the track, (ra, dec, pmra, pmdec, radius), to keep
+    only the files close to the star at their date (see on_track).
+    """
+    pm = math.hypot(pmra, pmdec)
+    motion = pm / 1000. * (epochs[1] - epochs[0])
+    if motion < radius / 10.:
+        return [('circle', ra, dec, radius)]
+    track = (ra, dec, pmra, pmdec, radius)
+    ncones = int(math.ceil(motion / radius)) + 1
+    if ncones <= max_cones:
+        # the cones are at most radius apart, and enlarged to cover
+        # the whole band around the path between two of them
+        wide = math.hypot(radius, motion / (ncones - 1) / 2.)
+        centres = propagate(ra, dec, pmra, pmdec, np.linspace(epochs[0], epochs[1], ncones))
+        return [('circle', float(cra), float(cdec), wide, track) for cra, cdec in zip(*centres)]
+    # rectangle around the path, in arcsec east and north of the J2000
+    # position, counterclockwise on the sky
+    ux, uy = pmra / pm, pmdec / pm
+    start, end = pm / 1000. * (epochs[0] - 2000.) - radius, pm / 1000. * (epochs[1] - 2000.) + radius
+    cosdec = max(math.cos(math.radians(dec)), 1e-6)
+    vertices = []
+    for along, across in ((start, -radius), (start, radius), (end, radius), (end, -radius)):
+        x, y = along * ux - across * uy, along * uy + across * ux
+        vertices += [(ra + x / 3600. / cosdec) % 360., max(-90., min(90., dec + y / 3600.))]
+    return [('polygon', tuple(vertices), track)]
+
+def shape_track(shape):
+    """
+    Track of a shape made by track_shapes, or None
+    """
+    if shape[0] == 'circle':
+        return shape[4] if len(shape) > 4 else None
+    return shape[2] if len(shape) > 2 else None
+
+def on_track(ra, dec, epochs, track):
+    """
+    Which of the positions (arrays, degrees) observed at these epochs
+    are within the radius of the star of the track at that time. The
+    ones without epoch are kept.
+    """
+    known = ~np.isnan(epochs)
+    tra, tdec = propagate(track[0], track[1], track[2], track[3], np.where(known, epochs, 2000.))
+    return ~known | (separations(tra, tdec, ra, dec) <= track[4])
+
+def minimal_shapes(shapes):
+    """
+    Remove the repeated shapes, and the cones that
+    are entirely inside another cone
+    """
+    cones = sorted([s for s in shapes if s[0] == 'circle'], key = lambda s: -s[3])
+    kept = []
+    for cone in cones:
+        if not any([separation(cone[1], cone[2], k[1], k[2]) * 3600. + cone[3] <= k[3] for k in kept]):
+            kept.append(cone)
+    return kept + list(dict.fromkeys([s for s in shapes if s[0] == 'polygon']))
+
+def adql_shape(shape):
+    """
+    ADQL for a ('circle', ra, dec, radius in arcsec)
+    or a ('polygon', (ra1, dec1, ra2, dec2, ...)) shape,
+    possibly followed by a track (see track_shapes)
+    """
+    if shape[0] == 'circle':
+        return "circle('J2000',{}, {}, {}/3600.)".format(shape[1], shape[2], shape[3])
+    return "polygon('J2000',{})".format(', '.join([str(v) for v in shape[1]]))
+# ------------------------------------------------------------
+def summary_labels(raw):
+    """
+    Columns of the summary table, for raw or phase 3 queries
+    """
+    if raw:
+        return ['object', 'instrument', 'dp_tech', 'prog_id', 'obsnight',
+                'release_date', 'nfiles', 'pi_coi']
+    return ['target_name', 'instrument_name', 'obstech', 'proposal_id',
+            'nfiles', 'obs_creator_name']
+
+def format_size(nbytes):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if nbytes < 1e3:
+            return '{:.1f} {}'.format(nbytes, unit)
+        nbytes /= 1e3
+    return '{:.1f} TB'.format(nbytes)
+
+def format_queue_status(status):
+    """
+    One line summary of Downloader.queue_status
+    """
+    text = 'Queue: {queued} queued, {active} active, {failed} failed'.format(**status)
+    if status['paused']:
+        return text + ' (paused)'
+    text += ', {} to go'.format(format_size(status['left']))
+    if status['rate'] > 0:
+        text += ' at {}/s'.format(format_size(status['rate']))
+    if status['eta'] is not None and status['eta'] < 86400:
+        text += ', about {} left'.format(time.strftime('%H:%M:%S', time.gmtime(status['eta'])))
+    elif status['eta'] is not None:
+        text += ', more than a day left'
+    return text
+# ------------------------------------------------------------
+def read_targets(filename):
+    """
+    Read a target list, one name per line. Empty lines
+    and lines starting with # are ignored.
+    """
+    targets = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line != '' and not line.startswith('#'):
+                targets.append(line)
+    return targets
+# ------------------------------------------------------------
+class Query(object):
+    """
+    Query the ESO archive and group the results
+    """
+
+    def __init__(self):
+        """
+        Query the ESO raw data archive
+        """
+        self.on_status, self.on_log, self.on_groups, self.on_finished = None, None, None, None
+        # self._ignorekey = ['tpl_id', 'release_date', 'date_obs', 'datalink_url']
+        self._ignorekey = ['access_url', 'tpl_id', 'release_date', 'date_obs', 'dp_id', 'datalink_url']
+        self.starname = None
+        self.instrument = None
+        self.user = None
+        self.password = None
+        self.raw = False
+        self.pref_insts = None
+        self.obinfo = []
+        self.targets = []
+        self.batch_status = []
+        self.nworkers = 4
+        self.summary = False
+        self.refresh = False
+        self.chunk_size = 500
+        self.execution_duration, self.timeout = 300., 600.
+        self.sync_maxrec, self.sync_timeout = 10000, 30.
+        self.page_size = 50000
+        self.radius, self.max_shapes = 20., 50
+        self.resolvers, self.sesame_chunk = 'SNV', 50
+        self.proper_motion, self.first_epoch = True, 1985.
+        self.offline = False
+        self.timings, self.perf_summary = {}, False
+        self.namecache = NameCache()
+        self.resultcache = ResultCache()
+        self.mirror = Mirror()
+        self.monitorstate = MonitorState()
+
+    def _set_status(self, text):
+        if self.on_status is not None:
+            self.on_status(text)
+
+    def _set_log(self, text):
+        if self.on_log is not None:
+            self.on_log(text)
+
+    def _finished(self):
+        if self.perf_summary and len(self.timings) > 0:
+            self._set_log(summary(self.timings))
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def _echo(self, message):
+        self._set_log(message)
+        self._set_status(message)
+
+    def _span(self, phase, **info):
+        """
+        Time a phase, see perf.PerfLog.span
+        """
+        return perflog.span(phase, self.timings, **info)
+
+    def _emit_groups(self, groups):
+        """
+        Send the groups to on_groups, by chunks of chunk_size
+        """
+        if self.on_groups is None:
+            return
+        for i in range(0, len(groups), self.chunk_size):
+            self.on_groups(groups[i:i+self.chunk_size])
+
+    def configure(self, conf):
+        """
+        Apply the settings read by config.read_config
+        """
+        self.user, self.password = conf['user'], conf['password']
+        self.nworkers = conf['nworkers']
+        self.resultcache.ttl = conf['cache_ttl'] * 3600.
+        self.resultcache.max_size = conf['cache_size'] * 1e6
+        self.execution_duration = conf['execution_duration']
+        self.timeout = conf['timeout']
+        self.sync_maxrec = conf['sync_maxrec']
+        self.sync_timeout = conf['sync_timeout']
+        self.page_size = conf['page_size']
+        self.perf_summary = conf['perf_summary']
+        perflog.enabled = conf['perf_log']
+        self.radius = conf['radius']
+        self.max_shapes = conf['max_shapes']
+        self.resolvers = conf['resolvers']
+        self.proper_motion = conf['proper_motion']
+        self.first_epoch = conf['first_epoch']
+
+    def _get_tap(self):
+        """
+        Get the TAP service, with or without the token.
+
+        A second service, whose requests time out after sync_timeout,
+        is used for the synchronous queries.
+        """
+        manager.set_credentials(self.user, self.password)
+        manager.set_pool_size(self.nworkers)
+        with self._span('token'):
+            token = manager.token()
+        if token is None:
+            self._echo('Not logged in the ESO Archive. Will continue anonymously.')
+        else:
+            self._echo('Logged in the ESO archive ...')
+        self._synctap = pyvo.dal.TAPService(eso_url, session=manager.session(self.sync_timeout))
+        return pyvo.dal.TAPService(eso_url, session=manager.session())
+
+    def _resolve_name(self, starname):
+        """
+        Position and proper motion of a star (see
+        resolver.Position), or None if it was not found
+        """
+        position = self._resolve_names([starname])[starname]
+        if position is None:
+            self._echo('Name {} not resolved in CDS ... Stopping.'.format(starname))
+        else:
+            self._echo('{} resolved in {}'.format(starname, position.resolver))
+        return position
+
+    def _resolve_names(self, names):
+        """
+        Positions of star names (see resolver.Position), None for the
+        ones that were not found. The names that were not resolved
+        recently are sent to Sesame by chunks of sesame_chunk names,
+        the resolvers being tried in the order of self.resolvers.
+        """
+        positions, todo = {}, []
+        for name in names:
+            cached = self.namecache.get(name, False)
+            if isinstance(cached, list): # [ra, dec] from older versions, without proper motion
+                cached = False
+            if cached is False:
+                todo.append(name)
+            else:
+                positions[name] = None if cached is None else Position(**cached)
+        if len(todo) > 0:
+            self._echo('Getting the coordinates from CDS for: {}'.format(todo[0] if len(todo) == 1 else '{} names'.format(len(todo))))
+        session = manager.session()
+        for i in range(0, len(todo), self.sesame_chunk):
+            chunk = todo[i:i+self.sesame_chunk]
+            with self._span('cds', names = len(chunk)):
+                found = resolve_names(session, [cds_url] + cds_mirrors, chunk, self.resolvers)
+            for name in chunk:
+                position = found[name]
+                positions[name] = position
+                self.namecache.set(name, None if position is None else position._asdict())
+                if position is not None and position.name:
+                    self.namecache.set(position.name, position._asdict())
+        return positions
+
+    def _names(self, texts):
+        """
+        Star names in regions (see _parse_region), each one once
+        """
+        names = {}
+        for text in texts:
+            for part in text.split(';'):
+                part = re.sub(r'\s+r\s*=\s*\S+$', '', part.strip())
+                if part == '' or part.lower().startswith('polygon') or parse_coordinates(part) is not None:
+                    continue
+                names[part] = True
+        return list(names)
+
+    def _prefetch_names(self, targets):
+        """
+        Resolve the names of a target list in a few requests, before
+        the targets are read one by one (which then use the cache)
+        """
+        try:
+            self._resolve_names(self._names(targets))
+        except IOError as e:
+            self._set_log('Could not resolve the names in one go: {}'.format(e))
+
+    def _set_keywords(self):
+        """
+        Define the keywords
+        """
+        if self.raw:
+            self._keywords = ['object', 'ra', 'dec', 'prog_id', 'pi_coi', 'date_obs',
+                              'instrument', 'dp_tech', 'dp_type', 'filter_path', 
+                              'ins_mode', 'ob_id', 'ob_name', 'release_date', 'tpl_id', 'dp_id', 
+                              'datalink_url', 'access_url']
+        else:
+            self._keywords = ['target_name', 's_ra', 's_dec', 'proposal_id', 'obstech',
+                              'instrument_name', 'obs_creator_name', 'access_url', 
+                              'filter', 'dp_id', 'dataproduct_type', 'obs_id', 'obs_release_date']
+
+    def _prepare(self):
+        """
+        Things to do before any query
+        """
+        self.timings = {}
+        self._set_keywords()
+        if self.offline and self.summary:
+            self._set_log('The summary mode is not used for the offline queries.')
+            self.summary = False
+
+    def start_query(self):
+        """
+        Query a star
+        """
+        self._prepare()
+        self.obinfo = []
+        """
+        Get the coordinates from the CDS, or read them
+        """
+        try:
+            shapes = self._parse_region(self.starname)
+        except (ValueError, IOError) as e:
+            self._echo('Could not read {}: {}'.format(self.starname, e))
+            shapes = None
+        if shapes is None:
+            self._finished()
+            return
+        """
+        Try to authentify on the eso archive
+        """
+        tap = self._get_tap()
+        """
+        Do the query
+        """
+        self._echo('Querying the ESO archive for: {}'.format(self.starname))
+        result = self._query_region(tap, shapes, emit = True)
+        """
+        Parse the results
+        """
+        if result is None:
+            self._echo('No results for: {}'.format(self.starname))
+        else:
+            self.obinfo, nfiles = result
+            self._set_status('Found {} entries for: {} ({} individual files)'.format(len(self.obinfo), self.starname, nfiles))
+        self._finished()
+
+    def start_batch(self):
+        """
+        Query all the stars in self.targets.
+
+        The names are resolved concurrently, then the TAP queries are run
+        with at most self.nworkers jobs at the same time. The groups of each
+        target are sent to on_groups as soon as the target is done, and a
+        failure for one target does not stop the others.
+        """
+        self._prepare()
+        self.obinfo = []
+        self.batch_status = []
+        nt = len(self.targets)
+        self._echo('Starting a batch query for {} targets'.format(nt))
+        tap = self._get_tap()
+        self._prefetch_names(self.targets)
+        with ThreadPoolExecutor(max_workers = self.nworkers) as pool:
+            regions = list(pool.map(self._region_safe, self.targets))
+            jobs = {}
+            for target, shapes in zip(self.targets, regions):
+                if shapes is None:
+                    self._batch_done(target, 'not resolved')
+                else:
+                    jobs[pool.submit(self._query_region, tap, shapes)] = target
+            for job in as_completed(jobs):
+                target = jobs[job]
+                try:
+                    result = job.result()
+                except Exception as e:
+                    self._batch_done(target, 'error: {}'.format(e))
+                    continue
+                if result is None or result[1] == 0:
+                    self._batch_done(target, 'no results')
+                    continue
+                groups, nfiles = result
+                for group in groups:
+                    group['target'] = target
+                self.obinfo += groups
+                self._batch_done(target, 'ok', len(groups), nfiles)
+                self._emit_groups(groups)
+        nok = len([status for status in self.batch_status if status['status'] == 'ok'])
+        self._set_status('Found {} entries for {} out of {} targets'.format(len(self.obinfo), nok, nt))
+        self._finished()
+
+    def start_monitor(self):
+        """
+        Query all the stars in self.targets, like start_batch, but
+        only report the files that were not found by the previous
+        runs (see _monitor_target).
+        """
+        self._prepare()
+        if self.summary:
+            self._set_log('The summary mode is not used for monitoring.')
+            self.summary = False
+        self.obinfo = []
+        self.batch_status = []
+        nt = len(self.targets)
+        self._echo('Looking for new files for {} targets'.format(nt))
+        tap = self._get_tap()
+        self._prefetch_names(self.targets)
+        with ThreadPoolExecutor(max_workers = self.nworkers) as pool:
+            regions = list(pool.map(self._region_safe, self.targets))
+            jobs = {}
+            for target, shapes in zip(self.targets, regions):
+                if shapes is None:
+                    self._batch_done(target, 'not resolved')
+                else:
+                    jobs[pool.submit(self._monitor_target, tap, target, shapes)] = target
+            for job in as_completed(jobs):
+                target = jobs[job]
+                try:
+                    result = job.result()
+                except Exception as e:
+                    self._batch_done(target, 'error: {}'.format(e))
+                    continue
+                if result is None:
+                    self._batch_done(target, 'query failed')
+                    continue
+                groups, nfiles = result
+                if len(groups) == 0:
+                    self._batch_done(target, 'nothing new')
+                    continue
+                for group in groups:
+                    group['target'] = target
+                self.obinfo += groups
+                self._batch_done(target, 'new', len(groups), nfiles)
+                self._emit_groups(groups)
+        nnew = len([status for status in self.batch_status if status['status'] == 'new'])
+        self._set_status('Found {} new entries for {} out of {} targets'.format(len(self.obinfo), nnew, nt))
+        self._finished()
+
+    def _monitor_target(self, tap, target, shapes):
+        """
+        New files of one target, grouped, and how many there are, or
+        None if the query failed.
+
+        Only the files released or observed (ingested, for phase 3)
+        since the latest ones of the previous run are queried, and the
+        ones that were already seen are ignored. The first run of a
+        target reports all its files.
+        """
+        key = self._monitor_key(target)
+        release, latest = self.monitorstate.marks(key)
+        columns = ('release_date', 'date_obs') if self.raw else ('obs_release_date', 'dp_id')
+        since = ['{} >= {}'.format(col, self._quote(mark)) for col, mark in zip(columns, (release, latest))
+                 if mark is not None]
+        insquery = self._fetch_region(tap, shapes, '(' + ' or '.join(since) + ')' if len(since) > 0 else None)
+        if insquery is None:
+            return None
+        if len(insquery) == 0:
+            return [], 0
+        dpid = np.array(insquery['dp_id'], dtype = str)
+        new = np.array(self.monitorstate.unseen(key, dpid), dtype = bool)
+        near = self._track_mask(insquery, shapes)
+        if near is not None:
+            new &= near
+        if insquery.meta.get('truncated'):
+            # the files left out by the archive may be newer than the marks:
+            # keep the state as it was, the next run asks for all of them again
+            self._set_log('Incomplete results for {}, the monitoring state is not updated.'.format(target))
+            return (self._prep(insquery[new]), int(new.sum())) if new.any() else ([], 0)
+        release = self._high_mark(insquery[columns[0]], release)
+        latest = self._high_mark(insquery[columns[1]], latest)
+        if not new.any():
+            self.monitorstate.update(key, release, latest, [])
+            return [], 0
+        groups = self._prep(insquery[new])
+        self.monitorstate.update(key, release, latest, dpid[new])
+        return groups, int(new.sum())
+
+    def _monitor_key(self, target):
+        if self.raw:
+            return 'raw|{}|{}'.format(self._inst_where(), NameCache.normalise(target))
+        return 'p3|{}'.format(NameCache.normalise(target))
+
+    def _high_mark(self, column, previous):
+        """
+        Largest value of a column of dates (or dp_id), as
+        returned by the archive, and previous mark
+        """
+        values = self._values(column)
+        values = [str(v) for v in values[(values != '--') & (values != '')]]
+        if previous is not None:
+            values.append(previous)
+        return max(values) if len(values) > 0 else None
+
+    def _fetch_region(self, tap, shapes, where = None):
+        """
+        All the files inside the shapes that match the where
+        condition, without the cache nor grouping. The results
+        are fetched again by pages if the archive truncated them
+        (see _fetch_pages). Returns None if the query failed.
+        """
+        if self.offline:
+            if self.raw:
+                where = self._inst_where() if where is None else '{} and {}'.format(self._inst_where(), where)
+            with self._span('mirror'):
+                return self.mirror.search('raw' if self.raw else 'obscore', shapes, where)
+        tables = []
+        for i in range(0, len(shapes), self.max_shapes):
+            query = self._build_query(shapes[i:i+self.max_shapes])
+            if where is not None:
+                query += ' and {}'.format(where)
+            table = self._fetch(tap, query)
+            if table is None:
+                return None
+            if table.meta.get('truncated') and self.page_size > 0:
+                self._set_log('The archive returned only the first {} rows, fetching them by pages.'.format(len(table)))
+                table = self._fetch_pages(tap, shapes[i:i+self.max_shapes], where)
+                if table is None:
+                    return None
+            if table.meta.get('truncated'):
+                self._echo('The archive returned only the first {} rows, the results are incomplete.'.format(len(table)))
+            tables.append(table)
+        if len(tables) == 1:
+            return tables[0]
+        table = aptable.vstack(tables)
+        dpid = np.array(table['dp_id'], dtype = str)
+        return table[np.sort(np.unique(dpid, return_index = True)[1])]
+
+    def _fetch_pages(self, tap, shapes, where = None):
+        """
+        Same as one query of _fetch_region, by pages of page_size rows
+        sorted by dp_id (see _pages), without the cache. A page that is
+        truncated by the archive is followed by the next one, so the
+        table is complete. Returns None if a query failed.
+        """
+        pages, last = [], None
+        while True:
+            page = self._fetch(tap, self._build_page_query(shapes, last, where), self.page_size < self.sync_maxrec)
+            if page is None:
+                return None
+            truncated = page.meta.pop('truncated', False)
+            pages.append(page)
+            if len(page) == 0 or (len(page) < self.page_size and not truncated):
+                break
+            last = str(page['dp_id'][-1])
+        return aptable.vstack(pages) if len(pages) > 1 else pages[0]
+
+    def _region_safe(self, target):
+        """
+        Read or resolve a target, without raising for the batch mode
+        """
+        try:
+            return self._parse_region(target)
+        except Exception as e:
+            self._set_log('Could not resolve {}: {}'.format(target, e))
+            return None
+
+    def _parse_region(self, text):
+        """
+        Shapes to query, from star names or coordinates (see
+        parse_coordinates), with an optional "r=<arcsec>" after each
+        of them to change the radius, or from "polygon ra1 dec1 ra2
+        dec2 ..." in degrees, separated by ";". Returns None if a name
+        could not be resolved.
+
+        The stars with a proper motion are searched along their path
+        since first_epoch (see track_shapes), and the raw files are
+        then only kept if they are within the radius of the position
+        of the star at their date (see _on_tracks).
+        """
+        shapes = []
+        for part in text.split(';'):
+            part = part.strip()
+            if part == '':
+                continue
+            if part.lower().startswith('polygon'):
+                values = [float(v) for v in re.split(r'[\s,]+', part[7:].strip())]
+                if len(values) < 6 or len(values) % 2 != 0:
+                    raise ValueError('a polygon needs at least three pairs of coordinates')
+                shapes.append(('polygon', tuple(values)))
+                continue
+            radius = self.radius
+            match = re.search(r'\s+r\s*=\s*(\S+)$', part)
+            if match is not None:
+                radius = float(match.group(1))
+                part = part[:match.start()]
+            coords = parse_coordinates(part)
+            if coords is None:
+                position = self._resolve_name(part)
+                if position is None:
+                    return None
+                if self.proper_motion:
+                    epochs = (self.first_epoch, time.gmtime().tm_year + 1.)
+                    shapes += track_shapes(position.ra, position.dec, position.pmra, position.pmdec, radius, epochs)
+                    continue
+                coords = (position.ra, position.dec)
+            shapes.append(('circle', coords[0], coords[1], radius))
+        if len(shapes) == 0:
+            return None
+        return minimal_shapes(shapes)
+
+    def _batch_done(self, target, status, ngroups = 0, nfiles = 0):
+        """
+        Keep track of the status of each target of the batch
+        """
+        self.batch_status.append({'target': target, 'status': status, 'ngroups': ngroups, 'nfiles': nfiles})
+        self._echo('[{}/{}] {}: {} ({} entries)'.format(len(self.batch_status), len(self.targets), target, status, ngroups))
+
+    def _track_mask(self, insquery, shapes):
+        """
+        Which raw files are within the radius of a moving star at
+        the date they were observed, or inside one of the shapes
+        without track. None if there is nothing to check (no track,
+        phase 3 footprints, summary rows).
+        """
+        tracks = list(dict.fromkeys([shape_track(s) for s in shapes if shape_track(s) is not None]))
+        if len(tracks) == 0 or not self.raw or self.summary:
+            return None
+        ra = np.asarray(self._values(insquery['ra']), dtype = float)
+        dec = np.asarray(self._values(insquery['dec']), dtype = float)
+        epochs = epochs_from_dates(self._values(insquery['date_obs']))
+        keep = np.zeros(len(insquery), dtype = bool)
+        for track in tracks:
+            keep |= on_track(ra, dec, epochs, track)
+        for shape in shapes:
+            if shape_track(shape) is not None:
+                continue
+            if shape[0] == 'circle':
+                keep |= separations(shape[1], shape[2], ra, dec) <= shape[3]
+            else:
+                keep |= inside_polygon(ra, dec, shape[1])
+        return keep
+
+    def _on_tracks(self, insquery, shapes):
+        """
+        Drop the files that are inside the path of a moving star
+        but far from it at their date (see _track_mask)
+        """
+        if insquery is None or len(insquery) == 0:
+            return insquery
+        keep = self._track_mask(insquery, shapes)
+        if keep is None or keep.all():
+            return insquery
+        self._set_log('{} of {} files were away from the moving targets at their date.'.format(
+            int((~keep).sum()), len(insquery)))
+        return insquery[keep]
+
+    def _query_region(self, tap, shapes, emit = False):
+        """
+        Query the files inside the shapes and group them. Returns
+        the groups and the number of files, or None if the query
+        failed. The groups are sent to on_groups if emit is True.
+        """
+        if self.offline:
+            return self._query_mirror(shapes, emit)
+        if len(shapes) > self.max_shapes and not self.summary:
+            return self._query_chunks(tap, shapes, emit)
+        if self.page_size > 0 and not self.summary:
+            return self._query_paged(tap, shapes, emit)
+        insquery = self._run_query(tap, self._build_query(shapes))
+        if insquery is None:
+            return None
+        if insquery.meta.get('truncated'):
+            self._echo('The archive returned only the first {} rows, the results are incomplete. '
+                       'Set page_size in the [TAP] section to get all of them.'.format(len(insquery)))
+        insquery = self._on_tracks(insquery, shapes)
+        groups = self._prep(insquery)
+        if emit:
+            self._emit_groups(groups)
+        return groups, sum([group['nfiles'] for group in groups])
+
+    def _query_paged(self, tap, shapes, emit = False):
+        """
+        Get the results by pages (see _pages), and group each page
+        as soon as it arrives, so that only one page is in memory
+        at a time.
+
+        The raw dp_id start with the instrument and the date, so all
+        the groups of a page are complete except the one of the last
+        file, whose rows are grouped again with the next page. For the
+        phase 3 data, the unique values of each group are merged page
+        after page.
+        """
+        groups, partial, carry = [], {}, None
+        npages, nfiles = 0, 0
+        for page, more in self._pages(tap, shapes):
+            if page is None:
+                if npages == 0:
+                    return None
+                self._echo('Could not get page {}, the results are incomplete.'.format(npages + 1))
+                break
+            npages += 1
+            nfiles += len(page)
+            if more:
+                self._echo('Got {} files so far, getting the next page.'.format(nfiles))
+            if self.raw:
+                if carry is not None:
+                    page = aptable.vstack([carry, page])
+                with self._span('prep', rows = len(page)):
+                    done, carry = self._prep_raw_page(page, more)
+                groups += done
+                if emit:
+                    self._emit_groups(done)
+            elif len(page) > 0:
+                with self._span('prep', rows = len(page)):
+                    for key, values in self._prep_p3(page, partial = True).items():
+                        partial[key] = self._merge_values(partial[key], values) if key in partial else values
+            del page
+        if carry is not None:
+            with self._span('prep', rows = len(carry)):
+                done, carry = self._prep_raw_page(carry, False)
+            groups += done
+            if emit:
+                self._emit_groups(done)
+        if not self.raw:
+            with self._span('prep', groups = len(partial)):
+                groups = [self._format_values(partial[key]) for key in sorted(partial)]
+            if emit:
+                self._emit_groups(groups)
+        if npages > 1:
+            self._set_log('{} files in {} pages.'.format(nfiles, npages))
+        return groups, nfiles
+
+    def _pages(self, tap, shapes):
+        """
+        Results by pages of page_size rows, sorted by dp_id, each
+        page starting after the last dp_id of the previous one.
+        Yields each page and whether there are more pages, or
+        (None, False) if a query failed.
+
+        If pages are larger than what a synchronous query may return,
+        only the first page is tried synchronously (small regions fit
+        in one page), the next ones are sent as jobs right away since
+        the previous page was full.
+        """
+        last, npages = None, 0
+        while True:
+            sync = last is None or self.page_size < self.sync_maxrec
+            page = self._run_query(tap, self._build_page_query(shapes, last), sync)
+            if page is None:
+                yield None, False
+                return
+            npages += 1
+            if page.meta.get('truncated'):
+                self._set_log('Page {} was truncated by the archive at {} rows.'.format(npages, len(page)))
+            more = len(page) > 0 and (len(page) >= self.page_size or page.meta.get('truncated', False))
+            if more:
+                last = str(page['dp_id'][-1])
+            yield self._on_tracks(page, shapes), more
+            if not more:
+                return
+
+    def _query_chunks(self, tap, shapes, emit = False):
+        """
+        Query many shapes, max_shapes at a time. A file found by
+        several queries (overlapping cones) is only kept once, before
+        grouping all the files together.
+        """
+        tables, seen, failed = [], set(), 0
+        for i in range(0, len(shapes), self.max_shapes):
+            chunk = shapes[i:i+self.max_shapes]
+            self._echo('Querying shapes {} to {} out of {}'.format(i + 1, i + len(chunk), len(shapes)))
+            if self.page_size > 0:
+                pages = self._pages(tap, chunk)
+            else:
+                pages = [(self._on_tracks(self._run_query(tap, self._build_query(chunk)), chunk), False)]
+            for page, more in pages:
+                if page is None:
+                    failed += 1
+                    continue
+                dpid = np.array(page['dp_id'], dtype = str)
+                new = np.array([d not in seen for d in dpid], dtype = bool)
+                seen.update(dpid)
+                if new.any():
+                    tables.append(page[new])
+        if failed > 0:
+            if len(tables) == 0:
+                return None
+            self._echo('{} queries failed, the results are incomplete.'.format(failed))
+        if len(tables) == 0:
+            return [], 0
+        insquery = aptable.vstack(tables) if len(tables) > 1 else tables[0]
+        self._set_log('{} different files in {} shapes.'.format(len(insquery), len(shapes)))
+        groups = self._prep(insquery)
+        if emit:
+            self._emit_groups(groups)
+        return groups, len(insquery)
+
+    def _query_mirror(self, shapes, emit = False):
+        """
+        Same as the TAP queries, but in the local mirror
+        (see sync_mirror), without going through the network
+        """
+        with self._span('mirror') as span:
+            if self.raw:
+                insquery = self.mirror.search('raw', shapes, self._inst_where())
+            else:
+                insquery = self.mirror.search('obscore', shapes)
+            span['rows'] = 0 if insquery is None else len(insquery)
+        if insquery is None:
+            self._echo('The local mirror is empty, synchronise it first.')
+            return None
+        insquery = self._on_tracks(insquery, shapes)
+        self._set_log('{} files found in the local mirror.'.format(len(insquery)))
+        groups = self._prep(insquery)
+        if emit:
+            self._emit_groups(groups)
+        return groups, len(insquery)
+
+    def sync_mirror(self, instruments = None):
+        """
+        Copy the metadata of the files of some instruments (by default
+        pref_insts) to the local mirror, dbo.raw or ivoa.obscore
+        depending on self.raw.
+
+        Only the rows changed since the last sync are queried, by pages
+        sorted by last_mod_date and dp_id for the raw data, and by dp_id
+        for the phase 3 data (they start with their ingestion date), so
+        that an interrupted sync starts again where it stopped.
+        """
+        self.timings = {}
+        self._set_keywords()
+        tap = self._get_tap()
+        for inst in (instruments or self.pref_insts):
+            try:
+                self._sync_instrument(tap, inst)
+            except Exception as e:
+                self._echo('Could not synchronise {}: {}'.format(inst, e))
+        self._finished()
+
+    def _sync_instrument(self, tap, inst):
+        kind = 'raw' if self.raw else 'obscore'
+        last_key, last_id = self.mirror.sync_state(kind, inst)
+        size = self.page_size if self.page_size > 0 else 50000
+        nrows = 0
+        while True:
+            query = self._build_sync_query(inst, size, last_key, last_id)
+            table = self._fetch(tap, query)
+            if table is None:
+                self._echo('Synchronisation of {} stopped after {} files, try again later.'.format(inst, nrows))
+                return
+            if len(table) > 0:
+                self.mirror.insert(kind, table)
+                last_id = str(table['dp_id'][-1])
+                if self.raw:
+                    last_key = str(table['last_mod_date'][-1])
+                self.mirror.set_sync_state(kind, inst, last_key, last_id, len(table))
+            nrows += len(table)
+            self._echo('{}: {} new or updated files'.format(inst, nrows))
+            if len(table) == 0 or (len(table) < size and not table.meta.get('truncated')):
+                return
+
+    def _build_sync_query(self, inst, size, last_key, last_id):
+        """
+        Query for the rows of an instrument that changed after
+        the last ones already in the mirror
+        """
+        if self.raw:
+            query = "SELECT TOP {} {}, last_mod_date from dbo.raw where instrument {} and dp_cat='SCIENCE'".format(
+                size, ', '.join(self._keywords), self._inst_format(inst))
+            if last_key is not None:
+                query += " and (last_mod_date > {0} or (last_mod_date = {0} and dp_id > {1}))".format(
+                    self._quote(last_key), self._quote(last_id))
+            query += " ORDER BY last_mod_date, dp_id"
+        else:
+            query = "SELECT TOP {} {}, s_fov from ivoa.obscore where instrument_name {}".format(
+                size, ', '.join(self._keywords), self._inst_format(inst))
+            if last_id is not None:
+                query += " and dp_id > {}".format(self._quote(last_id))
+            query += " ORDER BY dp_id"
+        self._set_log(query)
+        return query
+
+    def _build_query(self, shapes):
+        """
+        Prepare the query, one row per file or one row per
+        group of files in summary mode
+        """
+        if self.summary:
+            return self._build_summary_query(shapes)
+        query = "SELECT {} ".format(', '.join(self._keywords))
+        query += self._from_where(shapes)
+        self._set_log(query)
+        return query
+
+    def _build_page_query(self, shapes, after = None, where = None):
+        """
+        Query for one page of results, sorted by dp_id and
+        starting after the dp_id of the previous page
+        """
+        query = "SELECT TOP {} {} ".format(self.page_size, ', '.join(self._keywords))
+        query += self._from_where(shapes)
+        if where is not None:
+            query += " and {}".format(where)
+        if after is not None:
+            query += " and dp_id > {}".format(self._quote(after))
+        query += " ORDER BY dp_id"
+        self._set_log(query)
+        return query
+
+    def _from_where(self, shapes):
+        """
+        The from and where parts of the query, for the
+        files inside any of the shapes
+        """
+        if self.raw:
+            query = "from dbo.raw where "
+            query += self._inst_where() + " and "
+            query += "dp_cat='SCIENCE' and "
+            query += self._any_shape(["contains(point('', ra, dec), {})=1".format(adql_shape(s)) for s in shapes])
+            query += "AND dec BETWEEN -90 and 90"
+        else:
+            query = "from ivoa.obscore where "
+            query += self._any_shape(["intersects({},s_region)=1".format(adql_shape(s)) for s in shapes])
+        return query
+
+    def _inst_where(self):
+        """
+        Condition on the instruments of the raw data
+        """
+        if self.instrument != 'All above':
+            return "instrument {}".format(self._inst_format(self.instrument))
+        query = "("
+        for i in range(len(self.pref_insts)):
+            query += "instrument {}".format(self._inst_format(self.pref_insts[i]))
+            if i != len(self.pref_insts)-1:
+                query += " or "
+        return query + ")"
+
+    def _any_shape(self, conditions):
+        if len(conditions) == 1:
+            return conditions[0] + ' '
+        return '(' + ' or '.join(conditions) + ') '
+
+    def _build_summary_query(self, shapes):
+        """
+        Let the TAP service do the grouping and counting.
+
+        For the phase 3 data the groups are the same as the ones done
+        on our side (instrument and proposal id). For the raw data, there
+        is one row per execution of an OB, which are then merged on our
+        side with the same 4 hours rule as for the individual files.
+        """
+        if self.raw:
+            query = "SELECT instrument, prog_id, ob_id, COUNT(*) AS nfiles, MIN(date_obs) AS date_obs, "
+            query += "MAX(date_obs) AS date_end, MAX(release_date) AS release_date, MIN(object) AS object, "
+            query += "MIN(dp_tech) AS dp_tech, MIN(pi_coi) AS pi_coi, AVG(ra) AS ra, AVG(dec) AS dec "
+            query += self._from_where(shapes)
+            query += " GROUP BY instrument, prog_id, ob_id"
+        else:
+            query = "SELECT instrument_name, proposal_id, COUNT(*) AS nfiles, MIN(target_name) AS target_name, "
+            query += "MIN(obstech) AS obstech, MIN(obs_creator_name) AS obs_creator_name, AVG(s_ra) AS s_ra, "
+            query += "AVG(s_dec) AS s_dec, MIN(obs_release_date) AS obs_release_date "
+            query += self._from_where(shapes)
+            query += " GROUP BY instrument_name, proposal_id"
+        self._set_log(query)
+        return query
+
+    def fetch_details(self, group):
+        """
+        In summary mode, get the individual files of one group
+        (with access_url, datalink_url, ...) and return the
+        group as it would be without the summary mode, or None
+        if they could not be fetched.
+        """
+        if not group.get('summary'):
+            return group
+        self._echo('Getting the list of files for the selected entry.')
+        self._set_keywords()
+        query = "SELECT {} {} and {}".format(', '.join(self._keywords), group['from_where'], group['selection'])
+        self._set_log(query)
+        insquery = self._run_query(self._get_tap(), query)
+        if insquery is None or len(insquery) == 0:
+            self._echo('Could not get the list of files.')
+            return None
+        details = self.parse(self._prep_columns(insquery))
+        if 'target' in group:
+            details['target'] = group['target']
+        return details
+
+    def _quote(self, value):
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    def _run_query(self, tap, query, sync = True):
+        """
+        Do the query, returns None if it failed (see _fetch for sync)
+        """
+        if not self.refresh:
+            insquery = self.resultcache.get(query, self.user)
+            if insquery is not None:
+                self._set_log('Results taken from the local cache.')
+                return insquery
+        insquery = self._fetch(tap, query, sync)
+        if insquery is not None:
+            insquery.meta['query'] = query
+            if insquery.meta.get('truncated'):
+                return insquery
+            try:
+                self.resultcache.set(query, self.user, insquery)
+            except Exception as e:
+                self._set_log('Could not save the results in the cache: {}'.format(e))
+        return insquery
+
+    def _fetch(self, tap, query, sync = True):
+        """
+        Send the query to the archive, synchronously if possible.
+        With sync False, it goes straight to a job, for the queries
+        that are expected to return more than sync_maxrec rows.
+        """
+        insquery = None
+        if sync and self.sync_maxrec > 0:
+            insquery = self._run_sync(query)
+        if insquery is None:
+            insquery = self._run_async(tap, query)
+        return insquery
+
+    def _run_sync(self, query):
+        """
+        Synchronous query, in one request. Returns None if the
+        results were truncated at sync_maxrec rows, or if the query
+        failed or took too long, so that it is sent again as a job.
+        """
+        try:
+            with self._span('tap_sync') as span:
+                result = self._synctap.run_sync(query, maxrec = self.sync_maxrec)
+                span['rows'] = len(result)
+        except Exception as e:
+            self._set_log('Synchronous query failed ({}), submitting a job instead.'.format(e))
+            return None
+        if result.query_status == 'OVERFLOW' or len(result) >= self.sync_maxrec:
+            self._set_log('More than {} rows, submitting a job instead.'.format(self.sync_maxrec))
+            return None
+        return result.to_table()
+
+    def _run_async(self, tap, query):
+        """
+        Query as an asynchronous job, for the large or slow queries
+        """
+        insquery = None
+        with self._span('tap_queue') as span:
+            job = tap.submit_job(query)
+            job.execution_duration = self.execution_duration # max allowed: 3600s
+            job.run()
+            try:
+                job.wait(phases=["COMPLETED", "ERROR", "ABORTED"], timeout=self.timeout)
+            except pyvo.DALServiceError:
+                self._set_log('Exception on JOB {id}: {status}'.format(id=job.job_id, status=job.phase))
+            span['phase'] = job.phase
+        if job.phase == 'COMPLETED':
+            with self._span('tap_transfer') as span:
+                result = job.fetch_result()
+                insquery = result.to_table()
+                span['rows'] = len(insquery)
+            if result.query_status == 'OVERFLOW':
+                insquery.meta['truncated'] = True
+        job.delete()
+        return insquery
+
+    def _prep(self, insquery):
+        """
+        Group the results, depending on the type of query
+        """
+        with self._span('prep', rows = len(insquery)) as span:
+            if self.raw:
+                groups = self._prep_raw(insquery)
+            else:
+                groups = self._prep_p3(insquery)
+            span['groups'] = len(groups)
+        return groups
+
+    def _prep_columns(self, insquery):
+        """
+        Reformat the dates
+        """
+        if self.raw:
+            insquery['obsnight'] = self._day(insquery['date_obs'])
+            insquery['release_date'] = self._day(insquery['release_date'])
+        else:
+            insquery['obs_release_date'] = self._day(insquery['obs_release_date'])
+        return insquery
+
+    def _inst_format(self, inst):
+        """
+        Reformat a few things to account for different 
+        instruments names
+        """
+        if inst == 'APEX':
+            return "in ('APEXBOL', 'APEXHET')"
+        elif inst == 'CRIRES':
+            return "like 'CRIRE%'"
+        elif inst == 'EFOSC2':
+            return "like 'EFOSC%'"
+        elif inst == 'FORS1/2':
+            return "in ('FORS1', 'FORS2')"
+        elif inst == 'GIRAFFE':
+            return "like 'GIRAF%'"
+        elif inst == 'NACO':
+            return "like 'NAOS+CONICA%'"
+        elif inst == 'SINFONI':
+            return "like 'SINFO%'"
+        elif inst == 'SPECULOOS':
+            return "like 'SPECU%'"
+        elif inst == 'TIMMI2':
+            return "like 'TIMMI%'"
+        elif inst == 'XSHOOTER':
+            return "in ('SHOOT', 'XSHOOTER')"
+        else:
+            return "like '{}%'".format(inst)
+
+    def _prep_p3(self, insquery, partial = False):
+        """
+        Massage a bit the phase 3 query output
+
+        Group by instrument and then by proposal id. If partial is
+        True, returns the unique values of each group instead, with
+        (instrument, proposal id) as keys, for the paged queries.
+        """
+        if len(insquery) == 0:
+            return []
+        insquery = self._prep_columns(insquery)
+        inst = np.array(insquery['instrument_name'], dtype = str)
+        propid = np.array(insquery['proposal_id'], dtype = str)
+        order = np.lexsort((propid, inst))
+        insquery = insquery[order]
+        inst, propid = inst[order], propid[order]
+        newgroup = (inst[1:] != inst[:-1]) | (propid[1:] != propid[:-1])
+        gid = self._group_ids(newgroup)
+        if partial:
+            first = np.searchsorted(gid, np.arange(gid[-1] + 1))
+            values = self._unique_values(insquery, gid)
+            return {(inst[i], propid[i]): v for i, v in zip(first, values)}
+        if not self.summary:
+            return self._summarise(insquery, gid)
+        obinfo = self._summarise(insquery, gid, nfiles = insquery['nfiles'])
+        for i, group in enumerate(obinfo):
+            self._set_selection(group, insquery, 'instrument_name = {} and proposal_id = {}'.format(
+                self._quote(inst[i]), self._quote(propid[i])))
+        return obinfo
+
+    def _prep_raw(self, insquery):
+        """
+        Massage a bit the raw query output
+
+        Sort by instrument and then by date, a new group starts
+        for each instrument and whenever there are more than
+        4 hours between two consecutive files.
+        """
+        self._echo('Query finished. Parsing the data.')
+        if len(insquery) == 0:
+            return []
+        insquery, dobs, inst = self._sort_raw(insquery)
+        if not self.summary:
+            newgroup = (inst[1:] != inst[:-1]) | (np.diff(dobs) >= np.timedelta64(4, 'h'))
+            return self._summarise(insquery, self._group_ids(newgroup))
+        """
+        In summary mode each row is one OB, the gaps are between
+        the latest end of the previous OBs of the same instrument
+        and the start of the next one. An OB without end date
+        ends when it starts.
+        """
+        dend = self._values(insquery['date_end'])
+        dend = np.where(np.char.isdigit(np.asarray(dend, dtype = 'U4')), dend, 'NaT').astype('datetime64[us]')
+        dend = np.where(np.isnat(dend), dobs, dend)
+        starts = np.flatnonzero(np.concatenate(([True], inst[1:] != inst[:-1])))
+        for start, end in zip(starts, np.append(starts[1:], len(inst))):
+            dend[start:end] = np.fmax.accumulate(dend[start:end])
+        newgroup = (inst[1:] != inst[:-1]) | ((dobs[1:] - dend[:-1]) >= np.timedelta64(4, 'h'))
+        gid = self._group_ids(newgroup)
+        obinfo = self._summarise(insquery, gid, nfiles = insquery['nfiles'])
+        bounds = np.searchsorted(gid, np.arange(len(obinfo) + 1))
+        for i, group in enumerate(obinfo):
+            first, last = bounds[i], bounds[i+1] - 1
+            self._set_selection(group, insquery, 'instrument = {} and date_obs between {} and {}'.format(
+                self._quote(inst[first]), self._quote(insquery['date_obs'][first]),
+                self._quote(np.datetime_as_string(dend[last], unit = 'ms'))))
+        return obinfo
+
+    def _sort_raw(self, insquery):
+        """
+        Reformat the dates and sort by instrument and date,
+        returns the table, the dates and the instruments
+        """
+        insquery = self._prep_columns(insquery)
+        dobs = np.array(insquery['date_obs'], dtype = str).astype('datetime64[us]')
+        inst = np.array(insquery['instrument'], dtype = str)
+        order = np.lexsort((dobs, inst))
+        return insquery[order], dobs[order], inst[order]
+
+    def _prep_raw_page(self, page, keep_last):
+        """
+        Group one page of raw results. If keep_last is True, the
+        group of the last file (largest dp_id) may continue in the
+        next page: its rows are not grouped but returned, to be
+        added to the next page.
+        """
+        if len(page) == 0:
+            return [], None
+        self._set_log('Parsing {} files.'.format(len(page)))
+        last = str(page['dp_id'][-1])
+        page, dobs, inst = self._sort_raw(page)
+        newgroup = (inst[1:] != inst[:-1]) | (np.diff(dobs) >= np.timedelta64(4, 'h'))
+        gid = self._group_ids(newgroup)
+        if not keep_last:
+            return self._summarise(page, gid), None
+        opened = gid[np.flatnonzero(np.array(page['dp_id'], dtype = str) == last)[0]]
+        done = gid != opened
+        carry = page[~done]
+        carry.remove_column('obsnight')
+        if not done.any():
+            return [], carry
+        gid = gid[done]
+        return self._summarise(page[done], gid - (gid > opened)), carry
+
+    def _set_selection(self, group, insquery, selection):
+        """
+        Remember how to get the individual files of a group
+        """
+        query = insquery.meta['query']
+        group['summary'] = True
+        group['from_where'] = query[query.index('from '):query.index(' GROUP BY')]
+        group['selection'] = selection
+
+    def _group_ids(self, newgroup):
+        """
+        Group id of each row of a sorted table, from a boolean
+        array telling where a new group starts (between row i and i+1)
+        """
+        return np.concatenate(([0], np.cumsum(newgroup)))
+
+    def _day(self, dates):
+        """
+        Convert YYYY-MM-DDThh:mm:ss to YYYY/MM/DD
+        """
+        return np.char.replace(np.array(dates, dtype = 'U10'), '-', '/')
+
+    def parse(self, q):
+        """
+        Parse the entries of a single "group"
+        """
+        if len(q) == 0:
+            return {'nfiles': 0}
+        return self._summarise(q, np.zeros(len(q), dtype = int))[0]
+
+    def _summarise(self, insquery, gid, nfiles = None):
+        """
+        Parse the entries of all the groups at once
+        """
+        return [self._format_values(values) for values in self._unique_values(insquery, gid, nfiles)]
+
+    def _unique_values(self, insquery, gid, nfiles = None):
+        """
+        Number of files and sorted unique values of each column,
+        for all the groups at once.
+
+        gid is the group id of each row, starting at 0 and sorted.
+        For each column, the table is sorted once by group and value,
+        so that the unique values of all the groups are contiguous.
+        nfiles is the number of files per row, if the rows are already
+        groups of files (summary mode).
+        """
+        ngroups = gid[-1] + 1
+        counts = np.bincount(gid, weights = nfiles, minlength = ngroups)
+        obinfo = [{'nfiles': int(n)} for n in counts]
+        kw = self._keywords.copy()
+        kw.append('obsnight')
+        for key in kw:
+            if key not in insquery.colnames:
+                continue
+            values = self._values(insquery[key])
+            order = np.lexsort((values, gid))
+            g, v = gid[order], values[order]
+            keep = np.ones(len(v), dtype = bool)
+            keep[1:] = (g[1:] != g[:-1]) | (v[1:] != v[:-1])
+            g, v = g[keep], v[keep]
+            bounds = np.searchsorted(g, np.arange(ngroups + 1))
+            for i in range(ngroups):
+                obinfo[i][key] = v[bounds[i]:bounds[i+1]]
+        return obinfo
+
+    def _merge_values(self, first, second):
+        """
+        Merge the unique values of two parts of the same group
+        """
+        merged = {'nfiles': first['nfiles'] + second['nfiles']}
+        for key in first:
+            if key != 'nfiles':
+                merged[key] = np.union1d(first[key], second[key])
+        return merged
+
+    def _format_values(self, values):
+        """
+        Group as shown in the table, from its unique values
+        """
+        return {key: value if key == 'nfiles' else self._format(value, key) for key, value in values.items()}
+
+    def _values(self, column):
+        """
+        Column as a plain numpy array, strings are converted
+        to str and masked entries shown as --
+        """
+        data = column.data
+        mask = np.ma.getmaskarray(data)
+        data = np.ma.getdata(data)
+        if data.dtype.kind in 'OSU':
+            data = np.asarray(data, dtype = str)
+            if mask.any():
+                data = np.where(mask, '--', data)
+        elif mask.any():
+            data = np.where(mask, np.nan, data.astype(float))
+        return data
+
+    def _format(self, entry, key):
+        """
+        Try to format things a bit better
+        """
+        if key == 'object':
+            entry = entry[~np.isin(entry, ['', 'OBJECT', 'OBJECT NAME NOT SET'])]
+        if key == 'ra' or key == 'dec' or key == 's_ra' or key == 's_dec':
+            return '{:.4f}'.format(np.mean(entry))
+        if len(entry) == 0:
+            return '--'
+        return '\n'.join([str(e) for e in entry])
+
+
+
+
+class Interrupted(Exception):
+    """
+    Raised during a transfer to stop it when the queue is paused
+    """
+
+
+
+class Downloader(object):
+    """
+    Download the files of the groups of the results, through
+    a persistent queue (see cache.DownloadQueue)
+    """
+    levels = ['high', 'normal', 'low']
+
+    def __init__(self):
+        """
+        Query the ESO raw data archive
+        """
+        self.on_status, self.on_log, self.on_progress, self.on_finished = None, None, None, None
+        self.on_queue = None
+        self.user, self.password, self.dpath = None, None, None
+        self.access_url, self.datalink_url, self.obs_id, self.selector = [], [], [], None
+        self.raw = False
+        self.nworkers = 4
+        self.decompress = False
+        self.datalinkcache = SQLiteCache('datalink.sqlite')
+        self.calibcache = SQLiteCache('calselector.sqlite', ttl = 7 * 86400.)
+        self.calselector_batch, self.calselector_chunk = True, 50
+        self.timings, self.perf_summary = {}, False
+        self.store, self.per_target, self.target = None, False, None
+        self.queue = DownloadQueue()
+        self.bucket = TokenBucket()
+        self.bandwidth, self.night_bandwidth, self.night = 0., 0., None
+        self.host_limit = 4
+        self.kind_order = ['preview', 'science', 'calibration']
+        self._paused = self.queue.paused
+        self._workers, self._threads, self._hosts, self._active = [], [], {}, {}
+        self._run, self._reported = self._new_run(), 0.
+        self._lock = threading.Lock()
+
+    def _set_status(self, text):
+        if self.on_status is not None:
+            self.on_status(text)
+
+    def _set_log(self, text):
+        if self.on_log is not None:
+            self.on_log(text)
+
+    def _finished(self):
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def _echo(self, message):
+        self._set_log(message)
+        self._set_status(message)
+
+    def _span(self, phase, **info):
+        return perflog.span(phase, self.timings, **info)
+
+    def _progress(self, percent):
+        if self.on_progress is not None:
+            self.on_progress(percent)
+
+    def configure(self, conf):
+        """
+        Apply the settings read by config.read_config
+        """
+        self.user, self.password = conf['user'], conf['password']
+        self.dpath, self.nworkers = conf['dpath'], conf['nworkers']
+        self.decompress = conf['decompress']
+        self.perf_summary = conf['perf_summary']
+        self.per_target = conf['per_target']
+        self.store = None
+        if conf['store'] and (conf['store_path'] or self.dpath):
+            self.store = DataStore(conf['store_path'] or self.dpath + '/.store', link = conf['store_link'])
+        self.bandwidth, self.night_bandwidth = conf['bandwidth'], conf['night_bandwidth']
+        self.night, self.host_limit = conf['night'], conf['host_limit']
+        self.kind_order = conf['queue_order']
+
+    def set_group(self, group, raw, selector = 'sci', target = None):
+        """
+        Get the urls from one entry of the summary table. The
+        name of the target is used for the per target directories,
+        by default the one of the group for the batch queries.
+        """
+        self.raw = raw
+        self.selector = selector
+        self.target = target if target is not None else group.get('target')
+        self.access_url = group['access_url'].split('\n')
+        if raw:
+            self.datalink_url = group['datalink_url'].split('\n')
+        else:
+            self.obs_id = group['obs_id'].split('\n')
+
+    def _get_session(self):
+        """
+        One session for all the downloads, with enough pooled
+        connections for all the workers
+        """
+        manager.set_credentials(self.user, self.password)
+        manager.set_pool_size(self.nworkers)
+        return manager.session()
+
+    def get_data(self, level = 'normal'):
+        """
+        Download the files of the group set by set_group, and
+        wait until the queue is empty (or paused)
+        """
+        self._enqueue_group(self._get_session(), level)
+        self.wait()
+
+    def enqueue(self, groups, raw, selector = 'sci', level = 'normal'):
+        """
+        Find the files of the groups (DataLink, calibration cascade)
+        and add them to the queue with the priority level (high,
+        normal or low). The downloads start with the first files found.
+        """
+        session = self._get_session()
+        nfiles = 0
+        for group in groups:
+            self.set_group(group, raw, selector)
+            nfiles += self._enqueue_group(session, level)
+        self._set_log('{} files added to the download queue'.format(nfiles))
+        self._report(force = True)
+
+    def _enqueue_group(self, session, level):
+        """
+        Queue the files of the current group. Within a priority level,
+        the kinds of files (preview, science, calibration) are
+        downloaded in the order of kind_order.
+        """
+        if self.raw:
+            urls = self._urls_raw(session)
+        else:
+            urls = self._urls_phase3(session)
+        rank = self.levels.index(level) * 10
+        items, nfiles = [], 0
+        for url, kind in urls:
+            order = self.kind_order.index(kind) if kind in self.kind_order else len(self.kind_order)
+            items.append((url, self._dirname(), kind, self.target, rank + order))
+            if len(items) == 20: # the first files start while the others are found
+                nfiles += self.queue.add(items)
+                items = []
+                self.start_queue()
+        nfiles += self.queue.add(items)
+        self.start_queue()
+        return nfiles
+
+    def start_queue(self):
+        """
+        Start the workers, unless the queue is paused or empty
+        """
+        with self._lock:
+            if self._paused or len(self._workers) >= self.nworkers:
+                return
+            first = len(self._workers) == 0
+            if first:
+                if self.queue.pending(('queued',)) == 0:
+                    return
+                self.timings, self._run = {}, self._new_run()
+            session = self._get_session()
+            while len(self._workers) < self.nworkers:
+                worker = threading.Thread(target = self._worker, args = (session,), daemon = True)
+                self._workers.append(worker)
+                self._threads.append(worker)
+                worker.start()
+        if first:
+            self._set_log('Downloading the files of the queue ({} at a time)'.format(self.nworkers))
+
+    def wait(self):
+        """
+        Wait until all the workers are done
+        """
+        while True:
+            with self._lock:
+                self._threads = [thread for thread in self._threads if thread.is_alive()]
+                threads = list(self._threads)
+            if len(threads) == 0:
+                return
+            for thread in threads:
+                thread.join()
+
+    def pause(self):
+        """
+        Stop the downloads, the files being downloaded are queued
+        again and will resume from where they stopped
+        """
+        self._paused = True
+        self.queue.paused = True
+
+    def resume(self):
+        self._paused = False
+        self.queue.paused = False
+        self.start_queue()
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def _new_run(self):
+        return {'start': time.perf_counter(), 'done': 0, 'samples': [],
+                'states': {'downloaded': 0, 'resumed': 0, 'skipped': 0, 'stored': 0, 'failed': 0}}
+
+    def _worker(self, session):
+        """
+        Download the files of the queue, one at a time and at most
+        host_limit at a time from each host, until there is nothing
+        left or the queue is paused. The last worker reports.
+        """
+        while True:
+            with self._lock:
+                busy = [host for host, n in self._hosts.items() if n >= self.host_limit]
+                item = None if self._paused else self.queue.claim(busy)
+                if item is None and (self._paused or self.queue.pending(('queued',)) == 0):
+                    self._workers.remove(threading.current_thread())
+                    last = len(self._workers) == 0
+                    break
+                if item is not None:
+                    host = urlparse(item.url).hostname or ''
+                    self._hosts[host] = self._hosts.get(host, 0) + 1
+                    self._active[item.id] = [0, None]
+            if item is None: # only busy hosts left
+                time.sleep(0.5)
+                continue
+            try:
+                result = self._download(item, session)
+            except Exception as e:
+                result = eso.DownloadResult(None, item.url, 'failed', str(e))
+            with self._lock:
+                self._hosts[host] -= 1
+                self._active.pop(item.id, None)
+            self._record(item, result)
+        if last:
+            self._queue_finished()
+
+    def _record(self, item, result):
+        if result.state == 'interrupted':
+            self.queue.finish(item.id, 'queued')
+            return
+        self.queue.finish(item.id, 'failed' if result.state == 'failed' else 'done', result.reason)
+        with self._lock:
+            self._run['states'][result.state] += 1
+        if result.state == 'failed':
+            self._echo('Could not download the following file: {} ({})'.format(result.filepath, result.reason))
+        self._report(force = True)
+
+    def _queue_finished(self):
+        run = self._run
+        nfiles = sum(run['states'].values())
+        perflog.record('download', time.perf_counter() - run['start'], totals = self.timings, files = nfiles, bytes = run['done'])
+        if nfiles > 0:
+            self._echo('Downloaded: {downloaded}, resumed: {resumed}, already on disk: {skipped}, '
+                       'from the store: {stored}, failed: {failed}'.format(**run['states']))
+        if self._paused:
+            self._echo('Download queue paused, {} files left.'.format(self.queue.pending()))
+        if self.perf_summary and len(self.timings) > 0:
+            self._set_log(summary(self.timings))
+        self._report(force = True)
+        self._progress(100)
+        self._finished()
+
+    def _rate(self):
+        """
+        Bandwidth limit in bytes per second, night_bandwidth between
+        the hours of night (start, end), 0 for no limit
+        """
+        rate = self.bandwidth
+        if self.night is not None:
+            start, end = self.night
+            hour = time.localtime().tm_hour
+            if (start <= hour < end) if start < end else (hour >= start or hour < end):
+                rate = self.night_bandwidth
+        return rate * 1e6
+
+    def _throttle(self, nbytes):
+        if self._paused:
+            raise Interrupted()
+        self.bucket.consume(nbytes)
+
+    def queue_status(self):
+        """
+        Files in each state, bytes downloaded since the queue started,
+        throughput (bytes per second, over the last 10 seconds), bytes
+        left and estimated time left (None if unknown)
+        """
+        counts = self.queue.counts()
+        with self._lock:
+            done, samples = self._run['done'], list(self._run['samples'])
+            active = list(self._active.values())
+        nknown = sum([c[1] for c in counts.values()])
+        mean = sum([c[2] for c in counts.values()]) / nknown if nknown > 0 else 0.
+        nqueued, nqueued_known, queued_size = counts['queued']
+        left = queued_size + mean * (nqueued - nqueued_known)
+        left += sum([max(size - received, 0) if size is not None else mean for received, size in active])
+        rate = 0.
+        if len(samples) > 1 and samples[-1][0] > samples[0][0]:
+            rate = (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+        status = {state: counts[state][0] for state in counts}
+        status.update({'bytes': done, 'left': left, 'rate': rate, 'paused': self._paused,
+                       'eta': left / rate if rate > 0 else None})
+        return status
+
+    def _report(self, force = False):
+        """
+        Progress and state of the queue, at most twice per second
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._reported < 0.5:
+                return
+            self._reported = now
+            samples = self._run['samples']
+            samples.append((now, self._run['done']))
+            while len(samples) > 2 and now - samples[0][0] > 10.:
+                samples.pop(0)
+        self._paused = self.queue.paused # may be paused by another instance
+        self.queue.touch()
+        self.bucket.set_rate(self._rate())
+        status = self.queue_status()
+        if status['bytes'] + status['left'] > 0:
+            self._progress(min(int(100. * status['bytes'] / (status['bytes'] + status['left'])), 99))
+        if self.on_queue is not None:
+            self.on_queue(status)
+        if status['active'] > 0:
+            self._set_status(format_queue_status(status))
+
+    def _dirname(self):
+        """
+        Where the files end up, with one directory per target if
+        per_target is set (only when the store is used)
+        """
+        if self.store is not None and self.per_target and self.target:
+            return '{}/{}'.format(self.dpath, safe_name(self.target))
+        return self.dpath
+
+    def _download(self, item, session):
+        """
+        Download one file of the queue, called from the workers.
+
+        With the store, the file is only downloaded if it is not in the
+        store yet, while holding its lock so that no other process (or
+        thread) downloads it at the same time, and then linked in the
+        data directory. A complete copy already in the data directory
+        (from before the store was used) goes to the store instead of
+        being downloaded again.
+        """
+        file_id = file_id_from_url(item.url)
+        if self.store is None or file_id is None:
+            return self._transfer(item, item.dirname, session)
+        with self.store.lock(file_id) as directory:
+            filepath = self.store.find(file_id)
+            if filepath is None:
+                result = self._transfer(item, directory, session, adopt = item.dirname)
+                if result.state in ['failed', 'interrupted']:
+                    return result
+                filepath, state = result.filepath, result.state
+            else:
+                size = os.path.getsize(filepath)
+                self._update_progress(item, 0, size)
+                self._update_progress(item, size, None)
+                state = 'stored'
+        try:
+            return eso.DownloadResult(200, self.store.link(filepath, item.dirname), state, None)
+        except OSError as e:
+            return eso.DownloadResult(200, filepath, 'failed', 'could not link the file from the store ({})'.format(e))
+
+    def _transfer(self, item, dirname, session, adopt = None):
+        received = [0]
+        def callback(nbytes, total):
+            received[0] += nbytes
+            self._update_progress(item, nbytes, total)
+        with self._span('transfer') as span:
+            try:
+                result = eso.downloadURL(item.url, dirname = dirname, session = session, callback = callback,
+                                         throttle = self._throttle, decompress = self.decompress, adopt = adopt)
+            except Interrupted:
+                result = eso.DownloadResult(None, item.url, 'interrupted', 'the queue was paused')
+            span.update({'file': os.path.basename(str(result.filepath)), 'state': result.state, 'bytes': received[0]})
+        return result
+
+    def _update_progress(self, item, nbytes, total):
+        """
+        Keep track of the bytes downloaded by all the workers
+        """
+        if total is not None:
+            self.queue.set_size(item.id, total)
+        with self._lock:
+            entry = self._active.get(item.id)
+            if entry is not None:
+                entry[0] += nbytes
+                if total is not None:
+                    entry[1] = total
+            self._run['done'] += nbytes
+        self._report()
+
+    def _urls_phase3(self, session):
+        """
+        Get the urls for the phase3 data, with their kind. The
+        DataLink services are queried concurrently and the urls
+        are returned as soon as they are known
+        """
+        self._echo('Searching for products and preview files.')
+        access_url = []
+        for url in self.access_url:
+            if 'almascience' in url:
+                self._echo('Downloading of ALMA data is not yet supported.')
+            else:
+                access_url.append(url)
+        seen = set()
+        with ThreadPoolExecutor(max_workers = self.nworkers) as pool:
+            jobs = {pool.submit(self._datalink_phase3, url, session): url for url in access_url}
+            for job in as_completed(jobs):
+                try:
+                    links = job.result()
+                except Exception as e:
+                    self._echo('Could not get the products for {} ({})'.format(jobs[job], e))
+                    continue
+                for url, kind in links:
+                    if url not in seen:
+                        seen.add(url)
+                        yield url, kind
+
+    def _datalink_phase3(self, url, session):
+        """
+        Product and preview urls of one phase 3 product, with their
+        kind, from the cache if it was already looked up
+        """
+        key = 'products:' + dp_id_from_url(url)
+        links = self.datalinkcache.get(key)
+        if links is None:
+            with self._span('datalink'):
+                datalink = pyvo.dal.adhoc.DatalinkResults.from_result_url(url, session = session)
+            links = []
+            for semantics, kind in [('#this', 'science'), ('#preview', 'preview')]: # Might as well get a preview
+                product_url = next(datalink.bysemantics(semantics), None)
+                if product_url is not None:
+                    links.append([product_url.access_url, kind])
+            self.datalinkcache.set(key, links)
+        return links
+
+    def _urls_raw(self, session):
+        """
+        Get the urls for the raw data, and for their calibration
+        files, with their kind. Each url is returned only once.
+        """
+        seen = set()
+        for url in self.access_url:
+            if url not in seen:
+                seen.add(url)
+                yield url, 'science'
+        if self.selector != 'sci':
+            """
+            Get the calibration files
+            """
+            self._echo('Running the calibration cascade.')
+            nsci = len(seen)
+            for calib in self._calibrations(session):
+                if calib not in seen:
+                    seen.add(calib)
+                    yield calib, 'calibration'
+            if len(seen) == nsci:
+                self._echo('No calibration files were found. ')
+
+    def _calibrations(self, session):
+        """
+        Calibration files of all the science files: from the cache,
+        then from the calSelector service with many science files per
+        request, and finally with one DataLink per science file
+        (concurrently) for the ones that are still missing. If a batch
+        request fails, the next ones are not tried, for the rest of the
+        session, so that a service that does not accept them does not
+        cost an extra request per chunk.
+        """
+        todo = []
+        for url in self.datalink_url:
+            calibs = self.calibcache.get('{}:{}'.format(self.selector, dp_id_from_url(url)))
+            if calibs is None:
+                todo.append(url)
+            else:
+                for calib in calibs:
+                    yield calib
+        if self.calselector_batch and len(todo) > 1:
+            failed = []
+            for i in range(0, len(todo), self.calselector_chunk):
+                chunk = todo[i:i+self.calselector_chunk]
+                try:
+                    calibs = self._calibrations_batch(chunk, session)
+                except Exception as e:
+                    self._set_log('Batch calSelector request failed ({}), one request per file from now on.'.format(e))
+                    self.calselector_batch = False
+                    failed += todo[i:]
+                    break
+                for calib in calibs:
+                    yield calib
+            todo = failed
+        with ThreadPoolExecutor(max_workers = self.nworkers) as pool:
+            jobs = {pool.submit(self._calibrations_one, url, session): url for url in todo}
+            for job in as_completed(jobs):
+                try:
+                    calibs = job.result()
+                except Exception as e:
+                    self._echo('Could not run the calibration cascade for {} ({})'.format(dp_id_from_url(jobs[job]), e))
+                    continue
+                for calib in calibs:
+                    yield calib
+
+    def _calibrations_batch(self, datalink_url, session):
+        """
+        Calibration files for several science files, in one request
+        (comma separated dp_id, as for one file in the ESO notebooks).
+
+        The ID column of the response tells which science file each
+        row belongs to, as in DataLink, so the association of each
+        science file is cached on its own and found by _calibrations
+        for any other set of files. If some rows cannot be attributed
+        that way, nothing is cached.
+        """
+        dp_ids = sorted([dp_id_from_url(url) for url in datalink_url])
+        url = '{}?dp_id={}&mode={}&responseformat=votable'.format(calselector_url, ','.join(dp_ids), self.selector)
+        with self._span('calselector', files = len(dp_ids)):
+            associated_calib_files = pyvo.dal.adhoc.DatalinkResults.from_result_url(url, session = session)
+        table = associated_calib_files.to_table()
+        calibs = self._calib_urls(associated_calib_files)
+        owners = [dp_id_from_url(str(i)) for i in table['ID']] if 'ID' in table.colnames else [None] * len(table)
+        if set(owners) <= set(dp_ids):
+            per_file = {dp_id: [] for dp_id in dp_ids}
+            for owner, semantics, access_url in zip(owners, table['semantics'], table['access_url']):
+                if semantics == '#calibration':
+                    per_file[owner].append(str(access_url))
+            for dp_id, files in per_file.items():
+                self.calibcache.set('{}:{}'.format(self.selector, dp_id), files)
+        return calibs
+
+    def _calibrations_one(self, datalink_url, session):
+        """
+        Calibration files for one science file.
+
+        Following the notebook at:
+        http://archive.eso.org/programmatic/HOWTO/jupyter/authentication_and_authorisation/programmatic_authentication_and_authorisation.html
+        """
+        key = '{}:{}'.format(self.selector, dp_id_from_url(datalink_url))
+        semantics = 'http://archive.eso.org/rdf/datalink/eso#calSelector_{}'.format(self.selector)
+        with self._span('calselector', files = 1):
+            datalink = pyvo.dal.adhoc.DatalinkResults.from_result_url(datalink_url, session = session)
+            raw2master_url = next(datalink.bysemantics(semantics), None)
+            calibs = []
+            if raw2master_url is not None:
+                raw2master_url = raw2master_url.access_url
+                associated_calib_files = pyvo.dal.adhoc.DatalinkResults.from_result_url(raw2master_url, session = session)
+                calibs = self._calib_urls(associated_calib_files)
+        self.calibcache.set(key, calibs)
+        return calibs
+
+    def _calib_urls(self, associated_calib_files):
+        calibrator_mask = associated_calib_files['semantics'] == '#calibration'
+        return [str(url) for url in associated_calib_files.to_table()[calibrator_mask]['access_url']]
@@ -1,5 +1,5 @@
 from PyQt5.QtCore import Qt, pyqtSlot
-from PyQt5.QtWidgets import QMainWindow, QWidget,QVBoxLayout,QHBoxLayout,QLabel,QLineEdit, QMainWindow, QGroupBox, QPushButton, QFileDialog, QRadioButton
+from PyQt5.QtWidgets import QMainWindow, QWidget,QVBoxLayout,QHBoxLayout,QLabel,QLineEdit, QMainWindow, QGroupBox, QPushButton, QFileDialog, QRadioButton, QComboBox, QCheckBox
 
 """
 Download window
@@ -30,7 +30,7 @@ class Dl(QWidget):
         if self.b3.isChecked():
             selector = 'raw2master'
         self.parent().close()
-        self.parent().parent()._start_download(selector)
+        self.parent().parent()._start_download(selector, self.priority.currentText(), self.allrows.isChecked())
 
     @pyqtSlot()
     def on_click_c(self):
@@ -54,9 +54,17 @@ class Dl(QWidget):
         self.b2 = QRadioButton('Science and raw calibration files')
         self.b3 = QRadioButton('Science and processed calibration files')
         """
+        What to queue, and with which priority
+        """
+        self.allrows = QCheckBox('All the entries of the table')
+        self.allrows.setToolTip('Queue all the entries instead of the selected ones')
+        self.priority = QComboBox()
+        self.priority.addItems(['high', 'normal', 'low'])
+        self.priority.setCurrentText('normal')
+        """
         Ok and cancel buttons
         """
-        okbut = QPushButton('Download')
+        okbut = QPushButton('Add to queue')
         okbut.clicked.connect(self.on_click_ok)
         cbut = QPushButton('Cancel')
         cbut.clicked.connect(self.on_click_c)
@@ -85,6 +93,19 @@ class Dl(QWidget):
         groupBox.setLayout(vbox)
         grid.addWidget(groupBox)
         """
+        Queue stuff
+        """
+        groupBox = QGroupBox('Download queue:')
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.allrows)
+        hbox = QHBoxLayout()
+        hbox.addWidget(QLabel('Priority:', self))
+        hbox.addWidget(self.priority)
+        hbox.addStretch()
+        vbox.addLayout(hbox)
+        groupBox.setLayout(vbox)
+        grid.addWidget(groupBox)
+        """
         Add the buttons
         """
         buts = QHBoxLayout()
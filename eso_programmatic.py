@@ -17,9 +17,18 @@ TOKEN_AUTHENTICATION_URL = "https://www.eso.org/sso/oidc/token"
 import os
 import re
 import cgi
-import sys
 import json
+import time
+import zlib
+import queue
+import base64
+import shutil
+import hashlib
+import threading
+import subprocess
 import requests
+from collections import namedtuple
+from urllib3.exceptions import HTTPError as Urllib3Error
 
 def getToken(username, password):
     """Token based authentication to ESO: provide username and password to receive back a JSON Web Token."""
@@ -43,30 +52,267 @@ def getToken(username, password):
     return token
 
 
-##   - downloadURL(file_url[, dirname, filename, session]): Method to download a file given its URL,
+##   - DownloadResult: what downloadURL returns.
+# state is one of 'downloaded', 'resumed', 'skipped' (complete copy already on disk) or 'failed',
+# reason is None unless the download failed.
+DownloadResult = namedtuple('DownloadResult', ['status', 'filepath', 'state', 'reason'])
+
+
+# expectedChecksum(headers): [internal] get a checksum of the file from the response headers, if any
+def expectedChecksum(headers):
+    """Return (algorithm, hexdigest) from the Content-MD5 or Digest headers, or None."""
+    digest = headers.get('Digest')
+    if digest != None:
+        for item in digest.split(','):
+            algo, _, value = item.strip().partition('=')
+            algo = algo.lower().replace('-', '')
+            if algo in ('md5', 'sha256', 'sha1') and value:
+                try:
+                    return algo, base64.b64decode(value).hex()
+                except ValueError:
+                    pass
+    md5 = headers.get('Content-MD5')
+    if md5 != None:
+        try:
+            return 'md5', base64.b64decode(md5).hex()
+        except ValueError:
+            pass
+    return None
+
+
+# fileChecksum(filepath, algo): [internal] checksum of a file on disk
+def fileChecksum(filepath, algo):
+    """Return the hexdigest of a file on disk for the given hashlib algorithm."""
+    h = hashlib.new(algo)
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# isComplete(filepath, total, checksum): [internal] check a local copy against the archive headers
+def isComplete(filepath, total, checksum):
+    """A local file is complete if it matches the checksum, or the size if there is no checksum."""
+    if not os.path.isfile(filepath):
+        return False
+    if checksum != None:
+        return fileChecksum(filepath, checksum[0]) == checksum[1]
+    return total != None and os.path.getsize(filepath) == total
+
+
+##   - Streaming: the body of the downloads is read with readinto in a preallocated buffer, the size of
+# the reads starts at MIN_CHUNK and doubles (up to MAX_CHUNK) while they fill the buffer, and the data
+# are written from that buffer to an unbuffered file.
+MIN_CHUNK = 1 << 18
+MAX_CHUNK = 1 << 23
+
+
+# readChunks(response): [internal] the body of a streamed response, as memoryviews of a reused buffer
+def readChunks(response):
+    """Yield the body of the response by chunks. Each chunk is only valid until the next one is read."""
+    raw = response.raw
+    encoding = response.headers.get('Content-Encoding', 'identity').lower()
+    if encoding not in ('identity', '') or not hasattr(raw, 'readinto'):
+        # let requests decode the content
+        for chunk in response.iter_content(chunk_size=MIN_CHUNK):
+            yield memoryview(chunk)
+        return
+    view = memoryview(bytearray(MAX_CHUNK))
+    size = MIN_CHUNK
+    while True:
+        nbytes = raw.readinto(view[:size])
+        if not nbytes:
+            return
+        yield view[:nbytes]
+        if nbytes == size and size < MAX_CHUNK:
+            size *= 2
+
+
+# writeAll(f, chunk): [internal] write a whole chunk to an unbuffered file
+def writeAll(f, chunk):
+    while len(chunk) > 0:
+        chunk = chunk[f.write(chunk):]
+
+
+# streamBody(response, write[, hasher, callback, throttle]): [internal] copy the body of a response
+def streamBody(response, write, hasher=None, callback=None, throttle=None):
+    """Pass each chunk of the body to write, after throttle and before callback. Returns the number of bytes."""
+    nbytes = 0
+    for chunk in readChunks(response):
+        if throttle != None:
+            throttle(len(chunk))
+        if hasher != None:
+            hasher.update(chunk)
+        write(chunk)
+        nbytes += len(chunk)
+        if callback != None:
+            callback(len(chunk), None)
+    return nbytes
+
+
+class AllocMarker(object):
+    """[internal] Marker of a preallocated .part file: it holds the number of bytes really written,
+       saved at most once per second, so that the download can resume from there if the program is
+       killed before the file is truncated to that size."""
+
+    def __init__(self, allocpath, nbytes):
+        self.path = allocpath
+        self.file = open(allocpath, 'w')
+        self.saved = 0.
+        self.save(nbytes)
+
+    def save(self, nbytes):
+        # same length every time, the previous value is overwritten in place
+        self.file.seek(0)
+        self.file.write('%020d' % (nbytes))
+        self.file.flush()
+        self.saved = time.time()
+
+    def update(self, nbytes):
+        if time.time() - self.saved >= 1.:
+            self.save(nbytes)
+
+    def close(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+# readMarker(allocpath): [internal] number of bytes saved in a marker, 0 if it cannot be read
+def readMarker(allocpath):
+    try:
+        with open(allocpath) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+# preallocate(f, offset, total, allocpath): [internal] reserve the space of a file on disk
+def preallocate(f, offset, total, allocpath):
+    """Reserve the rest of the file with posix_fallocate, if the size is known. The file then has its
+       final size until it is truncated, allocpath keeps the number of bytes written in case the program
+       is killed before that (see AllocMarker). Returns the marker, or None if no space was reserved."""
+    if total == None or total <= offset or not hasattr(os, 'posix_fallocate'):
+        return None
+    marker = AllocMarker(allocpath, offset)
+    try:
+        os.posix_fallocate(f.fileno(), offset, total - offset)
+    except OSError:
+        marker.close()
+        return None
+    return marker
+
+
+##   - Decompression on the fly of the .gz (zlib, in a thread) and .Z (gzip -dc, in a separate process)
+# files. The .fz files are tile compressed FITS files that are read as they are, they are not decompressed.
+def decompressedName(filepath):
+    """Path of the file once decompressed, or None if it cannot be decompressed on the fly."""
+    if filepath.endswith('.gz'):
+        return filepath[:-3]
+    if filepath.endswith('.Z') and shutil.which('gzip') != None:
+        return filepath[:-2]
+    return None
+
+
+class Decompressor(object):
+    """[internal] Decompress a stream into a file in a worker, so that the download
+       does not wait for the decompression."""
+
+    def __init__(self, filepath, out):
+        self.error = None
+        self.process, self.thread = None, None
+        if filepath.endswith('.Z'):
+            self.process = subprocess.Popen(['gzip', '-dc'], stdin=subprocess.PIPE, stdout=out)
+        else:
+            self.queue = queue.Queue(maxsize=8)
+            self.thread = threading.Thread(target=self._inflate, args=(out,), daemon=True)
+            self.thread.start()
+
+    def _inflate(self, out):
+        inflater = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        while True:
+            data = self.queue.get()
+            if data == None:
+                break
+            if self.error != None:
+                continue
+            try:
+                while len(data) > 0:
+                    out.write(inflater.decompress(data))
+                    if not inflater.eof:
+                        break
+                    # concatenated gzip members
+                    data = inflater.unused_data
+                    inflater = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            except (zlib.error, OSError) as e:
+                self.error = e
+        if self.error == None:
+            out.write(inflater.flush())
+
+    def write(self, chunk):
+        if self.error != None:
+            raise OSError('decompression failed (%s)' % (self.error))
+        if self.process != None:
+            self.process.stdin.write(chunk)
+        else:
+            self.queue.put(bytes(chunk))
+
+    def close(self):
+        if self.process != None:
+            self.process.stdin.close()
+            # 2 is only a warning (e.g. trailing garbage)
+            if self.process.wait() not in (0, 2):
+                raise OSError('gzip -dc failed with status %d' % (self.process.returncode))
+        else:
+            self.queue.put(None)
+            self.thread.join()
+            if self.error != None:
+                raise OSError('decompression failed (%s)' % (self.error))
+
+    def abort(self):
+        if self.process != None:
+            self.process.kill()
+            self.process.wait()
+        else:
+            self.error = self.error or 'aborted'
+            self.queue.put(None)
+            self.thread.join()
+
+
+##   - downloadURL(file_url[, dirname, filename, session, callback, throttle, decompress]): Method to download a file given its URL,
 # either anonymously or with a token.
-# Returns: http status, filepath on disk (if successul)
-def downloadURL(file_url, dirname='.', filename=None, session=None):
+# The data are first written in <filepath>.part, which is used to resume an interrupted download
+# with a Range request. Files already on disk and matching the archive size/checksum are not downloaded again.
+# Returns: DownloadResult(http status, filepath on disk, state, reason)
+def downloadURL(file_url, dirname='.', filename=None, session=None, callback=None, throttle=None, decompress=False, adopt=None):
     """Method to download a file, either anonymously (no session or session not "tokenized"), or authenticated (if session with token is provided).
-       It returns: http status, and filepath on disk (if successful)"""
+       If provided, callback(nbytes, total) is called once the headers are known (nbytes=0, total=size of the file or None)
+       and then for each chunk written to disk, or already on disk (total=None).
+       If provided, throttle(nbytes) is called for each chunk received from the network, it can wait
+       to limit the bandwidth, or raise an exception to stop the download (the .part file is kept).
+       With decompress=True, .gz and .Z files are decompressed while they are downloaded (see downloadDecompressed).
+       If provided, adopt is another directory where a complete copy of the file may already be: it is then
+       hard linked (or moved if that fails) into dirname instead of being downloaded again.
+       It returns a DownloadResult: http status, filepath on disk, state and reason of the failure"""
 
     if dirname != None:
         if not os.access(dirname, os.W_OK):
-            print("ERROR: Provided directory (%s) is not writable" % (dirname))
-            sys.exit(1)
-      
-    if session!=None:
-        response = session.get(file_url, stream=True)
-    else:
+            return DownloadResult(None, dirname, 'failed', 'Provided directory (%s) is not writable' % (dirname))
+
+    if session == None:
         # no session -> no authentication
-        response = requests.get(file_url, stream=True)
+        session = requests
+
+    try:
+        response = session.get(file_url, stream=True)
+    except requests.RequestException as e:
+        return DownloadResult(None, file_url, 'failed', str(e))
 
     # If not provided, define the filename from the response header
     if filename == None:
         contentdisposition = response.headers.get('Content-Disposition')
         if contentdisposition != None:
             value, params = cgi.parse_header(contentdisposition)
-            filename = params["filename"]
+            filename = params.get("filename")
 
         # if the response header does not provide a name, derive a name from the URL
         if filename == None:
@@ -78,13 +324,142 @@ def downloadURL(file_url, dirname='.', filename=None, session=None):
         filepath = filename
     else:
         filepath = dirname + '/' + filename
-
-    if response.status_code == 200:
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=50000):
-                f.write(chunk)
-
-    return (response.status_code, filepath)
+    partpath = filepath + '.part'
+    # marks a .part file that was preallocated (see preallocate)
+    allocpath = filepath + '.alloc.part'
+
+    if response.status_code != 200:
+        response.close()
+        return DownloadResult(response.status_code, filepath, 'failed', 'HTTP status %d' % (response.status_code))
+
+    total = response.headers.get('Content-Length')
+    total = int(total) if total != None else None
+    checksum = expectedChecksum(response.headers)
+    if callback != None:
+        callback(0, total)
+
+    if decompress and decompressedName(filepath) != None:
+        return downloadDecompressed(response, filepath, total, checksum, callback, throttle)
+
+    # a complete copy is already there
+    if isComplete(filepath, total, checksum):
+        response.close()
+        if callback != None:
+            callback(os.path.getsize(filepath), None)
+        return DownloadResult(response.status_code, filepath, 'skipped', None)
+
+    # a complete copy is in the other directory: take it over
+    if adopt != None and not os.path.exists(filepath):
+        adoptpath = adopt + '/' + os.path.basename(filepath)
+        if os.path.realpath(adoptpath) != os.path.realpath(filepath) and isComplete(adoptpath, total, checksum):
+            response.close()
+            try:
+                os.link(adoptpath, filepath)
+            except OSError:
+                shutil.move(adoptpath, filepath)
+            if callback != None:
+                callback(os.path.getsize(filepath), None)
+            return DownloadResult(200, filepath, 'skipped', None)
+
+    # a preallocated .part file that was not truncated: only the bytes saved in the marker were written
+    if os.path.isfile(allocpath):
+        written = readMarker(allocpath)
+        if os.path.isfile(partpath):
+            with open(partpath, 'r+b') as f:
+                f.truncate(min(written, os.path.getsize(partpath)))
+        os.remove(allocpath)
+
+    # resume from the .part file if the server accepts ranges
+    offset = os.path.getsize(partpath) if os.path.isfile(partpath) else 0
+    if total != None and offset > total:
+        offset = 0
+    state, mode = 'downloaded', 'wb'
+    hasher = None
+    try:
+        if offset > 0 and offset == total:
+            response.close()
+            response = None
+        elif offset > 0 and response.headers.get('Accept-Ranges', 'bytes') != 'none':
+            response.close()
+            response = session.get(file_url, stream=True, headers={'Range': 'bytes=%d-' % (offset)})
+            if response.status_code == 206:
+                state, mode = 'resumed', 'r+b'
+            elif response.status_code != 200:
+                response.close()
+                return DownloadResult(response.status_code, filepath, 'failed', 'HTTP status %d on resume' % (response.status_code))
+        if mode == 'r+b' or response == None:
+            state = 'resumed'
+            if callback != None:
+                callback(offset, None)
+
+        if response != None:
+            if checksum != None:
+                hasher = hashlib.new(checksum[0])
+                if mode == 'r+b':
+                    with open(partpath, 'rb') as f:
+                        for block in iter(lambda: f.read(MAX_CHUNK), b''):
+                            hasher.update(block)
+            with open(partpath, mode, buffering=0) as f:
+                if mode == 'r+b':
+                    f.seek(offset)
+                marker = preallocate(f, offset, total, allocpath)
+                def write(chunk):
+                    writeAll(f, chunk)
+                    if marker != None:
+                        marker.update(f.tell())
+                try:
+                    streamBody(response, write, hasher, callback, throttle)
+                finally:
+                    if marker != None:
+                        f.truncate(f.tell())
+                        marker.close()
+    except (requests.RequestException, Urllib3Error, OSError) as e:
+        return DownloadResult(None, filepath, 'failed', 'interrupted, will resume next time (%s)' % (e))
+
+    if total != None and os.path.getsize(partpath) != total:
+        return DownloadResult(200, filepath, 'failed', 'incomplete file (%d out of %d bytes)' % (os.path.getsize(partpath), total))
+    if checksum != None:
+        digest = hasher.hexdigest() if hasher != None else fileChecksum(partpath, checksum[0])
+        if digest != checksum[1]:
+            os.remove(partpath)
+            return DownloadResult(200, filepath, 'failed', 'checksum mismatch')
+    os.replace(partpath, filepath)
+    return DownloadResult(200, filepath, state, None)
+
+
+# downloadDecompressed(response, filepath, total, checksum, callback, throttle): [internal] download and decompress
+def downloadDecompressed(response, filepath, total, checksum, callback, throttle):
+    """Only the decompressed file is written on disk, under the name without the .gz or .Z extension,
+       so there is no second pass over the data. Such a download cannot be resumed, it starts again
+       from scratch if it is interrupted. The size and checksum are checked on the compressed data."""
+    outpath = decompressedName(filepath)
+    partpath = outpath + '.part'
+    if os.path.isfile(outpath):
+        response.close()
+        if callback != None:
+            callback(total if total != None else os.path.getsize(outpath), None)
+        return DownloadResult(response.status_code, outpath, 'skipped', None)
+
+    hasher = hashlib.new(checksum[0]) if checksum != None else None
+    try:
+        with open(partpath, 'wb') as out:
+            decompressor = Decompressor(filepath, out)
+            try:
+                nbytes = streamBody(response, decompressor.write, hasher, callback, throttle)
+            except BaseException:
+                decompressor.abort()
+                raise
+            decompressor.close()
+    except (requests.RequestException, Urllib3Error, OSError) as e:
+        return DownloadResult(None, outpath, 'failed', 'interrupted (%s)' % (e))
+
+    if total != None and nbytes != total:
+        return DownloadResult(200, outpath, 'failed', 'incomplete file (%d out of %d bytes)' % (nbytes, total))
+    if hasher != None and hasher.hexdigest() != checksum[1]:
+        os.remove(partpath)
+        return DownloadResult(200, outpath, 'failed', 'checksum mismatch')
+    os.replace(partpath, outpath)
+    return DownloadResult(200, outpath, 'downloaded', None)
 
 
 # Let's define some methods to nicely print reference files information from the calselector service:
@@ -0,0 +1,17 @@
+import importlib
+# ------------------------------------------------------------
+class LazyModule(object):
+    """
+    Module that is only imported the first time one of its
+    attributes is used, to keep the start up fast when
+    numpy, astropy or pyvo are not needed right away.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
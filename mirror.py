@@ -0,0 +1,235 @@
+import math
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from lazy import LazyModule
+from cache import cache_dir
+np = LazyModule('numpy')
+aptable = LazyModule('astropy.table')
+# ------------------------------------------------------------
+band_width = 0.05 # degrees
+# ------------------------------------------------------------
+def _band(dec):
+    return int(math.floor((dec + 90.) / band_width))
+
+def separations(ra1, dec1, ra2, dec2):
+    """
+    Angular distance in arcsec, ra2 and dec2 can be arrays
+    """
+    ra1, dec1, ra2, dec2 = np.radians(ra1), np.radians(dec1), np.radians(ra2), np.radians(dec2)
+    h = np.sin((dec2 - dec1) / 2.)**2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2.)**2
+    return np.degrees(2. * np.arcsin(np.minimum(1., np.sqrt(h)))) * 3600.
+
+def inside_polygon(ra, dec, vertices):
+    """
+    Which of the positions are inside the polygon, vertices
+    being (ra1, dec1, ra2, dec2, ...). The polygon is assumed
+    to be small enough to be treated as flat.
+    """
+    vra, vdec = np.array(vertices[0::2], dtype = float), np.array(vertices[1::2], dtype = float)
+    ref = vra[0]
+    vra = (vra - ref + 180.) % 360. - 180.
+    x = (ra - ref + 180.) % 360. - 180.
+    inside = np.zeros(len(x), dtype = bool)
+    j = len(vra) - 1
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for i in range(len(vra)):
+            crossing = (vdec[i] > dec) != (vdec[j] > dec)
+            xcross = (vra[j] - vra[i]) * (dec - vdec[i]) / (vdec[j] - vdec[i]) + vra[i]
+            inside ^= crossing & (x < xcross)
+            j = i
+    return inside
+# ------------------------------------------------------------
+class Mirror(object):
+    """
+    Local copy of the metadata of dbo.raw and ivoa.obscore,
+    for the instruments that were synchronised, stored in
+    a SQLite file in the config directory.
+
+    Each table has a "band" column, the declination band of width
+    band_width of each file, and is indexed on (band, ra), so that a
+    cone search only reads a few ranges of the index before the exact
+    distances are computed. The tables are created from the columns
+    of the first results that are inserted.
+    """
+    coords = {'raw': ('ra', 'dec'), 'obscore': ('s_ra', 's_dec')}
+
+    def __init__(self, filename = cache_dir + '/mirror.sqlite'):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._maxfov = {}
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread = False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS sync (kind TEXT, instrument TEXT, last_key TEXT, '
+                             'last_id TEXT, nrows INTEGER, updated REAL, PRIMARY KEY (kind, instrument))')
+
+    def _columns(self, kind):
+        """
+        Names and types of the columns of a table, empty if it does not exist
+        """
+        return [(row[1], row[2]) for row in self._db.execute('PRAGMA table_info({})'.format(kind))]
+
+    def _create(self, kind, table):
+        columns = []
+        for name in table.colnames:
+            dtype = table[name].dtype.kind
+            sqltype = 'REAL' if dtype == 'f' else 'INTEGER' if dtype in 'iub' else 'TEXT'
+            columns.append('{} {}{}'.format(name, sqltype, ' PRIMARY KEY' if name == 'dp_id' else ''))
+        self._db.execute('CREATE TABLE {} ({}, band INTEGER)'.format(kind, ', '.join(columns)))
+        self._db.execute('CREATE INDEX {0}_band ON {0} (band, {1})'.format(kind, self.coords[kind][0]))
+
+    def insert(self, kind, table):
+        """
+        Add (or update) the rows of an astropy table to the mirror of
+        dbo.raw (kind = 'raw') or ivoa.obscore (kind = 'obscore')
+        """
+        if len(table) == 0:
+            return
+        columns = []
+        for name in table.colnames:
+            data = np.ma.getdata(table[name].data)
+            if data.dtype.kind in 'SU':
+                data = data.astype(str).astype(object)
+            values = data.tolist()
+            mask = np.ma.getmaskarray(table[name].data)
+            if mask.any():
+                values = [None if m else v for v, m in zip(values, mask)]
+            columns.append(values)
+        dec = np.ma.filled(np.ma.asarray(table[self.coords[kind][1]], dtype = float), np.nan)
+        bands = [None if np.isnan(d) else _band(d) for d in dec]
+        with self._lock, self._db:
+            self._maxfov.pop(kind, None)
+            existing = [c[0] for c in self._columns(kind)]
+            if len(existing) == 0:
+                self._create(kind, table)
+                existing = table.colnames + ['band']
+            names = [n for n in table.colnames if n in existing]
+            rows = zip(*([columns[table.colnames.index(n)] for n in names] + [bands]))
+            self._db.executemany('INSERT OR REPLACE INTO {} ({}, band) VALUES ({})'.format(
+                kind, ', '.join(names), ', '.join(['?'] * (len(names) + 1))), rows)
+
+    def sync_state(self, kind, instrument):
+        """
+        Keys of the last row synchronised for an instrument,
+        (None, None) if it was never synchronised
+        """
+        with self._lock:
+            row = self._db.execute('SELECT last_key, last_id FROM sync WHERE kind = ? AND instrument = ?',
+                                   (kind, instrument)).fetchone()
+        return (None, None) if row is None else row
+
+    def set_sync_state(self, kind, instrument, last_key, last_id, nrows):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?, '
+                             'COALESCE((SELECT nrows FROM sync WHERE kind = ? AND instrument = ?), 0) + ?, ?)',
+                             (kind, instrument, last_key, last_id, kind, instrument, nrows, time.time()))
+
+    def status(self):
+        """
+        Number of rows and time of the last sync of each instrument
+        """
+        with self._lock:
+            return self._db.execute('SELECT kind, instrument, nrows, updated FROM sync ORDER BY kind, instrument').fetchall()
+
+    def clear(self):
+        with self._lock, self._db:
+            self._maxfov = {}
+            for kind in self.coords:
+                self._db.execute('DROP TABLE IF EXISTS {}'.format(kind))
+            self._db.execute('DELETE FROM sync')
+
+    def search(self, kind, shapes, where = None):
+        """
+        Rows inside any of the shapes (see core.adql_shape), as an
+        astropy table, or None if nothing was synchronised yet. where
+        is an additional SQL condition. For ivoa.obscore, the position
+        and field of view (s_fov) of each product are used instead of
+        its exact footprint.
+        """
+        with self._lock:
+            columns = [c for c in self._columns(kind) if c[0] != 'band']
+            if len(columns) == 0:
+                return None
+            names = [c[0] for c in columns]
+            ira, idec = names.index(self.coords[kind][0]), names.index(self.coords[kind][1])
+            ifov = names.index('s_fov') if 's_fov' in names else None
+            if ifov is not None and kind not in self._maxfov:
+                self._maxfov[kind] = self._db.execute('SELECT MAX(s_fov) FROM {}'.format(kind)).fetchone()[0] or 0.
+            pad = self._maxfov.get(kind, 0.) * 1800.
+            found = {}
+            for shape in shapes:
+                condition, params = self._candidates(shape, self.coords[kind][0], pad)
+                query = 'SELECT {} FROM {} WHERE {}'.format(', '.join(names), kind, condition)
+                if where is not None:
+                    query += ' AND ({})'.format(where)
+                rows = self._db.execute(query, params).fetchall()
+                if len(rows) == 0:
+                    continue
+                ra = np.array([np.nan if r[ira] is None else r[ira] for r in rows], dtype = float)
+                dec = np.array([np.nan if r[idec] is None else r[idec] for r in rows], dtype = float)
+                if shape[0] == 'circle':
+                    radius = shape[3]
+                    if ifov is not None:
+                        radius = radius + np.nan_to_num(np.array([r[ifov] for r in rows], dtype = float)) * 1800.
+                    keep = separations(shape[1], shape[2], ra, dec) <= radius
+                else:
+                    keep = inside_polygon(ra, dec, shape[1])
+                for row in np.array(rows, dtype = object)[keep]:
+                    found[row[names.index('dp_id')]] = row
+        return self._to_table(columns, list(found.values()))
+
+    def _candidates(self, shape, racol, pad = 0.):
+        """
+        SQL condition on band and right ascension (racol) for the rows
+        that may be inside a shape, pad (arcsec) is added around it.
+        The margin in right ascension is that distance divided by the
+        cosine of the declination, for the cones and the polygons.
+        """
+        if shape[0] == 'circle':
+            rad = (shape[3] + pad) / 3600.
+            ramin, ramax = shape[1], shape[1]
+            decmin, decmax = shape[2] - rad, shape[2] + rad
+        else:
+            rad = pad / 3600.
+            vra, vdec = shape[1][0::2], shape[1][1::2]
+            offsets = [(r - vra[0] + 180.) % 360. - 180. for r in vra]
+            ramin, ramax = vra[0] + min(offsets), vra[0] + max(offsets)
+            decmin, decmax = min(vdec) - rad, max(vdec) + rad
+        decmin, decmax = max(-90., decmin), min(90., decmax)
+        cosdec = math.cos(math.radians(max(abs(decmin), abs(decmax))))
+        if cosdec > 1e-3:
+            ramin, ramax = ramin - rad / cosdec, ramax + rad / cosdec
+        else:
+            ramin, ramax = 0., 360.
+        bands = list(range(_band(decmin), _band(decmax) + 1))
+        condition = 'band IN ({})'.format(', '.join(['?'] * len(bands)))
+        params = bands
+        if ramax - ramin >= 360.:
+            return condition, params
+        if ramin < 0.:
+            condition += ' AND ({0} >= ? OR {0} <= ?)'
+            params = params + [ramin + 360., ramax]
+        elif ramax >= 360.:
+            condition += ' AND ({0} >= ? OR {0} <= ?)'
+            params = params + [ramin, ramax - 360.]
+        else:
+            condition += ' AND {0} BETWEEN ? AND ?'
+            params = params + [ramin, ramax]
+        return condition.format(racol), params
+
+    def _to_table(self, columns, rows):
+        """
+        astropy table from the rows, NULL values are masked
+        """
+        table = aptable.Table()
+        for i, (name, sqltype) in enumerate(columns):
+            values = [row[i] for row in rows]
+            mask = np.array([v is None for v in values], dtype = bool)
+            if sqltype in ['REAL', 'INTEGER']:
+                data = np.array([0 if v is None else v for v in values], dtype = float if sqltype == 'REAL' else int)
+            else:
+                data = np.array(['' if v is None else str(v) for v in values], dtype = str)
+            table[name] = aptable.MaskedColumn(data, mask = mask) if mask.any() else data
+        return table
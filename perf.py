@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from cache import cache_dir
+# ------------------------------------------------------------
+class PerfLog(object):
+    """
+    Timing of the phases of the queries and downloads (name
+    resolution, token, TAP, transfers, grouping, table display).
+
+    Each span is written as one json line to perf.jsonl in the config
+    directory, with its phase, start time, duration in seconds and
+    whatever information was added to it (rows, bytes, ...). The file
+    is renamed perf.jsonl.1 when it is larger than max_size (in bytes).
+    """
+
+    def __init__(self, filename = cache_dir + '/perf.jsonl', max_size = 10e6):
+        self.filename = filename
+        self.max_size = max_size
+        self.enabled = True
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase, totals = None, **info):
+        """
+        Time the code inside the with block. The dictionary it returns
+        can be filled with more information, and the duration is added
+        to totals (see summary) if provided.
+        """
+        start, t0 = time.time(), time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(phase, time.perf_counter() - t0, start, totals, **info)
+
+    def record(self, phase, duration, start = None, totals = None, **info):
+        """
+        Write a span that was timed somewhere else
+        """
+        if start is None:
+            start = time.time() - duration
+        if totals is not None:
+            with self._lock:
+                count, total, nbytes = totals.get(phase, (0, 0., 0))
+                totals[phase] = (count + 1, total + duration, nbytes + info.get('bytes', 0))
+        if not self.enabled:
+            return
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+                 'phase': phase, 'duration': round(duration, 6)}
+        entry.update(info)
+        if info.get('bytes') and duration > 0:
+            entry['mbps'] = round(info['bytes'] / 1e6 / duration, 3)
+        line = json.dumps(entry, default = str) + '\n'
+        with self._lock:
+            try:
+                Path(self.filename).parent.mkdir(parents=True, exist_ok=True)
+                if os.path.isfile(self.filename) and os.path.getsize(self.filename) > self.max_size:
+                    os.replace(self.filename, self.filename + '.1')
+                with open(self.filename, 'a') as f:
+                    f.write(line)
+            except OSError:
+                pass
+# ------------------------------------------------------------
+def summary(totals):
+    """
+    Readable summary of the spans added to totals
+    """
+    lines = ['Timing:']
+    for phase, (count, total, nbytes) in sorted(totals.items(), key = lambda t: -t[1][1]):
+        line = '  {}: {:.3f} s ({} times)'.format(phase, total, count)
+        if nbytes > 0 and total > 0:
+            line += ', {:.1f} MB at {:.2f} MB/s'.format(nbytes / 1e6, nbytes / 1e6 / total)
+        lines.append(line)
+    return '\n'.join(lines)
+# ------------------------------------------------------------
+perflog = PerfLog()
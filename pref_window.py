@@ -1,5 +1,6 @@
 import configparser
 from pathlib import Path
+from config import config_file
 from PyQt5.QtCore import Qt, pyqtSlot
 from PyQt5.QtWidgets import QMainWindow, QWidget,QVBoxLayout,QHBoxLayout,QLabel,QLineEdit, QMainWindow, QGroupBox, QPushButton, QFileDialog, QGridLayout, QCheckBox, QButtonGroup
 
@@ -26,7 +27,7 @@ class Pref(QWidget):
 
     @pyqtSlot()
     def on_click_ok(self):
-        filename = str(Path.home()) + '/.config/esoquery/esoquery.conf'
+        filename = config_file
         output = configparser.ConfigParser()
         output.optionxform = str
         output.read(filename)
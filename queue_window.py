@@ -0,0 +1,188 @@
+from core import format_queue_status, format_size
+from PyQt5.QtCore import Qt, pyqtSlot, QAbstractTableModel, QModelIndex
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QMainWindow, QGroupBox, QPushButton, QLabel, QTableView, QAbstractItemView
+
+
+"""
+Download queue window
+"""
+class QueueWindow(QMainWindow):
+    def __init__(self, parent=None):
+        super(QueueWindow, self).__init__(parent)
+        self.init_ui()
+
+    def init_ui(self):
+        self.setWindowTitle('Download queue')
+        self.qu = Queue(self)
+        self.setCentralWidget(self.qu)
+
+class QueueModel(QAbstractTableModel):
+    """
+    Table model over the rows of DownloadQueue.items, the cells
+    are only formatted when they are displayed
+    """
+    labels = ['state', 'kind', 'priority', 'size', 'file', 'directory', 'reason']
+
+    def __init__(self, parent = None):
+        super(QueueModel, self).__init__(parent)
+        self.items = []
+
+    def rowCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def columnCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.labels)
+
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        item_id, url, dirname, kind, target, priority, state, size, reason = self.items[index.row()]
+        if role == Qt.DisplayRole:
+            return [state, kind, str(priority), '--' if size is None else format_size(size),
+                    url.split('/')[-1], dirname, reason or ''][index.column()]
+        if role == Qt.ToolTipRole and index.column() == 4:
+            return url
+        return None
+
+    def headerData(self, section, orientation, role = Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.labels[section]
+        return None
+
+    def ids(self, rows):
+        return [self.items[row][0] for row in rows]
+
+    def update(self, items):
+        """
+        Show new rows of the queue. Only the rows that changed are
+        updated if the files are the same, and the selection follows
+        the files when they only moved. Returns True if the model was
+        reset (files added or removed).
+        """
+        items = list(items)
+        old = [item[0] for item in self.items]
+        new = [item[0] for item in items]
+        if old == new:
+            changed = [row for row, (before, after) in enumerate(zip(self.items, items)) if before != after]
+            self.items = items
+            if len(changed) > 0:
+                self.dataChanged.emit(self.index(min(changed), 0), self.index(max(changed), len(self.labels) - 1))
+            return False
+        if sorted(old) != sorted(new):
+            self.beginResetModel()
+            self.items = items
+            self.endResetModel()
+            return True
+        self.layoutAboutToBeChanged.emit()
+        before = self.persistentIndexList()
+        ids = [old[index.row()] for index in before]
+        self.items = items
+        rows = {item_id: row for row, item_id in enumerate(new)}
+        self.changePersistentIndexList(before, [self.index(rows[item_id], index.column()) for item_id, index in zip(ids, before)])
+        self.layoutChanged.emit()
+        return False
+
+
+class Queue(QWidget):
+    def __init__(self, parent=None):
+        super(Queue, self).__init__(parent)
+        self.initUI()
+
+    @property
+    def downloader(self):
+        return self.parent().parent().datadownloader
+
+    @pyqtSlot()
+    def on_click_pause(self):
+        if self.downloader.paused:
+            self.downloader.resume()
+        else:
+            self.downloader.pause()
+        self.refresh()
+
+    @pyqtSlot()
+    def on_click_retry(self):
+        self.downloader.queue.retry()
+        self.downloader.start_queue()
+        self.refresh()
+
+    @pyqtSlot()
+    def on_click_remove(self):
+        rows = set([index.row() for index in self.table.selectionModel().selectedRows()])
+        self.downloader.queue.remove(self.model.ids(rows))
+        self.refresh()
+
+    @pyqtSlot()
+    def on_click_clear(self):
+        self.downloader.queue.clear()
+        self.refresh()
+
+    @pyqtSlot()
+    def on_click_close(self):
+        self.parent().close()
+
+    def update_status(self, status):
+        """
+        Called for each update of the queue (at most twice per second)
+        """
+        self.status.setText(format_queue_status(status))
+        self.pausebut.setText('Resume' if status['paused'] else 'Pause')
+        if self.parent().isVisible():
+            self.refresh()
+
+    def refresh(self):
+        """
+        Show the files of the queue, active ones first. The
+        width of the columns is only computed again when
+        files were added or removed.
+        """
+        if self.model.update(self.downloader.queue.items()):
+            self.table.resizeColumnsToContents()
+        self.pausebut.setText('Resume' if self.downloader.paused else 'Pause')
+
+    def initUI(self):
+        """
+        The list of files, and buttons to pause the
+        queue and to manage the files that are done
+        """
+        self.status = QLabel('', self)
+        self.model = QueueModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.horizontalHeader().setResizeContentsPrecision(200)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.pausebut = QPushButton('Pause')
+        self.pausebut.clicked.connect(self.on_click_pause)
+        retrybut = QPushButton('Retry failed')
+        retrybut.clicked.connect(self.on_click_retry)
+        removebut = QPushButton('Remove')
+        removebut.setToolTip('Remove the selected files from the queue (not the active ones)')
+        removebut.clicked.connect(self.on_click_remove)
+        clearbut = QPushButton('Clear finished')
+        clearbut.clicked.connect(self.on_click_clear)
+        closebut = QPushButton('Close')
+        closebut.clicked.connect(self.on_click_close)
+
+        main = QVBoxLayout()
+        grid = QVBoxLayout()
+        groupBox = QGroupBox('Files to download')
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.status)
+        vbox.addWidget(self.table)
+        groupBox.setLayout(vbox)
+        grid.addWidget(groupBox)
+
+        buts = QHBoxLayout()
+        buts.addWidget(self.pausebut, alignment = Qt.AlignLeft)
+        buts.addWidget(retrybut, alignment = Qt.AlignLeft)
+        buts.addWidget(removebut, alignment = Qt.AlignLeft)
+        buts.addStretch()
+        buts.addWidget(clearbut, alignment = Qt.AlignRight)
+        buts.addWidget(closebut, alignment = Qt.AlignRight)
+
+        main.addLayout(grid)
+        main.addLayout(buts)
+        self.setLayout(main)
@@ -0,0 +1,77 @@
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import quote
+from collections import namedtuple
+# ------------------------------------------------------------
+backend_names = {'S': 'Simbad', 'N': 'NED', 'V': 'VizieR'}
+# ------------------------------------------------------------
+# J2000 position in degrees, proper motion in mas/yr (pmra includes
+# the cos(dec) factor, 0 if unknown), main identifier and resolver
+Position = namedtuple('Position', ['ra', 'dec', 'pmra', 'pmdec', 'name', 'resolver'])
+# ------------------------------------------------------------
+def _children(element, tag):
+    """
+    Sub-elements with this tag, whatever their namespace
+    """
+    return [child for child in element if child.tag.split('}')[-1] == tag]
+
+def _text(element, tag):
+    children = _children(element, tag)
+    if len(children) == 0 or children[0].text is None:
+        return None
+    return children[0].text.strip()
+
+def _float(text, default = None):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return default
+
+def parse_sesame(text):
+    """
+    Positions from the XML output of Sesame (-ox), one per Target
+    in the order of the request, None for the names that were not
+    found. The first resolver with a position is used.
+    """
+    root = ElementTree.fromstring(text)
+    positions = []
+    for target in _children(root, 'Target'):
+        position = None
+        for resolver in _children(target, 'Resolver'):
+            ra, dec = _float(_text(resolver, 'jradeg')), _float(_text(resolver, 'jdedeg'))
+            if ra is None or dec is None:
+                continue
+            pmra, pmdec = 0., 0.
+            for pm in _children(resolver, 'pm'):
+                pmra, pmdec = _float(_text(pm, 'pmRA'), 0.), _float(_text(pm, 'pmDE'), 0.)
+            name = _text(resolver, 'oname') or _text(target, 'name')
+            backend = resolver.get('name', '')
+            position = Position(ra, dec, pmra, pmdec, name, backend_names.get(backend[:1], backend))
+            break
+        positions.append(position)
+    return positions
+
+def resolve_names(session, urls, names, backends = 'SNV'):
+    """
+    Resolve several names with one Sesame request, returns a
+    dictionary name: Position (or None if it was not found).
+
+    The backends are tried in this order for each name (S for
+    Simbad, N for NED, V for VizieR), and the urls (Sesame and its
+    mirrors) in this order if one of them cannot be reached.
+    """
+    query = '&'.join([quote(name, safe = '') for name in names])
+    errors = []
+    for url in urls:
+        try:
+            response = session.get('{}/-ox/{}?{}'.format(url, backends, query))
+            if response.status_code != 200:
+                raise IOError('HTTP status {}'.format(response.status_code))
+            positions = parse_sesame(response.content)
+        except (IOError, ElementTree.ParseError) as e:
+            errors.append('{}: {}'.format(url, e))
+            continue
+        if len(positions) != len(names):
+            errors.append('{}: {} answers for {} names'.format(url, len(positions), len(names)))
+            continue
+        return dict(zip(names, positions))
+    raise IOError('Sesame could not be reached ({})'.format('; '.join(errors)))
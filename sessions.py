@@ -0,0 +1,172 @@
+"""
+HTTP sessions shared by all the calls to the archive and to CDS.
+
+The sessions keep pooled keep-alive connections per host, retry with
+an exponential backoff on 429 and 5xx responses, and add the ESO token
+to the requests sent to eso.org. The token is requested once and kept
+in memory until shortly before it expires.
+"""
+import json
+import time
+import base64
+import threading
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import eso_programmatic as eso
+# ------------------------------------------------------------
+def make_retry(total = 5, backoff_factor = 0.5):
+    """
+    Retry on 429 and 5xx for the idempotent methods only. A POST (TAP
+    query, job submission or phase change) is only sent again if the
+    connection failed, when the server cannot have received it, so
+    that a slow answer does not create a second job.
+    """
+    return Retry(total = total, backoff_factor = backoff_factor, raise_on_status = False,
+                 status_forcelist = [429, 500, 502, 503, 504], respect_retry_after_header = True)
+
+def token_expiry(token):
+    """
+    Expiration time of a JSON Web Token, None if it cannot be read
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, ValueError, TypeError):
+        return None
+# ------------------------------------------------------------
+class TimeoutAdapter(HTTPAdapter):
+    """
+    Default timeout for all the requests of a session
+    """
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super(TimeoutAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutAdapter, self).send(request, **kwargs)
+
+
+class TokenAuth(requests.auth.AuthBase):
+    """
+    Add the current token to the requests sent to eso.org,
+    and only to them
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def __call__(self, request):
+        host = urlparse(request.url).hostname or ''
+        if host == 'eso.org' or host.endswith('.eso.org'):
+            token = self.manager.token()
+            if token is not None:
+                request.headers['Authorization'] = 'Bearer ' + token
+        return request
+
+
+class TokenBucket(object):
+    """
+    Bandwidth limit shared by all the transfers: each chunk that is
+    received takes its size from the bucket, which is refilled at
+    rate bytes per second and holds at most burst seconds worth of
+    bytes. The thread waits when the bucket is empty, so that the
+    server slows down. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate = 0., burst = 1.):
+        self.rate, self.burst = rate, burst
+        self._tokens, self._last = 0., time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            if rate != self.rate:
+                self.rate = rate
+                self._tokens, self._last = 0., time.monotonic()
+
+    def consume(self, nbytes):
+        with self._lock:
+            if self.rate <= 0:
+                return
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._last) * self.rate, self.rate * self.burst) - nbytes
+            self._last = now
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SessionManager(object):
+    """
+    Keep the sessions and the token
+    """
+
+    def __init__(self, pool_maxsize = 10, margin = 60.):
+        self.pool_maxsize = pool_maxsize
+        self.margin = margin
+        self.user, self.password = None, None
+        self._token, self._expires = None, 0.
+        self._sessions = {}
+        self._lock = threading.RLock()
+
+    def set_credentials(self, user, password):
+        """
+        Change of login, forget the previous token
+        """
+        with self._lock:
+            if (user, password) != (self.user, self.password):
+                self.user, self.password = user, password
+                self._token, self._expires = None, 0.
+
+    def set_pool_size(self, nworkers):
+        """
+        Make sure there are enough connections per host
+        for all the workers
+        """
+        with self._lock:
+            if nworkers > self.pool_maxsize:
+                self.pool_maxsize = nworkers
+                for session in self._sessions.values():
+                    self._mount(session, session.timeout)
+
+    def token(self):
+        """
+        Current token, or None if anonymous. A new one is
+        requested if it expires in less than margin seconds.
+        """
+        with self._lock:
+            if self.user is None or self.password is None:
+                return None
+            if self._token is None or time.time() > self._expires - self.margin:
+                self._token = eso.getToken(self.user, self.password)
+                expires = token_expiry(self._token) if self._token is not None else None
+                # if the expiration is unknown, ask again in 5 minutes
+                self._expires = expires if expires is not None else time.time() + 300.
+            return self._token
+
+    def session(self, timeout = None):
+        """
+        The shared session, one per timeout
+        """
+        with self._lock:
+            if timeout not in self._sessions:
+                session = requests.Session()
+                session.auth = TokenAuth(self)
+                session.timeout = timeout
+                self._mount(session, timeout)
+                self._sessions[timeout] = session
+            return self._sessions[timeout]
+
+    def _mount(self, session, timeout):
+        adapter = TimeoutAdapter(timeout, pool_connections = 10, pool_maxsize = self.pool_maxsize,
+                                 max_retries = make_retry())
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+# ------------------------------------------------------------
+manager = SessionManager()
@@ -0,0 +1,88 @@
+import os
+import re
+import shutil
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: # Windows, no locking between processes
+    fcntl = None
+# ------------------------------------------------------------
+def safe_name(name):
+    """
+    Directory name for a target
+    """
+    return re.sub(r'[^\w.+-]+', '_', name).strip('_') or 'unknown'
+# ------------------------------------------------------------
+class DataStore(object):
+    """
+    Local store of the downloaded files, indexed by their archive
+    file id, and shared by all the processes using the same root
+    directory (batch jobs, colleagues on a shared disk, ...).
+
+    Each file is in its own directory, <root>/<xx>/<file id>/<name>,
+    where xx are the first characters of a hash of the file id. A lock
+    file in that directory makes sure that only one process downloads
+    a given file at a time, the others wait and then use it. The data
+    directories are filled with links to the files of the store.
+    """
+
+    def __init__(self, root, link = 'hardlink'):
+        self.root = root
+        self.link_mode = link
+
+    def directory(self, file_id):
+        key = hashlib.sha1(file_id.encode()).hexdigest()[:2]
+        return '{}/{}/{}'.format(self.root, key, safe_name(file_id))
+
+    def find(self, file_id):
+        """
+        Path of the file if it is in the store, or None
+        """
+        directory = self.directory(file_id)
+        if not os.path.isdir(directory):
+            return None
+        for name in sorted(os.listdir(directory)):
+            if name != '.lock' and not name.endswith('.part'):
+                return '{}/{}'.format(directory, name)
+        return None
+
+    @contextmanager
+    def lock(self, file_id):
+        """
+        Exclusive access to the directory of a file, across processes.
+        Waits until the process downloading it is done.
+        """
+        directory = self.directory(file_id)
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        with open(directory + '/.lock', 'a') as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield directory
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def link(self, source, dirname):
+        """
+        Make the file of the store appear in dirname, as a hard link,
+        a symbolic link or a copy (link_mode). Hard links fall back to
+        symbolic links across file systems. Returns the new path.
+        """
+        Path(dirname).mkdir(parents=True, exist_ok=True)
+        target = '{}/{}'.format(dirname, os.path.basename(source))
+        if os.path.lexists(target):
+            return target
+        if self.link_mode == 'copy':
+            shutil.copy2(source, target)
+            return target
+        if self.link_mode == 'hardlink':
+            try:
+                os.link(source, target)
+                return target
+            except OSError:
+                pass
+        os.symlink(os.path.abspath(source), target)
+        return target